@@ -0,0 +1,29 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks measuring how many packets packet queue can handle.
+
+Run each one as a module from the top of the repository, for example:
+
+  python -m benchmarks.micro --output micro.json
+
+  - micro: the per-packet work of Pipe.attempt, EventLog.add and the
+    nfqueue callback, on synthetic packets.
+  - udp_load: UDP traffic through udp_proxy at increasing rates, finding the
+    rate where it saturates.
+  - rest_load: requests to /events and /pipes while UDP traffic flows.
+
+Results are written as JSON, with the versions they were measured on, so
+runs can be compared across releases.
+"""
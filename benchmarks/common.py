@@ -0,0 +1,212 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers shared by the benchmarks: JSON results, and a UDP proxy with an
+echo server behind it, in child processes, for load generators to talk to.
+"""
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+
+def add_output_argument(parser):
+  parser.add_argument(
+      '-o', '--output', type=str,
+      help='file to write the results to as JSON, instead of stdout')
+
+
+def metadata():
+  """Returns what the results were measured on."""
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  try:
+    commit = subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], cwd=root,
+        stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+
+  try:
+    import twisted
+    twisted_version = twisted.__version__
+  except ImportError:
+    twisted_version = None
+
+  return {
+      'time': time.time(),
+      'commit': commit,
+      'python': sys.version.split()[0],
+      'implementation': platform.python_implementation(),
+      'twisted': twisted_version,
+      'platform': platform.platform(),
+      'cpus': multiprocessing.cpu_count(),
+  }
+
+
+def write_results(benchmark, results, output=None):
+  """Writes results as JSON, along with their metadata."""
+  document = {'benchmark': benchmark, 'metadata': metadata(),
+              'results': results}
+  text = json.dumps(document, indent=2, sort_keys=True)
+  if output:
+    with open(output, 'w') as f:
+      f.write(text + '\n')
+  else:
+    print text
+
+
+def quantiles(values, qs=(0.5, 0.9, 0.99, 0.999)):
+  """Returns {'p50': ...} for the given quantiles of a list of numbers."""
+  values = sorted(values)
+  result = {}
+  for q in qs:
+    key = 'p{:g}'.format(q * 100)
+    if values:
+      result[key] = values[min(len(values) - 1, int(q * len(values)))]
+    else:
+      result[key] = None
+  return result
+
+
+def _echo(sock):
+  while True:
+    data, address = sock.recvfrom(65535)
+    sock.sendto(data, address)
+
+
+def _serve(echo_port, params, api, ports):
+  from twisted.internet import reactor
+  from packet_queue import api_server
+  from packet_queue import monitoring
+  from packet_queue import simulation
+  from packet_queue import udp_proxy
+
+  params = simulation.Params(params)
+  pipes = simulation.PipePair(params, monitoring.EventLog())
+  proxy_port = udp_proxy.configure(echo_port, 0, pipes)
+  api_port = None
+  if api:
+    api_port = reactor.listenTCP(
+        0, api_server.create_site(params, pipes)).getHost().port
+  ports.put((proxy_port, api_port))
+  reactor.run()
+
+
+class Stack(object):
+  """A UDP echo server behind a udp_proxy, each in a child process.
+
+  Load generators send to proxy_port on localhost. With api, the proxy's
+  REST API listens on api_port.
+  """
+
+  def __init__(self, params=None, api=False):
+    from packet_queue import simulation
+    params = dict(simulation.Pipe.PARAMS, **(params or {}))
+
+    echo_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    echo_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    echo_socket.bind(('127.0.0.1', 0))
+    echo_port = echo_socket.getsockname()[1]
+    ports = multiprocessing.Queue()
+    self.processes = [
+        multiprocessing.Process(target=_echo, args=(echo_socket,)),
+        multiprocessing.Process(target=_serve,
+                                args=(echo_port, params, api, ports)),
+    ]
+    for process in self.processes:
+      process.daemon = True
+      process.start()
+    echo_socket.close()
+    self.proxy_port, self.api_port = ports.get(timeout=10)
+
+  def stop(self):
+    for process in self.processes:
+      process.terminate()
+      process.join()
+
+
+# Each datagram starts with its sequence number and send time.
+HEADER = struct.Struct('!Id')
+
+
+class Load(object):
+  """Sends datagrams to a port at a steady rate, and times their echoes."""
+
+  def __init__(self, port, size=200):
+    self.address = ('127.0.0.1', port)
+    self.padding = '\0' * max(0, size - HEADER.size)
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    self.socket.settimeout(0.2)
+
+  def close(self):
+    self.socket.close()
+
+  def run(self, rate, duration, drain=1.0):
+    """Sends rate datagrams a second for duration seconds, then waits up to
+    drain seconds for the last echoes.
+
+    Returns the datagrams sent and received, the rate actually sent at, and
+    round trip time quantiles in seconds.
+    """
+    latencies = []
+    stopping = threading.Event()
+    def receive():
+      while True:
+        try:
+          data = self.socket.recv(65535)
+        except socket.timeout:
+          if stopping.is_set():
+            return
+          continue
+        _, sent = HEADER.unpack_from(data)
+        latencies.append(time.time() - sent)
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+
+    sent = 0
+    start = time.time()
+    interval = 1.0 / rate
+    while True:
+      now = time.time()
+      elapsed = now - start
+      if elapsed >= duration:
+        break
+      # Catch up on sends that are due, then sleep until the next one.
+      while sent <= elapsed / interval and sent < rate * duration:
+        self.socket.sendto(HEADER.pack(sent, time.time()) + self.padding,
+                           self.address)
+        sent += 1
+      time.sleep(max(0, start + sent * interval - time.time()))
+    send_seconds = time.time() - start
+
+    time.sleep(drain)
+    stopping.set()
+    receiver.join()
+
+    received = len(latencies)
+    return {
+        'rate': rate,
+        'sent': sent,
+        'received': received,
+        'loss': 1 - float(received) / sent if sent else 0.0,
+        'achieved_rate': sent / send_seconds,
+        'latency': quantiles(latencies),
+    }
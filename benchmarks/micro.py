@@ -0,0 +1,156 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the per-packet work of the simulation, on synthetic packets.
+
+Pipes run on an offline.VirtualReactor, so the numbers leave out the event
+loop and sockets. Each benchmark is run --repeat times, and the fastest run
+is reported, as operations per second and nanoseconds per operation.
+"""
+import argparse
+import socket
+import struct
+import time
+
+from packet_queue import monitoring
+from packet_queue import offline
+from packet_queue import qdisc
+from packet_queue import simulation
+
+from . import common
+
+
+# Packets attempted between runs of the virtual reactor, so deliveries are
+# part of the work measured.
+BATCH = 1000
+
+
+def udp_header(source_port):
+  """Returns the first bytes of an IPv4 UDP packet of 1200 bytes."""
+  ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 1200, 0, 0, 64, 17, 0,
+                   socket.inet_aton('10.0.0.1'), socket.inet_aton('10.0.0.2'))
+  return ip + struct.pack('!HHHH', source_port, 3000, 1180, 0)
+
+
+def bench_pipe_attempt(count, **params):
+  reactor = offline.VirtualReactor()
+  pipe = simulation.Pipe('up',
+                         simulation.Params(simulation.Pipe.PARAMS, **params),
+                         monitoring.EventLog(), reactor)
+  deliver = drop = lambda: None
+  attempt = pipe.attempt
+  start = time.time()
+  for i in xrange(count):
+    attempt(deliver, drop, 1200, i & 63)
+    if i % BATCH == BATCH - 1:
+      reactor.advance(0.01)
+  reactor.run()
+  return time.time() - start
+
+
+def bench_event_log_add(count):
+  event_log = monitoring.EventLog()
+  add = event_log.add
+  start = time.time()
+  for i in xrange(count):
+    add(i * 0.0001, 'up', 'deliver', 1200)
+  return time.time() - start
+
+
+def bench_nfq_callback(count):
+  """The Python side of libnetfilter_queue.nfq_callback, through
+  nfqueue.packet_handler to a pipe, for packets of 64 flows.
+  """
+  from packet_queue import libnetfilter_queue
+  from packet_queue import nfqueue
+
+  class Manager(object):
+    def set_verdict(self, packet, verdict):
+      pass
+
+  reactor = offline.VirtualReactor()
+  pipe = simulation.Pipe('up', simulation.Params(simulation.Pipe.PARAMS),
+                         monitoring.EventLog(), reactor)
+  handler = nfqueue.packet_handler(Manager(), pipe)
+  # As copied to user space with nfqueue_copy_headers.
+  copy_range = libnetfilter_queue.HEADERS_SIZE
+  payloads = [udp_header(5000 + i).ljust(copy_range, '\0')
+              for i in range(64)]
+  Packet = libnetfilter_queue.Packet
+  packet_length = libnetfilter_queue.packet_length
+
+  start = time.time()
+  for i in xrange(count):
+    payload = payloads[i & 63]
+    size = len(payload)
+    if size >= copy_range:
+      size = packet_length(payload, size)
+    handler(Packet(i, size, payload, 1))
+    if i % BATCH == BATCH - 1:
+      reactor.advance(0.01)
+  reactor.run()
+  return time.time() - start
+
+
+BENCHMARKS = [
+    ('pipe_attempt', bench_pipe_attempt, {}),
+    ('pipe_attempt_shaped', bench_pipe_attempt,
+     {'bandwidth': 125000000, 'buffer': 1000000, 'delay': 0.02}),
+    ('pipe_attempt_impaired', bench_pipe_attempt,
+     {'bandwidth': 125000000, 'buffer': 1000000, 'delay': 0.02,
+      'jitter': 0.005, 'gilbert_p': 0.01, 'gilbert_r': 0.3,
+      'qdisc': qdisc.NAMES.index('fq_codel')}),
+    ('event_log_add', bench_event_log_add, {}),
+    ('nfq_callback', bench_nfq_callback, {}),
+]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument(
+      '-n', '--count', type=int, default=200000,
+      help='operations per run')
+  parser.add_argument(
+      '-r', '--repeat', type=int, default=5,
+      help='runs of each benchmark, of which the fastest is reported')
+  parser.add_argument(
+      'names', nargs='*', metavar='name',
+      help='benchmarks to run, defaults to all of: ' +
+      ', '.join(name for (name, _, _) in BENCHMARKS))
+  common.add_output_argument(parser)
+  args = parser.parse_args()
+
+  results = {}
+  for name, function, kwargs in BENCHMARKS:
+    if args.names and name not in args.names:
+      continue
+    try:
+      seconds = min(function(args.count, **kwargs)
+                    for _ in range(args.repeat))
+    except (ImportError, OSError) as e:
+      # nfqueue needs Linux, python-iptables and libnetfilter_queue.
+      results[name] = {'skipped': str(e)}
+      continue
+    results[name] = {
+        'count': args.count,
+        'seconds': seconds,
+        'per_second': args.count / seconds,
+        'nanoseconds': seconds / args.count * 1e9,
+    }
+
+  common.write_results('micro', results, args.output)
+
+
+if __name__ == '__main__':
+  main()
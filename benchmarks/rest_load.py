@@ -0,0 +1,131 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load-tests the REST API while UDP traffic flows through the proxy.
+
+The API shares the proxy's reactor, so requests compete with packets. UDP
+traffic is sent at --rate first on its own, then while --clients clients
+make requests as fast as they can: polling /events with a cursor, fetching
+/events summaries, and reading and writing /pipes. Reports the requests
+served per second and their latency, and what happened to the traffic.
+"""
+import argparse
+import httplib
+import json
+import threading
+import time
+
+from . import common
+
+
+def request_cycle(cursor):
+  """Returns the (method, path, body) of the requests each client cycles
+  through.
+  """
+  return [
+      ('GET', '/events?cursor={}'.format(cursor), None),
+      ('GET', '/events?resolution=100ms', None),
+      ('GET', '/pipes', None),
+      ('PUT', '/pipes', json.dumps({'loss': 0.0})),
+  ]
+
+
+def client(port, deadline, latencies, errors):
+  connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+  cursor = 0
+  while time.time() < deadline:
+    for method, path, body in request_cycle(cursor):
+      start = time.time()
+      try:
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        content = response.read()
+      except (httplib.HTTPException, IOError):
+        errors.append(path)
+        connection.close()
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+        continue
+      endpoint = method + ' ' + path.split('?')[0]
+      if '?resolution' in path:
+        endpoint += ' (summary)'
+      latencies.setdefault(endpoint, []).append(time.time() - start)
+      if path.startswith('/events?cursor'):
+        cursor = json.loads(content)['cursor']
+  connection.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument(
+      '--rate', type=int, default=5000,
+      help='UDP packets per second to send through the proxy')
+  parser.add_argument(
+      '--clients', type=int, default=4,
+      help='number of concurrent API clients')
+  parser.add_argument(
+      '--duration', type=float, default=10.0,
+      help='seconds of each phase')
+  common.add_output_argument(parser)
+  args = parser.parse_args()
+
+  stack = common.Stack(api=True)
+  load = common.Load(stack.proxy_port)
+  try:
+    alone = load.run(args.rate, args.duration)
+
+    traffic = {}
+    def send():
+      traffic.update(load.run(args.rate, args.duration))
+    sender = threading.Thread(target=send)
+    sender.start()
+
+    latencies = [{} for _ in range(args.clients)]
+    errors = []
+    deadline = time.time() + args.duration
+    clients = [threading.Thread(target=client,
+                                args=(stack.api_port, deadline, latencies[i],
+                                      errors))
+               for i in range(args.clients)]
+    for thread in clients:
+      thread.start()
+    for thread in clients:
+      thread.join()
+    sender.join()
+  finally:
+    load.close()
+    stack.stop()
+
+  endpoints = {}
+  for client_latencies in latencies:
+    for endpoint, values in client_latencies.items():
+      endpoints.setdefault(endpoint, []).extend(values)
+  api = {}
+  for endpoint, values in endpoints.items():
+    api[endpoint] = {'requests': len(values),
+                     'per_second': len(values) / args.duration,
+                     'latency': common.quantiles(values)}
+
+  common.write_results('rest_load', {
+      'rate': args.rate,
+      'clients': args.clients,
+      'duration': args.duration,
+      'api': api,
+      'errors': len(errors),
+      'traffic_alone': alone,
+      'traffic_with_requests': traffic,
+  }, args.output)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,78 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Finds the packet rate at which udp_proxy saturates.
+
+Sends UDP traffic to an echo server through the proxy, with no impairments,
+at each rate in turn, and records the loss and round trip times. The
+saturation point is the highest rate the proxy kept up with: losing no more
+than --max_loss of the datagrams, with the load generator sending at the
+rate it was asked to.
+
+The load generator is a single Python process too, so on a fast proxy it may
+saturate first; achieved_rate shows when it did.
+"""
+import argparse
+
+from . import common
+
+
+RATES = [1000, 2000, 5000, 10000, 20000, 50000, 100000]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument(
+      '--rates', type=lambda text: [int(r) for r in text.split(',')],
+      default=RATES, help='comma-separated packets per second to try')
+  parser.add_argument(
+      '--duration', type=float, default=5.0,
+      help='seconds to send at each rate')
+  parser.add_argument(
+      '--size', type=int, default=200,
+      help='bytes of UDP payload per datagram')
+  parser.add_argument(
+      '--max_loss', type=float, default=0.01,
+      help='fraction of datagrams a rate may lose and still be kept up with')
+  common.add_output_argument(parser)
+  args = parser.parse_args()
+
+  stack = common.Stack()
+  load = common.Load(stack.proxy_port, args.size)
+  steps = []
+  saturation = None
+  try:
+    for rate in args.rates:
+      step = load.run(rate, args.duration)
+      steps.append(step)
+      kept_up = (step['loss'] <= args.max_loss and
+                 step['achieved_rate'] >= 0.95 * rate)
+      if not kept_up:
+        break
+      saturation = rate
+  finally:
+    load.close()
+    stack.stop()
+
+  common.write_results('udp_load', {
+      'size': args.size,
+      'duration': args.duration,
+      'max_loss': args.max_loss,
+      'saturation_rate': saturation,
+      'steps': steps,
+  }, args.output)
+
+
+if __name__ == '__main__':
+  main()
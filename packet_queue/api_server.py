@@ -23,13 +23,18 @@ import os
 import sys
 import time
 
+from twisted.internet import interfaces
 from twisted.internet import reactor
+from twisted.internet import task
 from twisted.web import resource
 from twisted.web import static
 from twisted.web import server
 from twisted.web import util
+from zope.interface import implementer
 
 from . import command
+from . import monitoring
+from . import schedules
 from . import simulation
 
 
@@ -39,7 +44,12 @@ def create_site(params, pipes):
 
   root = static.File(web_dir)
   root.putChild('pipes', PipeResource(params))
-  root.putChild('events', EventsResource(pipes.event_log))
+  root.putChild('schedules', ScheduleResource(params))
+  events = EventsResource(pipes.event_log)
+  events.putChild('stream', EventStreamResource(pipes.event_log))
+  root.putChild('events', events)
+  root.putChild('meters', MeterResource(pipes))
+  root.putChild('metrics', MetricsResource(pipes))
   return server.Site(root)
 
 
@@ -55,14 +65,16 @@ def parse_pipe_params(args, types=None):
 
   Raises:
     ValueError in case of invalid cast result (raised from attempted
-        typecast PARAM_TYPES[k]())
+        typecast PARAM_TYPES[k]()), or of an index out of range
     TypeError in case of invalid cast type (raised from attempted typecast)
   """
 
   if types is None:
     types = {k: type(v) for (k, v) in simulation.Pipe.PARAMS.items()}
 
-  return {k: types[k](v) for (k, v) in args.items() if k in types}
+  params = {k: types[k](v) for (k, v) in args.items() if k in types}
+  simulation.check_params(params)
+  return params
 
 
 class PipeResource(resource.Resource):
@@ -82,11 +94,11 @@ class PipeResource(resource.Resource):
     self.params.update(self.default)
 
     request.setHeader('Content-Type', 'application/json')
-    return json.dumps(self.params)
+    return json.dumps(dict(self.params))
 
   def render_GET(self, request):
     request.setHeader('Content-Type', 'application/json')
-    return json.dumps(self.params)
+    return json.dumps(dict(self.params))
 
   def render_PUT(self, request):
     """Updates the params object.
@@ -109,11 +121,145 @@ class PipeResource(resource.Resource):
       return json.dumps(response)
     else:
       self.params.update(params)
-      return json.dumps(self.params)
+      return json.dumps(dict(self.params))
+
+
+class ScheduleResource(resource.Resource):
+  """Runs a program of params changes, as described in the schedules module.
+
+  One program runs at a time: putting a new one stops the last.
+  """
+
+  is_leaf = True
+
+  def __init__(self, params):
+    self.params = params
+    self.param_types = {k: type(v) for (k, v) in params.items()}
+    self.schedule = None
+    self.clock = reactor
+    resource.Resource.__init__(self)
+
+  def _render_schedule(self, request):
+    request.setHeader('Content-Type', 'application/json')
+    if self.schedule is None:
+      return json.dumps(None)
+    return json.dumps(self.schedule.to_json())
+
+  def render_DELETE(self, request):
+    """Stops the program, leaving the params as they are."""
+    if self.schedule is not None:
+      self.schedule.stop()
+    return self._render_schedule(request)
+
+  def render_GET(self, request):
+    return self._render_schedule(request)
+
+  def render_PUT(self, request):
+    """Starts the program in the request body."""
+    content = request.content.read()
+    try:
+      steps, loop, interval = schedules.parse_program(
+          json.loads(content), self.param_types)
+    except ValueError as e:
+      request.setResponseCode(400)
+      request.setHeader('Content-Type', 'application/json')
+      return json.dumps({'error': str(e.args[0])})
+
+    if self.schedule is not None:
+      self.schedule.stop()
+    self.schedule = schedules.Schedule(self.params, steps, loop, interval,
+                                       self.clock)
+    self.schedule.start()
+    return self._render_schedule(request)
+
+
+class MeterResource(resource.Resource):
+  """Reports each pipe's packet and byte counters."""
+
+  is_leaf = True
+
+  def __init__(self, pipes):
+    self.pipes = pipes
+    resource.Resource.__init__(self)
+
+  def render_DELETE(self, request):
+    """Resets the counters to zero."""
+    self.pipes.up.reset_meter()
+    self.pipes.down.reset_meter()
+    return self.render_GET(request)
+
+  def render_GET(self, request):
+    request.setHeader('Content-Type', 'application/json')
+    response = {
+      'now': time.time(),
+      'up': self.pipes.up.meter(),
+      'down': self.pipes.down.meter(),
+    }
+    return json.dumps(response)
+
+
+class MetricsResource(resource.Resource):
+  """Exports pipe counters, buffer occupancy and latency to Prometheus."""
+
+  is_leaf = True
+
+  def __init__(self, pipes):
+    self.pipes = pipes
+    resource.Resource.__init__(self)
+
+  def render_GET(self, request):
+    request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+    pipes = [self.pipes.up, self.pipes.down]
+    lines = []
+
+    for unit in ['packets', 'bytes']:
+      name = 'packet_queue_{}_total'.format(unit)
+      lines.append('# HELP {} {} seen by each pipe, by outcome.'.format(
+          name, unit.capitalize()))
+      lines.append('# TYPE {} counter'.format(name))
+      for pipe in pipes:
+        meter = pipe.meter()
+        for outcome in ['attempted', 'delivered', 'dropped_buffer',
+                        'dropped_aqm', 'dropped_loss']:
+          lines.append('{}{{pipe="{}",outcome="{}"}} {}'.format(
+              name, pipe.name, outcome, meter[unit + '_' + outcome]))
+
+    name = 'packet_queue_buffer_bytes'
+    lines.append('# HELP {} Bytes held in each pipe\'s buffer.'.format(name))
+    lines.append('# TYPE {} gauge'.format(name))
+    for pipe in pipes:
+      lines.append('{}{{pipe="{}"}} {}'.format(name, pipe.name, pipe.size))
+
+    name = 'packet_queue_latency_seconds'
+    lines.append('# HELP {} Latency of delivered packets.'.format(name))
+    lines.append('# TYPE {} histogram'.format(name))
+    for pipe in pipes:
+      histogram = pipe.latency
+      count = 0
+      for bound, bucket_count in zip(histogram.bounds + [float('inf')],
+                                     histogram.counts):
+        count += bucket_count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('{}_bucket{{pipe="{}",le="{}"}} {}'.format(
+            name, pipe.name, le, count))
+      lines.append('{}_sum{{pipe="{}"}} {!r}'.format(
+          name, pipe.name, histogram.sum))
+      lines.append('{}_count{{pipe="{}"}} {}'.format(name, pipe.name, count))
+
+    return '\n'.join(lines) + '\n'
 
 
 class EventsResource(resource.Resource):
-  """Provides a view of recent network simulation events."""
+  """Provides a view of recent network simulation events.
+
+  With a resolution query argument such as "100ms", returns per-pipe summaries
+  over intervals of that length instead of raw events. An optional since
+  argument, in seconds since the epoch, limits the intervals returned.
+
+  Raw events are returned along with a cursor. Clients that pass it back as
+  the cursor argument get the events that followed; clients that don't get
+  the events not yet returned to anyone.
+  """
 
   is_leaf = True
 
@@ -122,11 +268,139 @@ class EventsResource(resource.Resource):
     resource.Resource.__init__(self)
 
   def render_GET(self, request):
-    events = self.event_log.get_pending()
-    response = {'now': time.time(), 'events': events}
+    request.setHeader('Content-Type', 'application/json')
+    if 'resolution' in request.args:
+      try:
+        resolution = monitoring.parse_duration(request.args['resolution'][0])
+        since = float(request.args.get('since', [0.0])[0])
+      except ValueError:
+        request.setResponseCode(400)
+        response = {'error': 'Unable to parse resolution or since'}
+        return json.dumps(response)
+      buckets = self.event_log.get_buckets(resolution, since)
+      response = {'now': time.time(), 'resolution': resolution,
+                  'buckets': buckets}
+      return json.dumps(response)
+
+    if 'cursor' in request.args:
+      try:
+        cursor = int(request.args['cursor'][0])
+      except ValueError:
+        request.setResponseCode(400)
+        response = {'error': 'Unable to parse cursor'}
+        return json.dumps(response)
+      events, cursor = self.event_log.get_since(cursor)
+    else:
+      events = self.event_log.get_pending()
+      cursor = self.event_log.next_id
+    response = {'now': time.time(), 'events': events, 'cursor': cursor}
     return json.dumps(response)
 
 
+class EventStreamResource(resource.Resource):
+  """Pushes network simulation events to clients as Server-Sent Events.
+
+  Each client has its own EventStream, and accepts the same resolution
+  argument as EventsResource. New events are pushed every interval seconds.
+  """
+
+  is_leaf = True
+  interval = 0.1
+
+  def __init__(self, event_log):
+    self.event_log = event_log
+    self.streams = set()
+    self.loop = None
+    self.clock = reactor
+    resource.Resource.__init__(self)
+
+  def render_GET(self, request):
+    resolution = None
+    cursor = self.event_log.next_id
+    try:
+      if 'resolution' in request.args:
+        resolution = monitoring.parse_duration(request.args['resolution'][0])
+      if request.getHeader('Last-Event-ID'):
+        cursor = int(request.getHeader('Last-Event-ID'))
+    except ValueError:
+      request.setResponseCode(400)
+      request.setHeader('Content-Type', 'application/json')
+      return json.dumps({'error': 'Unable to parse resolution or event id'})
+
+    request.setHeader('Content-Type', 'text/event-stream')
+    request.setHeader('Cache-Control', 'no-cache')
+    request.write('retry: 1000\n\n')
+
+    stream = EventStream(request, cursor, resolution)
+    request.registerProducer(stream, True)
+    self.streams.add(stream)
+    request.notifyFinish().addBoth(lambda _: self.remove(stream))
+
+    if self.loop is None:
+      self.loop = task.LoopingCall(self.push)
+      self.loop.clock = self.clock
+      self.loop.start(self.interval, now=False)
+    return server.NOT_DONE_YET
+
+  def remove(self, stream):
+    self.streams.discard(stream)
+    if not self.streams and self.loop is not None:
+      self.loop.stop()
+      self.loop = None
+
+  def push(self):
+    now = time.time()
+    for stream in list(self.streams):
+      stream.push(self.event_log, now)
+
+
+@implementer(interfaces.IPushProducer)
+class EventStream(object):
+  """A client of EventStreamResource, with its own cursor into the event log.
+
+  Nothing is written while the client's connection is paused for
+  backpressure. The cursor stays put meanwhile, so a slow client only misses
+  events if it falls behind by more than the event log holds.
+  """
+
+  def __init__(self, request, cursor, resolution=None):
+    self.request = request
+    self.cursor = cursor
+    self.resolution = resolution
+    self.since = 0.0  # Start of the last aggregated interval sent.
+    self.paused = False
+
+  def pauseProducing(self):
+    self.paused = True
+
+  def resumeProducing(self):
+    self.paused = False
+
+  def stopProducing(self):
+    self.paused = True
+
+  def push(self, event_log, now):
+    if self.paused:
+      return
+
+    if self.resolution:
+      # The last interval may still be filling up, so it's sent again until
+      # a later one starts.
+      buckets = event_log.get_buckets(self.resolution, self.since)
+      if not buckets:
+        return
+      self.since = max(bucket['start'] for bucket in buckets)
+      data = {'now': now, 'resolution': self.resolution, 'buckets': buckets}
+      self.request.write('data: {}\n\n'.format(json.dumps(data)))
+    else:
+      events, self.cursor = event_log.get_since(self.cursor)
+      if not events:
+        return
+      data = {'now': now, 'events': events, 'cursor': self.cursor}
+      self.request.write(
+          'id: {}\ndata: {}\n\n'.format(self.cursor, json.dumps(data)))
+
+
 def configure():
   params, pipes, args = command.configure(rest_server=True)
   port = args.rest_api_port
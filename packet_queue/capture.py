@@ -0,0 +1,242 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Captures the packets going through the pipes to pcapng files.
+
+Each packet is recorded once its fate is known, with a comment giving its
+verdict (delivered, or dropped for buffer, aqm or loss) and how long it
+spent queued. The up and down pipes are recorded as two interfaces, both
+carrying raw IP packets: nfqueue captures the packets themselves, and the
+UDP proxy makes up IP and UDP headers for the datagrams it relays.
+
+Records are handed to a Writer, which writes them from a thread of its own
+so the reactor never waits for the disk. Its queue is bounded: when the
+disk can't keep up, records are left out and counted rather than held.
+Packets are cut to snaplen bytes, and files can be rotated through a ring of
+a fixed number of files of a fixed size. If writing fails, the error is
+logged and the capture stops there, with later records counted as left out;
+the simulation itself carries on.
+"""
+import os
+import Queue
+import socket
+import struct
+import threading
+
+from twisted.python import log
+
+
+# Set by start, and used by pipes and adapters to check whether to capture.
+writer = None
+
+INTERFACES = ['up', 'down']
+LINKTYPE_RAW = 101  # IPv4 or IPv6 packets, with no link layer header.
+SNAPLEN = 65535
+QUEUE_SIZE = 10000  # Records waiting to be written.
+STOP_TIMEOUT = 5.0  # Seconds stop waits for the queued records.
+
+SECTION_HEADER = 0x0A0D0D0A
+INTERFACE_DESCRIPTION = 1
+ENHANCED_PACKET = 6
+OPTION_END = 0
+OPTION_COMMENT = 1
+OPTION_NAME = 2  # if_name, in an interface description block.
+OPTION_TIMESTAMP_RESOLUTION = 9  # if_tsresol
+OPTION_FLAGS = 2  # epb_flags, in an enhanced packet block.
+INBOUND = 1  # epb_flags direction: up packets come in from clients.
+OUTBOUND = 2
+
+
+def _option(code, value):
+  padding = '\0' * (-len(value) % 4)
+  return struct.pack('=HH', code, len(value)) + value + padding
+
+
+def _block(block_type, body):
+  length = 12 + len(body)
+  return struct.pack('=II', block_type, length) + body + struct.pack(
+      '=I', length)
+
+
+def header(snaplen):
+  """Returns the blocks that start each file: a section header, and an
+  interface description for each pipe.
+  """
+  blocks = [_block(SECTION_HEADER, struct.pack('=IHHq', 0x1A2B3C4D, 1, 0, -1))]
+  for name in INTERFACES:
+    options = (_option(OPTION_NAME, name) +
+               _option(OPTION_TIMESTAMP_RESOLUTION, '\x06') +
+               _option(OPTION_END, ''))
+    blocks.append(_block(INTERFACE_DESCRIPTION,
+                         struct.pack('=HHI', LINKTYPE_RAW, 0, snaplen) +
+                         options))
+  return ''.join(blocks)
+
+
+def packet_block(time, pipe_name, verdict, queueing_delay, size, payload):
+  """Returns an enhanced packet block for one record."""
+  interface = INTERFACES.index(pipe_name)
+  microseconds = int(round(time * 1e6))
+  comment = 'verdict={} queueing_delay={:.6f}'.format(verdict, queueing_delay)
+  flags = struct.pack('=I', INBOUND if interface == 0 else OUTBOUND)
+  body = struct.pack('=IIIII', interface, microseconds >> 32,
+                     microseconds & 0xffffffff, len(payload), size)
+  body += payload + '\0' * (-len(payload) % 4)
+  body += (_option(OPTION_COMMENT, comment) + _option(OPTION_FLAGS, flags) +
+           _option(OPTION_END, ''))
+  return _block(ENHANCED_PACKET, body)
+
+
+def udp_packet(source, destination, data):
+  """Returns data with made up IP and UDP headers, for addresses given as
+  (host, port) pairs.
+  """
+  udp = struct.pack('!HHHH', source[1], destination[1], 8 + len(data), 0)
+  if ':' in source[0]:
+    ip = struct.pack('!IHBB', 6 << 28, 8 + len(data), 17, 64)
+    ip += (socket.inet_pton(socket.AF_INET6, source[0]) +
+           socket.inet_pton(socket.AF_INET6, destination[0]))
+  else:
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28 + len(data), 0, 0, 64, 17,
+                     0, socket.inet_aton(source[0]),
+                     socket.inet_aton(destination[0]))
+  return ip + udp + data
+
+
+class Writer(object):
+  """Writes records to pcapng files from a background thread.
+
+  Without a file_size, everything goes to path. With one, in bytes, records
+  go to path.0, path.1 and so on, moving to the next file once one reaches
+  file_size, and starting over at path.0 after files files.
+  """
+
+  def __init__(self, path, snaplen=SNAPLEN, file_size=None, files=1,
+               queue_size=QUEUE_SIZE):
+    self.path = path
+    self.snaplen = snaplen
+    self.file_size = file_size
+    self.files = max(1, files)
+    self.index = 0
+    self.file = None
+    self.written = 0  # Bytes in the current file.
+    self.dropped = 0  # Records left out because the queue was full.
+    self.error = None  # Set by the thread if writing fails.
+    self.queue = Queue.Queue(queue_size)
+    self.thread = threading.Thread(target=self._run, name='capture')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def add(self, time, pipe_name, verdict, queueing_delay, size, payload):
+    """Queues a record. Called from the reactor thread.
+
+    Args:
+      time: seconds since the epoch at which the verdict was reached
+      pipe_name: 'up' or 'down'
+      verdict: 'delivered', or the reason the packet was dropped
+      queueing_delay: seconds the packet spent in the buffer
+      size: bytes in the whole packet
+      payload: the start of the packet, from its IP header, or None
+    """
+    if payload is None:
+      return
+    if self.error is not None:
+      self.dropped += 1
+      return
+    try:
+      self.queue.put_nowait((time, pipe_name, verdict, queueing_delay, size,
+                             payload[:self.snaplen]))
+    except Queue.Full:
+      self.dropped += 1
+
+  def stop(self, timeout=STOP_TIMEOUT):
+    """Writes the records queued so far, and closes the file.
+
+    Waits at most about timeout seconds for the thread, so a stuck disk
+    can't hold up shutdown; the thread is a daemon, and goes with the process.
+    """
+    try:
+      self.queue.put(None, timeout=timeout)
+    except Queue.Full:
+      return
+    self.thread.join(timeout)
+
+  def _path(self):
+    if self.file_size:
+      return '{}.{}'.format(self.path, self.index)
+    return self.path
+
+  def _open(self):
+    self.file = open(self._path(), 'wb')
+    self.file.write(header(self.snaplen))
+    self.written = 0
+
+  def _write(self, record):
+    if self.file is None:
+      self._open()
+    elif self.file_size and self.written >= self.file_size:
+      self.file.close()
+      self.index = (self.index + 1) % self.files
+      self._open()
+    block = packet_block(*record)
+    self.file.write(block)
+    self.written += len(block)
+
+  def _run(self):
+    stopping = False
+    while not stopping:
+      records = [self.queue.get()]
+      try:
+        while len(records) < 1000:
+          records.append(self.queue.get_nowait())
+      except Queue.Empty:
+        pass
+      if None in records:
+        stopping = True
+        records = records[:records.index(None)]
+
+      # After a failure, keep taking records off the queue so neither add
+      # nor stop ever waits on it, but write nothing more.
+      if self.error is not None:
+        continue
+      try:
+        for record in records:
+          self._write(record)
+        if self.file is not None:
+          self.file.flush()
+      except (IOError, OSError) as e:
+        self.error = e
+        log.err(e, 'Capture to {} failed'.format(self._path()))
+
+    if self.file is not None:
+      try:
+        self.file.close()
+      except (IOError, OSError):
+        pass
+
+def start(path, snaplen=SNAPLEN, file_size=None, files=1):
+  """Starts capturing the packets of every pipe, until stop is called."""
+  global writer
+  directory = os.path.dirname(os.path.abspath(path))
+  if not os.path.isdir(directory):
+    raise ValueError('Capture directory does not exist.', directory)
+  writer = Writer(path, snaplen, file_size, files)
+  return writer
+
+
+def stop():
+  global writer
+  if writer is not None:
+    writer.stop()
+    writer = None
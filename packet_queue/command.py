@@ -15,8 +15,15 @@
 import argparse
 import netifaces
 import sys
+from twisted.internet import reactor
+from . import capture
+from . import flows
+from . import impairments
 from . import monitoring
+from . import shared
 from . import simulation
+from . import tcp_proxy
+from . import traces
 from . import udp_proxy
 
 
@@ -47,28 +54,184 @@ def configure(rest_server=False):
   parser.add_argument(
       '-p', '--port', type=int, required=True,
       help='flaky inbound/outbound traffic occurs on specified port')
+  parser.add_argument(
+      '--nfqueue_batch_verdicts', action='store_true',
+      help=('if -lkernel is specified, send the verdicts that come due in '
+            'the same reactor tick together'))
+  parser.add_argument(
+      '--nfqueue_drain', type=int, default=1,
+      help=('if -lkernel is specified, max number of netlink messages to '
+            'read each time the queue socket becomes readable'))
+  parser.add_argument(
+      '--nfqueue_rcvbuf', type=int,
+      help=('if -lkernel is specified, receive buffer size in bytes for the '
+            'queue socket'))
+  parser.add_argument(
+      '--nfqueue_copy_headers', action='store_true',
+      help=('if -lkernel is specified, copy only packet headers to user '
+            'space instead of whole packets'))
+  parser.add_argument(
+      '--batch_io', action='store_true',
+      help=('if -luser is specified, read and write many datagrams per '
+            'system call'))
+  parser.add_argument(
+      '--max_flows', type=int, default=udp_proxy.MAX_FLOWS,
+      help=('max number of client addresses to proxy at once if -luser is '
+            'specified, and of flows if --per_flow is; the least recently '
+            'used is removed to make room'))
+  parser.add_argument(
+      '--flow_timeout', type=float, default=udp_proxy.FLOW_TIMEOUT,
+      help=('seconds without packets after which a client address stops '
+            'being proxied if -luser is specified, and a flow is removed if '
+            '--per_flow is'))
+  parser.add_argument(
+      '--per_flow', action='store_true',
+      help=('give every flow (5-tuple, or client address if -luser is '
+            'specified) pipes of its own, instead of sharing one pair'))
+  parser.add_argument(
+      '--aggregate_bandwidth', type=int, default=-1,
+      help=('if --per_flow is specified, bytes per second shared by all '
+            'flows in each direction'))
+  parser.add_argument(
+      '--uplink_trace', type=str,
+      help=('Mahimahi packet delivery trace to replay in place of the '
+            'bandwidth of the up pipe'))
+  parser.add_argument(
+      '--downlink_trace', type=str,
+      help=('Mahimahi packet delivery trace to replay in place of the '
+            'bandwidth of the down pipe'))
+  parser.add_argument(
+      '--params_trace', type=str,
+      help=('CSV file of params to set over time: a "time" column in '
+            'seconds, then a column for each param'))
+  parser.add_argument(
+      '--loop_params_trace', action='store_true',
+      help='start the params trace over once it ends')
+  parser.add_argument(
+      '--capture', type=str,
+      help=('pcapng file to record every packet to, with its verdict and '
+            'queueing delay'))
+  parser.add_argument(
+      '--capture_snaplen', type=int, default=capture.SNAPLEN,
+      help='max bytes of each packet to record')
+  parser.add_argument(
+      '--capture_file_size', type=float,
+      help=('if --capture is specified, millions of bytes per file before '
+            'moving to the next of --capture_files files'))
+  parser.add_argument(
+      '--capture_files', type=int, default=10,
+      help=('if --capture_file_size is specified, number of files to rotate '
+            'through'))
+  parser.add_argument(
+      '--seed', type=int,
+      help=('seed for the random numbers behind loss, jitter, reordering '
+            'and duplication, to make runs reproducible'))
+  parser.add_argument(
+      '--jitter_table', type=str,
+      help=('file of samples, one per line, to draw the jitter from when '
+            'the jitter_distribution param is 2 (empirical)'))
+  parser.add_argument(
+      '-w', '--workers', type=int, default=1,
+      help=('number of worker processes to spread packets across; if -luser '
+            'is specified, each binds the proxy port with SO_REUSEPORT'))
 
   if rest_server:
     parser.add_argument(
         '-a', '--rest_api_port', type=int, default=9000,
         help='port which REST API server will listen on')
 
-  params = simulation.Pipe.PARAMS
-  event_log = monitoring.EventLog()
-  pipes = simulation.PipePair(params, event_log)
-
   args = parser.parse_args()
 
+  if args.workers < 1:
+    print '--workers must be at least 1'
+    sys.exit(1)
+  if args.nfqueue_drain < 1:
+    print '--nfqueue_drain must be at least 1'
+    sys.exit(1)
   if args.level == 'kernel':
     import nfqueue # Makes imports that only work on Linux.
-    nfqueue.configure(args.transport, args.port, pipes, args.interface)
-  else:
-    if args.transport == 'tcp':
-      print 'Can\'t proxy TCP packets at the user level :('
+    if args.workers > nfqueue.MAX_WORKERS:
+      print '--workers can be at most {} with -lkernel'.format(
+          nfqueue.MAX_WORKERS)
       sys.exit(1)
+
+  # With workers, this process only serves the API: the pipes it exposes sum
+  # up the counters the workers publish to the shared block.
+  if args.per_flow and args.workers > 1:
+    print '--per_flow can\'t be used with --workers'
+    sys.exit(1)
+  if ((args.uplink_trace or args.downlink_trace) and
+      (args.per_flow or args.workers > 1)):
+    print ('--uplink_trace and --downlink_trace can\'t be used with '
+           '--per_flow or --workers')
+    sys.exit(1)
+  if args.capture and args.workers > 1:
+    print '--capture can\'t be used with --workers'
+    sys.exit(1)
+  if args.capture and args.level == 'user' and args.transport == 'tcp':
+    print '--capture needs -lkernel or -tudp'
+    sys.exit(1)
+
+  if args.seed is not None:
+    impairments.seed(args.seed)
+  if args.jitter_table:
+    impairments.POOL.table = impairments.load_table(args.jitter_table)
+  if args.capture:
+    file_size = None
+    if args.capture_file_size:
+      file_size = int(args.capture_file_size * 1000000)
+    capture.start(args.capture, args.capture_snaplen, file_size,
+                  args.capture_files)
+    reactor.addSystemEventTrigger('before', 'shutdown', capture.stop)
+
+  block = None
+  event_log = monitoring.EventLog()
+  if args.per_flow:
+    params = simulation.Params(simulation.Pipe.PARAMS)
+    pipes = flows.FlowTable(params, event_log,
+                            max_flows=args.max_flows,
+                            flow_timeout=args.flow_timeout,
+                            aggregate_bandwidth=args.aggregate_bandwidth)
+  elif args.workers > 1:
+    block = shared.SharedBlock.create(simulation.Pipe.PARAMS, args.workers)
+    params = block.params
+    pipes = shared.AggregatePipePair(block, event_log)
+  else:
+    params = simulation.Params(simulation.Pipe.PARAMS)
+    pipes = simulation.PipePair(params, event_log)
+
+  traces.configure(pipes, params,
+                   uplink=args.uplink_trace,
+                   downlink=args.downlink_trace,
+                   params_trace=args.params_trace,
+                   loop=args.loop_params_trace)
+
+  if args.level == 'kernel':
+    if args.nfqueue_copy_headers:
+      copy_range = nfqueue.libnetfilter_queue.HEADERS_SIZE
+    else:
+      copy_range = nfqueue.libnetfilter_queue.BUFFER_SIZE
+    nfqueue.configure(args.transport, args.port, pipes, args.interface,
+                      batch_verdicts=args.nfqueue_batch_verdicts,
+                      drain_limit=args.nfqueue_drain,
+                      rcvbuf=args.nfqueue_rcvbuf,
+                      copy_range=copy_range,
+                      workers=args.workers,
+                      block=block)
+  else:
     if not args.proxy_port:
       print '--proxy_port is required'
       sys.exit(1)
-    udp_proxy.configure(args.port, args.proxy_port, pipes)
+    if args.transport == 'tcp':
+      tcp_proxy.configure(args.port, args.proxy_port, pipes,
+                          workers=args.workers,
+                          block=block)
+    else:
+      udp_proxy.configure(args.port, args.proxy_port, pipes,
+                          batch_io=args.batch_io,
+                          max_flows=args.max_flows,
+                          flow_timeout=args.flow_timeout,
+                          workers=args.workers,
+                          block=block)
 
   return params, pipes, args
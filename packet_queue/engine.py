@@ -0,0 +1,62 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Selects the event loop that drives the Twisted reactor.
+
+The "twisted" engine is Twisted's default reactor. The "asyncio" engine runs
+the same reactor API on an asyncio event loop, using uvloop when it is
+installed, so pipes, proxies and the API server would work unchanged.
+
+The asyncio engine needs Python 3 and Twisted 18.7 or later, and Packet Queue
+still runs on Python 2, so the scripts don't offer it yet: install raises
+RuntimeError for it. Once the package is ported, a script can call install
+before anything imports twisted.internet.reactor.
+"""
+
+
+ENGINES = ['twisted', 'asyncio']
+
+
+def install(engine):
+  """Installs the reactor for an engine.
+
+  Raises:
+    RuntimeError if the engine isn't supported by this Python or Twisted
+  """
+  if engine == 'twisted':
+    return
+
+  try:
+    import asyncio
+    from twisted.internet import asyncioreactor
+  except ImportError:
+    raise RuntimeError('The asyncio engine requires Python 3 and Twisted 18.7 '
+                       'or later.')
+
+  try:
+    import uvloop
+  except ImportError:
+    loop = asyncio.new_event_loop()
+  else:
+    loop = uvloop.new_event_loop()
+  asyncio.set_event_loop(loop)
+  asyncioreactor.install(loop)
+
+
+def installed():
+  """Returns the name of the engine driving the installed reactor."""
+  from twisted.internet import reactor
+  if type(reactor).__name__ == 'AsyncioSelectorReactor':
+    return 'asyncio'
+  return 'twisted'
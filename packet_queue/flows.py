@@ -0,0 +1,261 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Flow classification, and a pair of pipes for every flow.
+
+A flow is identified by any hashable key passed to Pipe.attempt: nfqueue
+passes the 5-tuple from the packet's headers, and the proxies pass the
+client's address or connection. A FlowTable stands in for a PipePair, and
+sends each flow's packets through a PipePair of its own, all with the same
+params. Optionally, the flows share an aggregate bandwidth too.
+"""
+import collections
+import struct
+
+from twisted.internet import reactor
+
+from . import monitoring
+from . import simulation
+
+
+def classify(payload, reverse=False):
+  """Returns the 5-tuple of the IP packet at the start of a payload.
+
+  The tuple is (protocol, source address, source port, destination address,
+  destination port), with addresses as packed bytes and ports as zero for
+  protocols other than TCP and UDP. With reverse, the source and destination
+  are swapped, so the packets of both directions of a connection get the
+  same key. Returns None if the payload isn't IPv4 or IPv6.
+
+  IPv6 extension headers aren't followed, so their ports read as zero.
+  """
+  if len(payload) >= 20 and ord(payload[0]) >> 4 == 4:
+    protocol = ord(payload[9])
+    source = payload[12:16]
+    destination = payload[16:20]
+    ports_offset = (ord(payload[0]) & 0xf) * 4
+  elif len(payload) >= 40 and ord(payload[0]) >> 4 == 6:
+    protocol = ord(payload[6])
+    source = payload[8:24]
+    destination = payload[24:40]
+    ports_offset = 40
+  else:
+    return None
+
+  source_port = destination_port = 0
+  if protocol in (6, 17) and len(payload) >= ports_offset + 4:
+    source_port, destination_port = struct.unpack_from(
+        '!HH', payload, ports_offset)
+
+  if reverse:
+    return (protocol, destination, destination_port, source, source_port)
+  return (protocol, source, source_port, destination, destination_port)
+
+
+class FlowPipe(simulation.Pipe):
+  """A Pipe for one flow, which counts its buffer toward the flows' total.
+
+  With an aggregate bandwidth, gets a share of it in proportion to how much
+  of the total it has buffered, on top of the bandwidth param. As the share
+  changes with the other flows' buffers, a waiting packet's release time is
+  then rechecked every AGGREGATE_CHECK_INTERVAL seconds.
+  """
+
+  AGGREGATE_CHECK_INTERVAL = 0.01
+
+  def __init__(self, name, params, totals):
+    self.totals = totals
+    self._size = 0
+    simulation.Pipe.__init__(self, name, params, totals, totals.table.clock)
+
+  @property
+  def size(self):
+    return self._size
+
+  @size.setter
+  def size(self, value):
+    self.totals.size += value - self._size
+    self._size = value
+
+  @property
+  def RATE_CHECK_INTERVAL(self):
+    if self.totals.table.aggregate_bandwidth > 0:
+      return self.AGGREGATE_CHECK_INTERVAL
+    return None
+
+  def rate(self):
+    bandwidth = self.cached.bandwidth
+    aggregate = self.totals.table.aggregate_bandwidth
+    if aggregate <= 0 or not self.totals.size:
+      return bandwidth
+    share = float(aggregate) * self._size / self.totals.size
+    if bandwidth > 0:
+      return min(bandwidth, share)
+    return share
+
+  def busy(self):
+    """Returns whether any packets are still in the pipe."""
+    return self._size > 0 or bool(self.deliveries)
+
+
+class FlowPipePair(object):
+  """The pipes of one flow."""
+
+  def __init__(self, table):
+    self.up = FlowPipe('up', table.params, table.up)
+    self.down = FlowPipe('down', table.params, table.down)
+    self.last_active = None
+
+
+class FlowTotals(object):
+  """Stands in for one direction's Pipe, on behalf of all flows.
+
+  Hands each packet to the pipe of its flow, and adds up the counters, buffer
+  sizes and latency histograms of all of the flows' pipes, including flows
+  that have been removed from the table. Also serves as the event log of the
+  flows' pipes, reporting the total buffer size rather than each flow's.
+  """
+
+  def __init__(self, name, table):
+    self.name = name
+    self.table = table
+    self.params = table.params
+    self.size = 0
+    self.retired = []  # Pipes of removed flows, until they're empty.
+    self.closed = {counter: 0 for counter in simulation.Pipe.COUNTERS}
+    self.closed_latency = monitoring.Histogram(
+        monitoring.METRICS_LATENCY_BOUNDS)
+
+  def attempt(self, deliver_callback, drop_callback, size, flow=None,
+              payload=None):
+    pipe = getattr(self.table.get(flow), self.name)
+    pipe.attempt(deliver_callback, drop_callback, size, flow, payload)
+
+  def add(self, time, pipe_name, event_type, value):
+    """Invoked by the flows' pipes, as their event log."""
+    if event_type == 'buffer':
+      value = self.size
+    self.table.event_log.add(time, pipe_name, event_type, value)
+
+  def retire(self, pipe):
+    """Takes over the counters of a pipe whose flow has been removed."""
+    self.retired.append(pipe)
+    self._fold()
+
+  def _fold(self):
+    """Adds the counters of retired pipes that are empty to the totals."""
+    retired = []
+    for pipe in self.retired:
+      if pipe.busy():
+        retired.append(pipe)
+      else:
+        for counter, value in pipe.meter().items():
+          self.closed[counter] += value
+        self.closed_latency.merge(pipe.latency)
+    self.retired = retired
+
+  def _pipes(self):
+    """Returns every pipe with counters that haven't been folded yet."""
+    self._fold()
+    pipes = [getattr(pair, self.name) for pair in self.table.flows.values()]
+    return pipes + self.retired
+
+  def reset_meter(self):
+    for pipe in self._pipes():
+      pipe.reset_meter()
+    self.closed = {counter: 0 for counter in simulation.Pipe.COUNTERS}
+    self.closed_latency.reset()
+
+  def meter(self):
+    pipes = self._pipes()
+    totals = dict(self.closed)
+    for pipe in pipes:
+      for counter, value in pipe.meter().items():
+        totals[counter] += value
+    return totals
+
+  @property
+  def latency(self):
+    pipes = self._pipes()
+    histogram = monitoring.Histogram(monitoring.METRICS_LATENCY_BOUNDS)
+    histogram.merge(self.closed_latency)
+    for pipe in pipes:
+      histogram.merge(pipe.latency)
+    return histogram
+
+
+class FlowTable(object):
+  """Stands in for a PipePair, giving each flow a pair of pipes of its own.
+
+  Flows are kept in least recently used order. A flow is removed when none
+  of its packets have been attempted for flow_timeout seconds, or when a new
+  flow would exceed max_flows; None means no limit. Packets already in a
+  removed flow's pipes are still delivered.
+
+  With an aggregate_bandwidth above zero, in bytes per second, the flows
+  share that much bandwidth in each direction, as well as each being limited
+  by the bandwidth param.
+
+  The clock is passed on to the flows' pipes, as for a PipePair.
+  """
+
+  def __init__(self, params, event_log, max_flows=None, flow_timeout=None,
+               aggregate_bandwidth=-1, clock=None):
+    self.params = params
+    self.event_log = event_log
+    self.clock = reactor if clock is None else clock
+    self.max_flows = max_flows
+    self.flow_timeout = flow_timeout
+    self.aggregate_bandwidth = aggregate_bandwidth
+    self.flows = collections.OrderedDict()
+    self.expiry_scheduled = False
+    self.up = FlowTotals('up', self)
+    self.down = FlowTotals('down', self)
+
+  def get(self, flow):
+    """Returns the FlowPipePair for a flow, adding one if needed."""
+    pair = self.flows.pop(flow, None)
+    if pair is None:
+      if self.max_flows and len(self.flows) >= self.max_flows:
+        _, oldest = self.flows.popitem(last=False)
+        self._retire(oldest)
+      pair = FlowPipePair(self)
+      if self.flow_timeout and not self.expiry_scheduled:
+        self.expiry_scheduled = True
+        self.clock.callLater(self.flow_timeout, self._expire_idle)
+
+    pair.last_active = self.clock.seconds()
+    self.flows[flow] = pair
+    return pair
+
+  def _retire(self, pair):
+    self.up.retire(pair.up)
+    self.down.retire(pair.down)
+
+  def _expire_idle(self):
+    """Removes idle flows, oldest first, and checks again later."""
+    self.expiry_scheduled = False
+    deadline = self.clock.seconds() - self.flow_timeout
+    while self.flows:
+      flow, pair = next(self.flows.iteritems())
+      if pair.last_active > deadline:
+        break
+      del self.flows[flow]
+      self._retire(pair)
+
+    if self.flows:
+      self.expiry_scheduled = True
+      oldest = next(self.flows.itervalues())
+      delay = oldest.last_active + self.flow_timeout - self.clock.seconds()
+      self.clock.callLater(max(0, delay), self._expire_idle)
@@ -0,0 +1,206 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Random impairments applied to each packet, after netem.
+
+A Pipe asks its Impairments whether to lose each packet it's offered, what
+delay to give it, and whether to reorder or duplicate it, all following the
+pipe's params:
+
+  - Loss is independent, with the loss param, unless gilbert_p is above zero,
+    in which case it follows a Gilbert-Elliott model: a good and a bad state,
+    each with its own loss probability, and a chance per packet of moving
+    from good to bad (gilbert_p) and back (gilbert_r).
+  - Jitter is added to the delay, drawn from one of DISTRIBUTIONS scaled so
+    jitter is its standard deviation. Packets still leave in order.
+  - A reordered packet skips the delay, overtaking the packets delayed ahead
+    of it, and a duplicated packet is delivered twice.
+
+Random numbers come from a RandomPool, which generates them in batches, with
+NumPy if it is installed, and hands them out one at a time. Nothing random
+is drawn for impairments that are turned off.
+"""
+import random
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Distributions of the jitter, indexed by the jitter_distribution param. An
+# empirical distribution is only available once a table has been loaded,
+# and falls back to normal until then.
+DISTRIBUTIONS = ['normal', 'pareto', 'empirical']
+
+BATCH_SIZE = 4096
+
+# Pareto variates have a shape of 3, and are moved and scaled to a mean of
+# zero and a standard deviation of one, leaving a long tail of late packets.
+PARETO_SHAPE = 3.0
+PARETO_MEAN = PARETO_SHAPE / (PARETO_SHAPE - 1)
+PARETO_DEVIATION = (PARETO_SHAPE / (PARETO_SHAPE - 2) - PARETO_MEAN ** 2) ** 0.5
+
+
+def load_table(path):
+  """Returns the samples in a file, one per line, for an empirical
+  distribution, normalized to a mean of zero and a standard deviation of one.
+  """
+  with open(path) as f:
+    samples = [float(line) for line in f if line.strip()]
+  if len(samples) < 2:
+    raise ValueError('Distribution table needs at least two samples.', path)
+  mean = sum(samples) / len(samples)
+  deviation = (sum((x - mean) ** 2 for x in samples) / len(samples)) ** 0.5
+  if not deviation:
+    raise ValueError('Distribution table samples are all the same.', path)
+  return [(x - mean) / deviation for x in samples]
+
+
+class RandomPool(object):
+  """Random variates generated BATCH_SIZE at a time.
+
+  With a seed, the same variates come out in the same order every run.
+  """
+
+  def __init__(self, seed=None, table=None):
+    self.table = table
+    self.seed(seed)
+
+  def seed(self, seed=None):
+    """Starts over with a new generator, discarding pooled variates."""
+    if numpy is not None:
+      self.generator = numpy.random.RandomState(seed)
+    else:
+      self.generator = random.Random(seed)
+    self.uniforms = []
+    self.variates = [[] for _ in DISTRIBUTIONS]
+
+  def uniform(self):
+    """Returns a number from zero up to one."""
+    if not self.uniforms:
+      self.uniforms = self._generate('uniform')
+    return self.uniforms.pop()
+
+  def variate(self, distribution):
+    """Returns a variate with a mean of zero and a standard deviation of one.
+
+    Args:
+      distribution: an index into DISTRIBUTIONS
+
+    Raises:
+      ValueError if the distribution is out of range
+    """
+    if not 0 <= distribution < len(DISTRIBUTIONS):
+      raise ValueError('Unknown jitter distribution.', distribution)
+    variates = self.variates[distribution]
+    if not variates:
+      variates = self.variates[distribution] = self._generate(
+          DISTRIBUTIONS[distribution])
+    return variates.pop()
+
+  def _generate(self, name):
+    if name == 'empirical' and not self.table:
+      name = 'normal'
+
+    if numpy is not None:
+      generator = self.generator
+      if name == 'uniform':
+        batch = generator.random_sample(BATCH_SIZE)
+      elif name == 'normal':
+        batch = generator.standard_normal(BATCH_SIZE)
+      elif name == 'pareto':
+        batch = ((1 - generator.random_sample(BATCH_SIZE)) **
+                 (-1 / PARETO_SHAPE) - PARETO_MEAN) / PARETO_DEVIATION
+      else:
+        batch = numpy.take(self.table,
+                           generator.randint(len(self.table), size=BATCH_SIZE))
+      return batch.tolist()
+
+    uniform = self.generator.random
+    if name == 'uniform':
+      return [uniform() for _ in xrange(BATCH_SIZE)]
+    elif name == 'normal':
+      gauss = self.generator.gauss
+      return [gauss(0, 1) for _ in xrange(BATCH_SIZE)]
+    elif name == 'pareto':
+      return [((1 - uniform()) ** (-1 / PARETO_SHAPE) - PARETO_MEAN) /
+              PARETO_DEVIATION for _ in xrange(BATCH_SIZE)]
+    table = self.table
+    return [table[int(uniform() * len(table))] for _ in xrange(BATCH_SIZE)]
+
+
+# Shared by every pipe, so one seed makes a whole run reproducible.
+POOL = RandomPool()
+
+# The seed given to seed(), passed on to worker processes.
+SEED = None
+
+
+def seed(value):
+  """Seeds the shared pool, and the random module used by queue disciplines.
+  """
+  global SEED
+  SEED = value
+  POOL.seed(value)
+  random.seed(value)
+
+
+class Impairments(object):
+  """Decides what happens to each packet of one pipe.
+
+  The params are read as attributes, of a simulation.CachedParams.
+  """
+
+  def __init__(self, params, pool=POOL):
+    self.params = params
+    self.pool = pool
+    self.bad = False  # Gilbert-Elliott state.
+
+  def lost(self):
+    """Returns whether the next packet is lost."""
+    params = self.params
+    if params.gilbert_p > 0:
+      # As in netem, the state a packet arrives in decides its loss.
+      uniform = self.pool.uniform
+      if self.bad:
+        loss = params.gilbert_loss_bad
+        if uniform() < params.gilbert_r:
+          self.bad = False
+      else:
+        loss = params.gilbert_loss_good
+        if uniform() < params.gilbert_p:
+          self.bad = True
+    else:
+      loss = params.loss
+    return loss > 0 and self.pool.uniform() < loss
+
+  def delay(self):
+    """Returns the delay of the next packet, in seconds."""
+    params = self.params
+    delay = params.delay
+    if params.jitter <= 0:
+      return delay
+    variate = self.pool.variate(params.jitter_distribution)
+    return max(0.0, delay + params.jitter * variate)
+
+  def reordered(self):
+    """Returns whether the next packet skips the delay."""
+    reorder = self.params.reorder
+    return reorder > 0 and self.pool.uniform() < reorder
+
+  def duplicated(self):
+    """Returns whether the next packet is delivered twice."""
+    duplicate = self.params.duplicate
+    return duplicate > 0 and self.pool.uniform() < duplicate
@@ -35,6 +35,14 @@ BANNER = '\n'.join([
   '',
 ])
 
+METER_COUNTERS = [
+  ('attempted', 'attempted'),
+  ('delivered', 'delivered'),
+  ('dropped (buffer full)', 'dropped_buffer'),
+  ('dropped (queue management)', 'dropped_aqm'),
+  ('dropped (loss)', 'dropped_loss'),
+]
+
 
 class ParamsProxy(object):
   def __init__(self, params):
@@ -63,15 +71,18 @@ class MeterProxy(object):
     self.pipes.up.reset_meter()
     self.pipes.down.reset_meter()
 
+  def _atomic_read(self):
+    return self.pipes.up.meter(), self.pipes.down.meter()
+
   def __repr__(self):
-    return '\n'.join([
-      'up:',
-      '  attempted: {}'.format(self.pipes.up.bytes_attempted),
-      '  delivered: {}'.format(self.pipes.up.bytes_delivered),
-      'down:',
-      '  attempted: {}'.format(self.pipes.down.bytes_attempted),
-      '  delivered: {}'.format(self.pipes.down.bytes_delivered),
-    ])
+    up, down = threads.blockingCallFromThread(reactor, self._atomic_read)
+    lines = []
+    for name, meter in [('up', up), ('down', down)]:
+      lines.append('{}:'.format(name))
+      for label, counter in METER_COUNTERS:
+        lines.append('  {}: {} bytes, {} packets'.format(
+            label, meter['bytes_' + counter], meter['packets_' + counter]))
+    return '\n'.join(lines)
 
 
 def main():
@@ -15,13 +15,20 @@
 """ctypes adapter for libnetfilter_queue on Linux."""
 import collections
 import ctypes
+import errno
 import socket
+import struct
 
 
 BUFFER_SIZE = 0xffff  # Largest possible IP packet.
+HEADERS_SIZE = 128  # Enough for IP options plus TCP or UDP headers.
 NF_DROP = 0
 NF_ACCEPT = 1
 NFQNL_COPY_PACKET = 2
+SO_RCVBUFFORCE = 33  # Like SO_RCVBUF, but root may exceed rmem_max.
+ID_MODULUS = 2 ** 32  # Packet ids are 32 bits, and wrap around.
+# payload holds as many bytes as the queue's copy range allows, but size is
+# always the length of the whole packet.
 Packet = collections.namedtuple('Packet', ['id', 'size', 'payload', 'qh'])
 nfq = ctypes.cdll.LoadLibrary('libnetfilter_queue.so')
 
@@ -32,6 +39,14 @@ class msg_packet_header(ctypes.Structure):
   _fields_ = [('packet_id', ctypes.c_uint32)]
 
 nfq.nfq_get_msg_packet_hdr.restype = ctypes.POINTER(msg_packet_header)
+nfq.nfq_set_verdict.argtypes = [ctypes.c_void_p,
+                                ctypes.c_uint32,
+                                ctypes.c_uint32,
+                                ctypes.c_uint32,
+                                ctypes.c_char_p]
+nfq.nfq_set_verdict_batch.argtypes = [ctypes.c_void_p,
+                                      ctypes.c_uint32,
+                                      ctypes.c_uint32]
 
 nfq_callback_type = ctypes.CFUNCTYPE(ctypes.c_int,
                                      ctypes.c_void_p,
@@ -47,6 +62,8 @@ def nfq_callback(qh, unused_nfmsg, nfad, unused_data):
   payload_pointer = ctypes.c_void_p()
   size = nfq.nfq_get_payload(nfad, ctypes.byref(payload_pointer))
   payload = ctypes.string_at(payload_pointer, size)
+  if size >= copy_ranges[qh]:
+    size = packet_length(payload, size)
 
   packet = Packet(packet_id, size, payload, qh)
   py_callbacks[qh](packet)
@@ -55,14 +72,64 @@ def nfq_callback(qh, unused_nfmsg, nfad, unused_data):
 # Maps queue handles to user-specified callbacks.
 py_callbacks = {}
 
+# Maps queue handles to the max number of payload bytes copied per packet.
+copy_ranges = {}
+
+
+def packet_length(payload, default):
+  """Reads the total length of an IP packet from its header.
+
+  Returns default if the header is too short or not IPv4 or IPv6.
+  """
+  if len(payload) >= 20 and ord(payload[0]) >> 4 == 4:
+    return struct.unpack_from('!H', payload, 2)[0]
+  if len(payload) >= 40 and ord(payload[0]) >> 4 == 6:
+    return 40 + struct.unpack_from('!H', payload, 4)[0]
+  return default
+
 
 class Manager(object):
-  """Manages multiple queues."""
+  """Manages multiple queues.
+
+  With batch_verdicts set, set_verdict only records verdicts, and
+  flush_verdicts sends them. Runs of consecutive packets with the same
+  verdict, counted from the oldest packet still waiting in the kernel, are
+  sent as one nfq_set_verdict_batch message; the rest are sent one by one.
+
+  Each call to process reads up to drain_limit messages from the netlink
+  socket, all into the same preallocated buffer. A larger socket receive
+  buffer can be requested with rcvbuf, in bytes.
 
-  def __init__(self):
+  Only the first copy_range bytes of each packet are copied to user space.
+  The simulation only needs packet sizes, which are read from the IP header,
+  so HEADERS_SIZE avoids copying payloads that nothing looks at.
+  """
+
+  def __init__(self, batch_verdicts=False, drain_limit=1, rcvbuf=None,
+               copy_range=BUFFER_SIZE):
     self.handle = nfq.nfq_open()
     self.fileno = nfq.nfq_fd(self.handle)
     self.socket = socket.fromfd(self.fileno, socket.AF_UNIX, socket.SOCK_RAW)
+    self.buffer = ctypes.create_string_buffer(BUFFER_SIZE)
+    self.drain_limit = drain_limit
+    self.copy_range = copy_range
+    self.overruns = 0  # Number of ENOBUFS errors: the kernel dropped packets.
+
+    if rcvbuf:
+      try:
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, rcvbuf)
+      except socket.error:
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+    self.batch_verdicts = batch_verdicts
+    # Maps queue handles to ids of packets with no verdict sent yet, in the
+    # order they arrived.
+    self.unverdicted = {}
+    # Maps queue handles to {packet id: verdict} waiting to be flushed.
+    self.pending_verdicts = {}
+    # Maps queue handles to ids that got a verdict while not at the head of
+    # their unverdicted queue.
+    self.verdicted = {}
 
     if nfq.nfq_unbind_pf(self.handle, socket.AF_INET) < 0:
       raise OSError('nfq_unbind_pf() failed. Are you root?')
@@ -71,13 +138,61 @@ class Manager(object):
       raise OSError('nfq_bind_pf() failed. Are you root?')
 
   def set_verdict(self, packet, verdict):
-    """Set the verdict on a Packet instance: NF_ACCEPT or NF_DROP."""
-    payload_buffer = ctypes.create_string_buffer(packet.payload)
-    nfq.nfq_set_verdict(packet.qh,
-                        packet.id,
-                        verdict,
-                        packet.size,
-                        payload_buffer)
+    """Set the verdict on a Packet instance: NF_ACCEPT or NF_DROP.
+
+    The packet is never mangled, so no payload is sent back to the kernel.
+    With batched verdicts, a verdict for a packet that has already been sent
+    one is ignored.
+    """
+    if self.batch_verdicts:
+      if self._awaiting_verdict(packet.qh, packet.id):
+        self.pending_verdicts[packet.qh][packet.id] = verdict
+    else:
+      nfq.nfq_set_verdict(packet.qh, packet.id, verdict, 0, None)
+
+  def _awaiting_verdict(self, qh, packet_id):
+    ids = self.unverdicted[qh]
+    if not ids or packet_id in self.verdicted[qh]:
+      return False
+    # Ids grow by arrival, modulo ID_MODULUS, and leave the queue from the
+    # front, so any id before its head has been flushed already.
+    return ((packet_id - ids[0]) % ID_MODULUS <=
+            (ids[-1] - ids[0]) % ID_MODULUS)
+
+  def flush_verdicts(self):
+    """Send all verdicts recorded since the last flush."""
+    for qh, pending in self.pending_verdicts.iteritems():
+      if not pending:
+        continue
+
+      ids = self.unverdicted[qh]
+      verdicted = self.verdicted[qh]
+      while ids:
+        packet_id = ids[0]
+        if packet_id in verdicted:
+          verdicted.remove(ids.popleft())
+          continue
+        if packet_id not in pending:
+          break
+
+        # A batch verdict applies to every queued packet with an id up to and
+        # including the last one, so stop at the first gap or wraparound.
+        verdict = pending.pop(ids.popleft())
+        last_id = packet_id
+        while ids and ids[0] > last_id:
+          if ids[0] in verdicted:
+            verdicted.remove(ids.popleft())
+          elif pending.get(ids[0]) == verdict:
+            last_id = ids.popleft()
+            del pending[last_id]
+          else:
+            break
+        nfq.nfq_set_verdict_batch(qh, last_id, verdict)
+
+      for packet_id, verdict in pending.iteritems():
+        nfq.nfq_set_verdict(qh, packet_id, verdict, 0, None)
+        verdicted.add(packet_id)
+      pending.clear()
 
   def bind(self, queue_num, callback):
     """Bind a queue number to a callback.
@@ -88,11 +203,36 @@ class Manager(object):
     if qh <= 0:
       raise OSError('nfq_create_queue() failed. Is packet queue already running?')
 
-    py_callbacks[qh] = callback
-    nfq.nfq_set_mode(qh, NFQNL_COPY_PACKET, BUFFER_SIZE)
+    if self.batch_verdicts:
+      unverdicted = collections.deque()
+      self.unverdicted[qh] = unverdicted
+      self.pending_verdicts[qh] = {}
+      self.verdicted[qh] = set()
+
+      def track(packet, callback=callback):
+        unverdicted.append(packet.id)
+        callback(packet)
+      py_callbacks[qh] = track
+    else:
+      py_callbacks[qh] = callback
+    copy_ranges[qh] = self.copy_range
+    nfq.nfq_set_mode(qh, NFQNL_COPY_PACKET, self.copy_range)
 
   def process(self):
-    """Without blocking, read available packets and invoke their callbacks."""
-    data = self.socket.recv(BUFFER_SIZE, socket.MSG_DONTWAIT)
-    buf = ctypes.create_string_buffer(data)
-    nfq.nfq_handle_packet(self.handle, buf, len(data))
+    """Without blocking, read available packets and invoke their callbacks.
+
+    Stops when the socket has no more data, or after drain_limit reads so
+    that other reactor work isn't starved.
+    """
+    for _ in xrange(self.drain_limit):
+      try:
+        size = self.socket.recv_into(self.buffer, BUFFER_SIZE,
+                                     socket.MSG_DONTWAIT)
+      except socket.error as e:
+        if e.errno == errno.ENOBUFS:
+          self.overruns += 1
+          continue
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        raise
+      nfq.nfq_handle_packet(self.handle, self.buffer, size)
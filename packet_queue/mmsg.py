@@ -0,0 +1,197 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""ctypes adapter for batched datagram I/O: recvmmsg and sendmmsg on Linux.
+
+Where those calls aren't available, falls back to one recvfrom or sendto
+call per datagram. Only IPv4 sockets are supported.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+
+
+BATCH_SIZE = 32  # Max datagrams per system call.
+MAX_DATAGRAM = 0xffff
+SOCKADDR_IN_SIZE = 16
+
+
+class iovec(ctypes.Structure):
+  _fields_ = [('iov_base', ctypes.c_void_p),
+              ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+  _fields_ = [('msg_name', ctypes.c_void_p),
+              ('msg_namelen', ctypes.c_uint32),
+              ('msg_iov', ctypes.POINTER(iovec)),
+              ('msg_iovlen', ctypes.c_size_t),
+              ('msg_control', ctypes.c_void_p),
+              ('msg_controllen', ctypes.c_size_t),
+              ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+  _fields_ = [('msg_hdr', msghdr),
+              ('msg_len', ctypes.c_uint)]
+
+try:
+  libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                            ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+  libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                            ctypes.c_uint, ctypes.c_int]
+  available = True
+except (OSError, AttributeError):
+  available = False
+
+
+def pack_address(address):
+  """Packs a (host, port) tuple into a struct sockaddr_in."""
+  host, port = address
+  return (struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) +
+          socket.inet_aton(host) + '\0' * 8)
+
+
+def unpack_address(sockaddr):
+  """Unpacks a struct sockaddr_in into a (host, port) tuple."""
+  port, = struct.unpack('!H', sockaddr[2:4])
+  return socket.inet_ntoa(sockaddr[4:8]), port
+
+
+def raise_errno():
+  code = ctypes.get_errno()
+  raise socket.error(code, os.strerror(code))
+
+
+class Receiver(object):
+  """Preallocated buffers and headers for receiving a batch of datagrams.
+
+  Datagrams are copied out before receive returns, so one Receiver can be
+  shared by any number of sockets.
+  """
+
+  def __init__(self, size=BATCH_SIZE):
+    self.size = size
+    self.buffers = ctypes.create_string_buffer(size * MAX_DATAGRAM)
+    self.names = ctypes.create_string_buffer(size * SOCKADDR_IN_SIZE)
+    self.iovecs = (iovec * size)()
+    self.headers = (mmsghdr * size)()
+
+    buffers = ctypes.addressof(self.buffers)
+    names = ctypes.addressof(self.names)
+    for i in range(size):
+      self.iovecs[i].iov_base = buffers + i * MAX_DATAGRAM
+      self.iovecs[i].iov_len = MAX_DATAGRAM
+      header = self.headers[i].msg_hdr
+      header.msg_name = names + i * SOCKADDR_IN_SIZE
+      header.msg_iov = ctypes.pointer(self.iovecs[i])
+      header.msg_iovlen = 1
+
+  def receive(self, sock):
+    """Without blocking, reads up to a batch of datagrams from a socket.
+
+    Returns a list of (data, address) tuples, empty if nothing is available.
+    """
+    if not available:
+      return self._receive_each(sock)
+
+    for i in range(self.size):
+      self.headers[i].msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+    count = libc.recvmmsg(sock.fileno(), self.headers, self.size,
+                          socket.MSG_DONTWAIT, None)
+    if count < 0:
+      if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return []
+      raise_errno()
+
+    buffers = ctypes.addressof(self.buffers)
+    datagrams = []
+    for i in range(count):
+      data = ctypes.string_at(buffers + i * MAX_DATAGRAM,
+                              self.headers[i].msg_len)
+      offset = i * SOCKADDR_IN_SIZE
+      address = unpack_address(self.names[offset:offset + SOCKADDR_IN_SIZE])
+      datagrams.append((data, address))
+    return datagrams
+
+  def _receive_each(self, sock):
+    datagrams = []
+    for _ in range(self.size):
+      try:
+        datagrams.append(sock.recvfrom(MAX_DATAGRAM, socket.MSG_DONTWAIT))
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          break
+        raise
+    return datagrams
+
+
+def send(sock, datagrams):
+  """Without blocking, writes a list of (data, address) tuples to a socket.
+
+  Datagrams that don't fit in the socket's send buffer are dropped, as the
+  network would, and so are datagrams the kernel refuses, such as ones too
+  large to send; the rest are still sent. Returns the number of datagrams
+  sent.
+  """
+  if not available:
+    return _send_each(sock, datagrams)
+
+  sent = 0
+  start = 0
+  while start < len(datagrams):
+    batch = datagrams[start:start + BATCH_SIZE]
+    count = len(batch)
+    names = ctypes.create_string_buffer(
+        ''.join(pack_address(address) for (_, address) in batch))
+    iovecs = (iovec * count)()
+    headers = (mmsghdr * count)()
+    for i, (data, _) in enumerate(batch):
+      # Points into the string itself; batch keeps it alive until the call.
+      iovecs[i].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+      iovecs[i].iov_len = len(data)
+      header = headers[i].msg_hdr
+      header.msg_name = ctypes.addressof(names) + i * SOCKADDR_IN_SIZE
+      header.msg_namelen = SOCKADDR_IN_SIZE
+      header.msg_iov = ctypes.pointer(iovecs[i])
+      header.msg_iovlen = 1
+
+    # sendmmsg stops at the first datagram it can't send, and reports that
+    # datagram's error when called again from there.
+    result = libc.sendmmsg(sock.fileno(), headers, count, socket.MSG_DONTWAIT)
+    if result < 0:
+      if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK):
+        break
+      start += 1
+      continue
+    if result == 0:
+      break
+    sent += result
+    start += result
+  return sent
+
+
+def _send_each(sock, datagrams):
+  sent = 0
+  for data, address in datagrams:
+    try:
+      sock.sendto(data, socket.MSG_DONTWAIT, address)
+    except socket.error as e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        break
+      continue
+    sent += 1
+  return sent
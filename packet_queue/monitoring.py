@@ -12,35 +12,319 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""Network simulation monitoring, as reported to the web UI."""
+
+import array
+import bisect
+import collections
+import itertools
+import math
+
+
+def parse_duration(text):
+  """Parses a duration such as "100ms", "2s" or "0.5" into seconds.
+
+  Raises:
+    ValueError if the text isn't a positive number of seconds or milliseconds
+  """
+  if text.endswith('ms'):
+    seconds = float(text[:-2]) / 1000
+  elif text.endswith('s'):
+    seconds = float(text[:-1])
+  else:
+    seconds = float(text)
+  if not seconds > 0:
+    raise ValueError('Duration must be positive', text)
+  return seconds
+
+
+class Histogram(object):
+  """Counts values into fixed buckets, given by their upper bounds.
+
+  Values larger than the last bound are counted in an extra overflow bucket.
+  The sum of all values is kept too.
+  """
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.reset()
+
+  def reset(self):
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.sum = 0.0
+
+  def add(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.sum += value
+
+  def merge(self, other):
+    for i, count in enumerate(other.counts):
+      self.counts[i] += count
+    self.sum += other.sum
+
+  def quantile(self, q):
+    """Estimates a quantile as the upper bound of the bucket containing it.
+
+    Returns None if the histogram is empty, and infinity if the quantile
+    falls in the overflow bucket.
+    """
+    total = sum(self.counts)
+    if not total:
+      return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if count and seen >= rank:
+        break
+    return self.bounds[i] if i < len(self.bounds) else float('inf')
+
+
+# Latency histogram bounds for aggregated events: 100us to about 100s, with
+# each bucket about 19% wider than the previous.
+LATENCY_BOUNDS = [0.0001 * 2 ** (i / 4.0) for i in range(81)]
+
+# Latency histogram bounds exported to Prometheus.
+METRICS_LATENCY_BOUNDS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                          0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class Bucket(object):
+  """Summary of the events of one pipe over a time interval."""
+
+  __slots__ = ['start', 'delivered', 'dropped', 'buffer_max', 'latency_min',
+               'latency_max', 'latency']
+
+  def __init__(self, start):
+    self.start = start
+    self.delivered = 0
+    self.dropped = 0
+    self.buffer_max = 0
+    self.latency_min = float('inf')
+    self.latency_max = 0.0
+    self.latency = Histogram(LATENCY_BOUNDS)
+
+  def add_deliver(self, value):
+    self.delivered += value
+
+  def add_drop(self, value):
+    self.dropped += value
+
+  def add_buffer(self, value):
+    if value > self.buffer_max:
+      self.buffer_max = value
+
+  def add_latency(self, value):
+    if value < self.latency_min:
+      self.latency_min = value
+    if value > self.latency_max:
+      self.latency_max = value
+    self.latency.add(value)
+
+  # Maps event types to the methods summarizing them; others are ignored.
+  ADDERS = {
+      'deliver': add_deliver,
+      'drop': add_drop,
+      'buffer': add_buffer,
+      'latency': add_latency,
+  }
+
+  def merge(self, other):
+    self.delivered += other.delivered
+    self.dropped += other.dropped
+    self.buffer_max = max(self.buffer_max, other.buffer_max)
+    self.latency_min = min(self.latency_min, other.latency_min)
+    self.latency_max = max(self.latency_max, other.latency_max)
+    self.latency.merge(other.latency)
+
+  def summary(self, pipe_name):
+    count = sum(self.latency.counts)
+    if count:
+      latency = {
+        'count': count,
+        'min': self.latency_min,
+        'mean': self.latency.sum / count,
+        'p50': min(self.latency.quantile(0.5), self.latency_max),
+        'p99': min(self.latency.quantile(0.99), self.latency_max),
+      }
+    else:
+      latency = {'count': 0}
+    return {
+      'pipe': pipe_name,
+      'start': self.start,
+      'delivered': int(self.delivered),
+      'dropped': int(self.dropped),
+      'buffer_max': int(self.buffer_max),
+      'latency': latency,
+    }
+
 
 class EventLog(object):
   """Records network simulation events for reporting to the web UI.
 
-  This implementation assumes a single client, and deletes events that have
-  been sent.
+  get_pending assumes a single client, and skips events it has already
+  returned. Any number of clients can instead keep their own cursor, the id
+  of the next event they want, and read with get_since.
+
+  Events are stored in a ring of max_size slots, as parallel typed arrays:
+  adding an event is O(1), and old events are overwritten once the ring is
+  full. Pipe names and event types are interned as small integers. Event
+  dictionaries are only built when events are read, with values that were
+  added as integers read back as integers.
+
+  Events are also summarized per pipe into buckets of bucket_width seconds,
+  keeping the last bucket_count of them, which get_buckets merges into
+  coarser intervals on request. Summarizing is left until get_buckets is
+  called, so adding an event doesn't pay for it. While buckets are being
+  read, events are also summarized before the ring overwrites them; when
+  get_buckets hasn't been called for as long as the buckets reach back,
+  overwritten events are left out, and a new reader's first buckets only
+  cover the events still in the ring.
   """
 
   max_size = 9000
+  bucket_width = 0.1
+  bucket_count = 600
 
   def __init__(self):
     self.next_id = 1
-    self.events = []
+    self.first_pending = 1  # Oldest event id not returned by get_pending.
+    self.first_unbucketed = 1  # Oldest event id not summarized in buckets.
+    self.last_read = None  # Time of the last event when buckets were read.
+
+    self.labels = []  # Interned pipe names and event types.
+    self.label_ids = {}
+
+    self.times = array.array('d', [0.0]) * self.max_size
+    self.pipes = array.array('H', [0]) * self.max_size
+    self.types = array.array('H', [0]) * self.max_size
+    self.values = array.array('d', [0.0]) * self.max_size
+    self.floats = array.array('b', [0]) * self.max_size
+
+    self.buckets = {}  # Maps pipe names to deques of Buckets.
 
   def add(self, time, pipe_name, event_type, value):
-    event = {
-      'id': self.next_id,
-      'time': time,
-      'pipe': pipe_name,
-      'type': event_type,
-      'value': value,
-    }
-    self.next_id += 1
-    self.events.append(event)
+    label_ids = self.label_ids
+    if pipe_name not in label_ids:
+      self._intern(pipe_name)
+    if event_type not in label_ids:
+      self._intern(event_type)
+
+    next_id = self.next_id
+    if next_id - self.first_unbucketed >= self.max_size:
+      self._make_room(time)
+    slot = next_id % self.max_size
+    self.times[slot] = time
+    self.pipes[slot] = label_ids[pipe_name]
+    self.types[slot] = label_ids[event_type]
+    self.values[slot] = value
+    self.floats[slot] = isinstance(value, float)
+    self.next_id = next_id + 1
+
+  def _intern(self, label):
+    self.label_ids[label] = len(self.labels)
+    self.labels.append(label)
+
+  def _make_room(self, time):
+    """Summarizes the events in the ring if buckets have been read lately, or
+    else skips the older half of them.
+    """
+    history = self.bucket_width * self.bucket_count
+    if self.last_read is not None and time - self.last_read < history:
+      self._summarize()
+    else:
+      self.first_unbucketed = self.next_id - self.max_size // 2
 
-    if len(self.events) > self.max_size:
-      self.events = self.events[-self.max_size:]
+  def _summarize(self):
+    """Adds the events not yet summarized to their pipes' buckets."""
+    count = self.next_id - self.first_unbucketed
+    start = self.first_unbucketed % self.max_size
+    stop = min(start + count, self.max_size)
+    self._summarize_slots(start, stop)
+    self._summarize_slots(0, start + count - stop)
+    self.first_unbucketed = self.next_id
+
+  def _summarize_slots(self, start, stop):
+    labels = self.labels
+    adders = [Bucket.ADDERS.get(label) for label in labels]
+    width = self.bucket_width
+    bucket_pipe = None
+    bucket_end = None
+    events = itertools.izip(self.times[start:stop], self.pipes[start:stop],
+                            self.types[start:stop], self.values[start:stop])
+    for time, pipe, event_type, value in events:
+      if pipe != bucket_pipe or time >= bucket_end:
+        bucket = self._bucket(labels[pipe], time)
+        bucket_pipe = pipe
+        bucket_end = bucket.start + width
+      adder = adders[event_type]
+      if adder is not None:
+        adder(bucket, value)
+
+  def _bucket(self, pipe_name, time):
+    """Returns the bucket of a pipe to add an event at a time to."""
+    buckets = self.buckets.get(pipe_name)
+    if buckets is None:
+      buckets = collections.deque(maxlen=self.bucket_count)
+      self.buckets[pipe_name] = buckets
+    width = self.bucket_width
+    if not buckets or time >= buckets[-1].start + width:
+      start = round(math.floor(round(time / width, 6)) * width, 6)
+      buckets.append(Bucket(start))
+    return buckets[-1]
 
   def get_pending(self):
-    events = self.events
-    self.events = []
+    events, self.first_pending = self.get_since(self.first_pending)
     return events
+
+  def get_since(self, cursor):
+    """Returns events from id cursor on, and the cursor for the next call.
+
+    Events that have already been overwritten are skipped.
+    """
+    start = max(cursor, self.next_id - self.max_size, 1)
+    events = [self.get_event(event_id)
+              for event_id in xrange(start, self.next_id)]
+    return events, self.next_id
+
+  def get_event(self, event_id):
+    """Builds the dictionary for an event that is still in the ring."""
+    slot = event_id % self.max_size
+    value = self.values[slot]
+    if not self.floats[slot]:
+      value = int(value)
+    return {
+      'id': event_id,
+      'time': self.times[slot],
+      'pipe': self.labels[self.pipes[slot]],
+      'type': self.labels[self.types[slot]],
+      'value': value,
+    }
+
+  def get_buckets(self, resolution, since=0.0):
+    """Summarizes recent events per pipe, over intervals of resolution seconds.
+
+    Resolution is rounded up to a multiple of bucket_width. Only intervals
+    starting at or after since are returned. Intervals without events are
+    left out.
+    """
+    self._summarize()
+    if self.next_id > 1:
+      self.last_read = self.times[(self.next_id - 1) % self.max_size]
+    width = self.bucket_width * max(1, math.ceil(
+        round(resolution / self.bucket_width, 6)))
+    summaries = []
+    for pipe_name in sorted(self.buckets):
+      merged = None
+      for bucket in self.buckets[pipe_name]:
+        start = round(math.floor(round(bucket.start / width, 6)) * width, 6)
+        if start < since:
+          continue
+        if merged is None or merged.start != start:
+          if merged is not None:
+            summaries.append(merged.summary(pipe_name))
+          merged = Bucket(start)
+        merged.merge(bucket)
+      if merged is not None:
+        summaries.append(merged.summary(pipe_name))
+    return summaries
@@ -19,24 +19,70 @@ import iptc
 from twisted.internet import abstract
 from twisted.internet import reactor
 
+from packet_queue import flows
 from packet_queue import libnetfilter_queue
 
 
 UP_QUEUE = 1
 DOWN_QUEUE = 2
 
+# With several workers, worker i serves queues UP_QUEUE_BALANCE + i and
+# DOWN_QUEUE_BALANCE + i.
+UP_QUEUE_BALANCE = 1000
+DOWN_QUEUE_BALANCE = 2000
+MAX_WORKERS = DOWN_QUEUE_BALANCE - UP_QUEUE_BALANCE
 
-def packet_handler(manager, pipe):
+
+def packet_handler(manager, pipe, reverse=False):
+  """Returns a callback sending queued packets through a pipe.
+
+  Packets are classified by their 5-tuple, reversed for packets going from
+  the server to the client.
+  """
   def on_packet(packet):
+    accepted = []
     def accept():
-      manager.set_verdict(packet, libnetfilter_queue.NF_ACCEPT)
+      # A packet can only be accepted once, so duplicates are left out.
+      if not accepted:
+        accepted.append(True)
+        manager.set_verdict(packet, libnetfilter_queue.NF_ACCEPT)
     def drop():
       manager.set_verdict(packet, libnetfilter_queue.NF_DROP)
-    pipe.attempt(accept, drop, packet.size)
+    flow = flows.classify(packet.payload, reverse)
+    pipe.attempt(accept, drop, packet.size, flow, packet.payload)
   return on_packet
 
 
-def configure(protocol, port, pipes, interface):
+class VerdictBatcher(object):
+  """Collects the verdicts set during one reactor tick and flushes them
+  together at the start of the next one.
+
+  Stands in for the Manager in packet_handler.
+  """
+  def __init__(self, manager):
+    self.manager = manager
+    self.flush_scheduled = False
+
+  def set_verdict(self, packet, verdict):
+    self.manager.set_verdict(packet, verdict)
+    if not self.flush_scheduled:
+      self.flush_scheduled = True
+      reactor.callLater(0, self.flush)
+
+  def flush(self):
+    self.flush_scheduled = False
+    self.manager.flush_verdicts()
+
+
+def configure(protocol, port, pipes, interface, workers=1, block=None,
+              **manager_options):
+  """Installs the iptables rules and starts handling queued packets.
+
+  With more than one worker, packets are spread across worker processes by
+  CPU, and pipes are ignored: each worker builds its own from the
+  shared.SharedBlock passed as block. Other keyword arguments are passed on
+  to libnetfilter_queue.Manager.
+  """
   remove_all()
   reactor.addSystemEventTrigger('after', 'shutdown', remove_all)
 
@@ -48,11 +94,28 @@ def configure(protocol, port, pipes, interface):
     if interface not in netifaces.interfaces():
       raise ValueError("Given interface does not exist.", interface)
 
-  add(protocol, port, interface)
-  manager = libnetfilter_queue.Manager()
+  if workers > 1:
+    # Only add the rules once every worker has bound its queues: packets
+    # sent to a queue nobody has bound yet are dropped.
+    from packet_queue import workers as worker_processes
+    worker_processes.spawn('nfqueue', block, workers, manager_options)
+    add(protocol, port, interface, workers)
+  else:
+    add(protocol, port, interface)
+    listen(pipes, UP_QUEUE, DOWN_QUEUE, **manager_options)
+
+
+def listen(pipes, up_queue, down_queue, batch_verdicts=False, drain_limit=1,
+           rcvbuf=None, copy_range=libnetfilter_queue.BUFFER_SIZE):
+  """Binds a pair of queues to pipes and reads them with the reactor."""
+  manager = libnetfilter_queue.Manager(batch_verdicts=batch_verdicts,
+                                       drain_limit=drain_limit,
+                                       rcvbuf=rcvbuf,
+                                       copy_range=copy_range)
+  verdicts = VerdictBatcher(manager) if batch_verdicts else manager
 
-  manager.bind(UP_QUEUE, packet_handler(manager, pipes.up))
-  manager.bind(DOWN_QUEUE, packet_handler(manager, pipes.down))
+  manager.bind(up_queue, packet_handler(verdicts, pipes.up))
+  manager.bind(down_queue, packet_handler(verdicts, pipes.down, reverse=True))
 
   reader = abstract.FileDescriptor()
   reader.doRead = manager.process
@@ -60,16 +123,20 @@ def configure(protocol, port, pipes, interface):
   reactor.addReader(reader)
 
 
-def add(protocol, port, interface):
-  """Adds iptables NFQUEUE rules: one each for INPUT and OUTPUT."""
+def add(protocol, port, interface, workers=1):
+  """Adds iptables NFQUEUE rules: one each for INPUT and OUTPUT.
+
+  With more than one worker, each rule balances packets across a range of
+  queues, one per worker, choosing a queue by CPU.
+  """
   table = iptc.Table(iptc.Table.FILTER)
 
   params =  [
-    ('INPUT', 'in_interface', 'dport', UP_QUEUE),
-    ('OUTPUT', 'out_interface', 'sport', DOWN_QUEUE),
+    ('INPUT', 'in_interface', 'dport', UP_QUEUE, UP_QUEUE_BALANCE),
+    ('OUTPUT', 'out_interface', 'sport', DOWN_QUEUE, DOWN_QUEUE_BALANCE),
   ]
 
-  for chain_name, interface_attr, port_attr, queue_num in params:
+  for chain_name, interface_attr, port_attr, queue_num, balance in params:
     chain = iptc.Chain(table, chain_name)
     rule = iptc.Rule()
     setattr(rule, interface_attr, interface)
@@ -82,7 +149,12 @@ def add(protocol, port, interface):
     setattr(protocol_match, port_attr, str(port))
 
     rule.target = rule.create_target('NFQUEUE')
-    rule.target.set_parameter('queue-num', str(queue_num))
+    if workers > 1:
+      queue_range = '{}:{}'.format(balance, balance + workers - 1)
+      rule.target.set_parameter('queue-balance', queue_range)
+      rule.target.set_parameter('queue-cpu-fanout')
+    else:
+      rule.target.set_parameter('queue-num', str(queue_num))
     chain.insert_rule(rule)
 
 
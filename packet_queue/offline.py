@@ -0,0 +1,430 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs pipes in virtual time, without a network.
+
+A VirtualReactor stands in for the Twisted reactor, as the clock of pipes and
+flow tables: its time only moves when it jumps to the next scheduled call, so
+a simulated minute takes as long as the work done in it. Synthetic traffic
+from the generators here, or the packet sizes and times of a capture file, is
+sent through a PipePair, and a Report sums up what happened to it.
+
+Used by the impaired_network_simulate script, or python -m
+packet_queue.offline, for tuning params and catching performance regressions
+without root or a live network.
+"""
+import argparse
+import heapq
+import json
+import random
+import struct
+import time
+
+from . import impairments
+from . import monitoring
+from . import simulation
+
+
+class DelayedCall(object):
+  """Handle returned by VirtualReactor.callLater, like Twisted's DelayedCall.
+  """
+
+  __slots__ = ['time', 'callback', 'args', 'kwargs', 'cancelled', 'called']
+
+  def __init__(self, time, callback, args, kwargs):
+    self.time = time
+    self.callback = callback
+    self.args = args
+    self.kwargs = kwargs
+    self.cancelled = False
+    self.called = False
+
+  def cancel(self):
+    self.cancelled = True
+
+  def active(self):
+    return not (self.cancelled or self.called)
+
+  def getTime(self):
+    return self.time
+
+
+class VirtualReactor(object):
+  """The parts of the Twisted reactor that pipes use, in virtual time.
+
+  Scheduled calls are kept in a heap. Cancelled calls stay in it until their
+  time comes, and are skipped then.
+  """
+
+  def __init__(self, start=0.0):
+    self.time = start
+    self.heap = []
+    self.count = 0  # Keeps calls with equal times in scheduling order.
+
+  def seconds(self):
+    return self.time
+
+  def callLater(self, delay, callback, *args, **kwargs):
+    call = DelayedCall(self.time + max(0, delay), callback, args, kwargs)
+    self.count += 1
+    heapq.heappush(self.heap, (call.time, self.count, call))
+    return call
+
+  def step(self):
+    """Makes the next call that isn't cancelled, moving the clock to its time.
+
+    Returns False if nothing is scheduled.
+    """
+    heap = self.heap
+    while heap:
+      call_time, _, call = heapq.heappop(heap)
+      if call.cancelled:
+        continue
+      self.time = call_time
+      call.called = True
+      call.callback(*call.args, **call.kwargs)
+      return True
+    return False
+
+  def run(self, until=None):
+    """Makes calls in order, until none are left or the clock reaches until.
+    """
+    heap = self.heap
+    while heap:
+      if until is not None and heap[0][0] > until:
+        break
+      self.step()
+    if until is not None:
+      self.time = max(self.time, until)
+
+  def advance(self, seconds):
+    """Moves the clock forward, making the calls that come due."""
+    self.run(self.time + seconds)
+
+
+def constant_bit_rate(rate, size, duration):
+  """Yields (time, size) pairs for packets sent evenly, rate times a second.
+  """
+  count = int(rate * duration)
+  for i in xrange(count):
+    yield i / float(rate), size
+
+
+def poisson(rate, size, duration, generator=random):
+  """Yields (time, size) pairs for packets sent at random, rate times a
+  second on average.
+  """
+  now = generator.expovariate(rate)
+  while now < duration:
+    yield now, size
+    now += generator.expovariate(rate)
+
+
+PCAP_MAGIC = {
+    '\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    '\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    '\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    '\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+
+
+PCAPNG_SECTION = '\x0a\x0d\x0d\x0a'
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+PCAPNG_INTERFACE = 1
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_TSRESOL = 9
+
+
+def pcap_sizes(path):
+  """Yields (time, size) pairs for the packets in a pcap or pcapng file,
+  with times counted from the first packet, and sizes as they were on the
+  wire.
+
+  Of pcapng's packet blocks, only enhanced packet blocks are read: simple
+  packet blocks have no timestamp, and the obsolete packet block isn't
+  written by current tools.
+  """
+  with open(path, 'rb') as f:
+    magic = f.read(4)
+    if magic == PCAPNG_SECTION:
+      packets = _pcapng_packets(f, path)
+    elif magic in PCAP_MAGIC:
+      packets = _pcap_packets(f, path, magic)
+    else:
+      raise ValueError('Not a pcap or pcapng file.', path)
+
+    start = None
+    for timestamp, size in packets:
+      if start is None:
+        start = timestamp
+      yield timestamp - start, size
+
+
+def _pcap_packets(f, path, magic):
+  """Yields (timestamp, size) pairs from a pcap file, after its magic."""
+  header = f.read(20)
+  if len(header) < 20:
+    raise ValueError('Not a pcap file.', path)
+  order, resolution = PCAP_MAGIC[magic]
+  record = struct.Struct(order + 'IIII')
+  while True:
+    data = f.read(record.size)
+    if len(data) < record.size:
+      return
+    seconds, fraction, captured, size = record.unpack(data)
+    f.seek(captured, 1)
+    yield seconds + fraction * resolution, size
+
+
+def _pcapng_packets(f, path):
+  """Yields (timestamp, size) pairs from a pcapng file, after the type of its
+  first block.
+
+  Each section has its own byte order and interfaces, and each interface its
+  own timestamp resolution.
+  """
+  block_type = PCAPNG_SECTION
+  while True:
+    data = f.read(4)
+    if len(data) < 4:
+      return
+    if block_type == PCAPNG_SECTION:
+      # The byte order is only known from the magic after the length.
+      magic = f.read(4)
+      for order in '<>':
+        if magic == struct.pack(order + 'I', PCAPNG_BYTE_ORDER):
+          break
+      else:
+        raise ValueError('Not a pcapng file.', path)
+      resolutions = []
+      header_size = 16
+    else:
+      magic = ''
+      header_size = 12
+    length = struct.unpack(order + 'I', data)[0]
+    if length < header_size:
+      raise ValueError('Bad pcapng block length.', path)
+    body = magic + f.read(length - header_size)
+    if len(body) < length - 12:
+      return
+    f.seek(4, 1)  # The length again.
+
+    block_type = struct.unpack(order + 'I', block_type)[0]
+    if block_type == PCAPNG_INTERFACE:
+      resolutions.append(_pcapng_resolution(body[8:], order))
+    elif block_type == PCAPNG_ENHANCED_PACKET and len(body) >= 20:
+      interface, high, low, _, size = struct.unpack_from(order + 'IIIII', body)
+      if interface >= len(resolutions):
+        raise ValueError('Packet from an undescribed interface.', path)
+      yield ((high << 32) | low) * resolutions[interface], size
+
+    block_type = f.read(4)
+    if len(block_type) < 4:
+      return
+
+
+def _pcapng_resolution(options, order):
+  """Returns the seconds per timestamp unit given by an interface's options.
+  """
+  offset = 0
+  while offset + 4 <= len(options):
+    code, length = struct.unpack_from(order + 'HH', options, offset)
+    offset += 4
+    if code == 0:
+      break
+    if code == PCAPNG_TSRESOL and length >= 1 and offset < len(options):
+      value = ord(options[offset])
+      if value & 0x80:
+        return 2.0 ** -(value & 0x7f)
+      return 10.0 ** -value
+    offset += (length + 3) & ~3
+  return 1e-6
+
+
+class Source(object):
+  """Sends packets from a traffic generator through one pipe, in time."""
+
+  def __init__(self, reactor, pipe, traffic, report):
+    self.reactor = reactor
+    self.pipe = pipe
+    self.traffic = iter(traffic)
+    self.report = report
+    self.start = reactor.seconds()
+
+  def start_sending(self):
+    self._schedule_next()
+
+  def _schedule_next(self):
+    for offset, size in self.traffic:
+      delay = self.start + offset - self.reactor.seconds()
+      self.reactor.callLater(delay, self._send, size)
+      return
+
+  def _send(self, size):
+    attempt_time = self.reactor.seconds()
+    def deliver():
+      self.report.latency.add(self.reactor.seconds() - attempt_time)
+    self.pipe.attempt(deliver, lambda: None, size)
+    self._schedule_next()
+
+
+class Report(object):
+  """What happened to the packets sent through one pipe."""
+
+  def __init__(self, name):
+    self.name = name
+    self.latency = monitoring.Histogram(monitoring.LATENCY_BOUNDS)
+    self.meter = {}
+
+  def summary(self):
+    attempted = self.meter.get('packets_attempted', 0)
+    summary = dict(self.meter)
+    for reason in ['buffer', 'aqm', 'loss']:
+      dropped = self.meter.get('packets_dropped_' + reason, 0)
+      summary['drop_rate_' + reason] = (
+          float(dropped) / attempted if attempted else 0.0)
+    for q in [0.5, 0.9, 0.99, 0.999]:
+      summary['latency_p{:g}'.format(q * 100)] = self.latency.quantile(q)
+    delivered = sum(self.latency.counts)
+    summary['latency_mean'] = (
+        self.latency.sum / delivered if delivered else None)
+    return summary
+
+
+def simulate(params, up=None, down=None, reactor=None):
+  """Sends traffic through a new PipePair until every packet is through.
+
+  Args:
+    params: the pipes' params, as a dictionary
+    up: traffic for the up pipe, as (time, size) pairs in time order
+    down: traffic for the down pipe, likewise
+    reactor: a VirtualReactor, or None for a new one starting at zero
+
+  Returns:
+    A dictionary with a summary of each direction, the virtual seconds the
+    simulation covered, the wall clock seconds it took, and the packets
+    attempted per wall clock second.
+  """
+  if reactor is None:
+    reactor = VirtualReactor()
+
+  pipes = simulation.PipePair(simulation.Params(params),
+                              monitoring.EventLog(), reactor)
+  reports = {}
+  for name, traffic in [('up', up), ('down', down)]:
+    reports[name] = Report(name)
+    if traffic is not None:
+      Source(reactor, getattr(pipes, name), traffic,
+             reports[name]).start_sending()
+
+  start_time = reactor.seconds()
+  wall_start = time.time()
+  reactor.run()
+  wall_seconds = time.time() - wall_start
+
+  results = {'virtual_seconds': reactor.seconds() - start_time,
+             'wall_seconds': wall_seconds}
+  attempted = 0
+  for name, report in reports.items():
+    report.meter = getattr(pipes, name).meter()
+    attempted += report.meter['packets_attempted']
+    results[name] = report.summary()
+  results['packets_per_second'] = (
+      attempted / wall_seconds if wall_seconds > 0 else float('inf'))
+  return results
+
+
+def parse_param(text):
+  """Parses a key=value argument into a pair, with the type of the default.
+  """
+  key, _, value = text.partition('=')
+  if key not in simulation.Pipe.PARAMS:
+    raise argparse.ArgumentTypeError('unknown param: ' + key)
+  try:
+    return key, type(simulation.Pipe.PARAMS[key])(value)
+  except ValueError:
+    raise argparse.ArgumentTypeError('bad value for {}: {}'.format(key, value))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description='Sends synthetic traffic through pipes in virtual time.')
+  parser.add_argument(
+      '--traffic', choices=['cbr', 'poisson', 'pcap'], default='cbr',
+      help='how packets are spaced: evenly, at random, or as in --pcap')
+  parser.add_argument(
+      '--rate', type=float, default=1000,
+      help='packets per second, for cbr and poisson traffic')
+  parser.add_argument(
+      '--size', type=int, default=1200,
+      help='bytes per packet, for cbr and poisson traffic')
+  parser.add_argument(
+      '--duration', type=float, default=10.0,
+      help='seconds of traffic, for cbr and poisson traffic')
+  parser.add_argument(
+      '--pcap', type=str,
+      help='capture file to take packet times and sizes from')
+  parser.add_argument(
+      '--direction', choices=['up', 'down', 'both'], default='up',
+      help='pipes to send the traffic through')
+  parser.add_argument(
+      '--param', type=parse_param, action='append', default=[],
+      metavar='KEY=VALUE', help='pipe param to set; may be repeated')
+  parser.add_argument(
+      '--seed', type=int,
+      help='seed for the random numbers, to make runs reproducible')
+  parser.add_argument(
+      '--json', action='store_true',
+      help='print the results as JSON')
+  args = parser.parse_args(argv)
+
+  if args.traffic == 'pcap' and not args.pcap:
+    parser.error('--pcap is required with --traffic pcap')
+  if args.seed is not None:
+    impairments.seed(args.seed)
+
+  params = dict(simulation.Pipe.PARAMS)
+  params.update(args.param)
+
+  def traffic():
+    if args.traffic == 'cbr':
+      return constant_bit_rate(args.rate, args.size, args.duration)
+    elif args.traffic == 'poisson':
+      return poisson(args.rate, args.size, args.duration,
+                     random.Random(args.seed))
+    return pcap_sizes(args.pcap)
+
+  up = traffic() if args.direction in ('up', 'both') else None
+  down = traffic() if args.direction in ('down', 'both') else None
+  results = simulate(params, up, down)
+
+  if args.json:
+    print json.dumps(results, indent=2, sort_keys=True)
+    return
+
+  print 'simulated {:.3f}s in {:.3f}s, {:.0f} packets/second'.format(
+      results['virtual_seconds'], results['wall_seconds'],
+      results['packets_per_second'])
+  for name in ['up', 'down']:
+    summary = results[name]
+    if not summary['packets_attempted']:
+      continue
+    print
+    print name
+    for key in sorted(summary):
+      print '  {:<24} {}'.format(key, summary[key])
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,313 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Queue disciplines deciding which packets a Pipe's buffer holds and sends.
+
+A queue discipline belongs to one pipe. The pipe offers it each packet that
+survives random loss, and asks it for the next packet to send whenever the
+link is free. Packets it turns away or throws out are handed back through
+the pipe's drop method, with the reason they were dropped: 'buffer' when the
+buffer param is exceeded, 'aqm' for early drops by RED or CoDel.
+
+The discipline is chosen with the qdisc param, an index into QDISCS, and
+reads its tuning params from the pipe's cached params on every packet, so
+they can be changed on the fly. All of the work done per packet is constant
+time.
+"""
+import collections
+import math
+import random
+
+
+# Bytes in the largest packet expected. CoDel never drops from a queue that
+# holds less than this, and FQ-CoDel gives each flow this many bytes per turn.
+MAX_PACKET = 1514
+
+# Weight of the newest sample in RED's moving average of the queue size.
+RED_WEIGHT = 0.002
+
+
+class TailDrop(object):
+  """First in, first out, turning away packets that don't fit in the buffer.
+
+  This is how pipes have always behaved.
+  """
+
+  def __init__(self, pipe):
+    self.pipe = pipe
+    self.queue = collections.deque()
+
+  def __len__(self):
+    return len(self.queue)
+
+  def enqueue(self, packet, now):
+    if self.pipe.over_limit():
+      self.pipe.drop(packet, 'buffer')
+    else:
+      self.push(packet)
+
+  def push(self, packet):
+    """Adds a packet that has already been admitted."""
+    self.queue.append(packet)
+
+  def dequeue(self, now):
+    if self.queue:
+      return self.queue.popleft()
+    return None
+
+  def drain(self):
+    """Removes and returns every packet, in the order they would be sent."""
+    packets = list(self.queue)
+    self.queue.clear()
+    return packets
+
+
+class RED(TailDrop):
+  """Random Early Detection, after Floyd and Jacobson.
+
+  Drops arrivals at random once the average queue size passes red_min bytes,
+  with a probability that grows to red_probability at red_max bytes, and
+  drops every arrival beyond that. While the queue is empty, the average
+  decays as if packets of MAX_PACKET bytes kept being sent at the pipe's
+  rate.
+  """
+
+  def __init__(self, pipe):
+    TailDrop.__init__(self, pipe)
+    self.average = 0.0
+    self.count = -1  # Arrivals since the last early drop.
+    self.idle_since = None
+
+  def enqueue(self, packet, now):
+    params = self.pipe.cached
+    backlog = self.pipe.backlog() - packet.size
+
+    if self.idle_since is not None:
+      rate = self.pipe.rate()
+      if rate > 0:
+        sent = (now - self.idle_since) * rate / MAX_PACKET
+        self.average *= (1 - RED_WEIGHT) ** sent
+      else:
+        self.average = 0.0
+      self.idle_since = None
+    self.average += RED_WEIGHT * (backlog - self.average)
+
+    if self.pipe.over_limit():
+      self.pipe.drop(packet, 'buffer')
+    elif self.average < params.red_min:
+      self.count = -1
+      self.push(packet)
+    elif self.average >= params.red_max:
+      self.count = 0
+      self.pipe.drop(packet, 'aqm')
+    else:
+      self.count += 1
+      fraction = ((self.average - params.red_min) /
+                  (params.red_max - params.red_min))
+      probability = params.red_probability * fraction
+      if self.count * probability < 1:
+        probability /= 1 - self.count * probability
+      else:
+        probability = 1.0
+      if random.random() < probability:
+        self.count = 0
+        self.pipe.drop(packet, 'aqm')
+      else:
+        self.push(packet)
+
+  def dequeue(self, now):
+    packet = TailDrop.dequeue(self, now)
+    if not self.queue:
+      self.idle_since = now
+    return packet
+
+
+class CoDel(TailDrop):
+  """Controlled Delay, as described in RFC 8289.
+
+  Once packets have spent more than codel_target seconds in the queue for a
+  whole codel_interval, drops packets as they leave the queue, more often the
+  longer the delay stays above the target.
+  """
+
+  def __init__(self, pipe):
+    TailDrop.__init__(self, pipe)
+    self.bytes = 0
+    self.first_above_time = None
+    self.drop_next = 0.0
+    self.count = 0
+    self.last_count = 0
+    self.dropping = False
+
+  def push(self, packet):
+    self.queue.append(packet)
+    self.bytes += packet.size
+
+  def drain(self):
+    self.bytes = 0
+    return TailDrop.drain(self)
+
+  def _control_law(self, time):
+    return time + self.pipe.cached.codel_interval / math.sqrt(self.count)
+
+  def _pop(self, now):
+    """Returns the next packet, and whether it may be dropped."""
+    if not self.queue:
+      self.first_above_time = None
+      return None, False
+
+    packet = self.queue.popleft()
+    self.bytes -= packet.size
+    params = self.pipe.cached
+    sojourn = now - packet.attempt_time
+    if sojourn < params.codel_target or self.bytes <= MAX_PACKET:
+      self.first_above_time = None
+      return packet, False
+    if self.first_above_time is None:
+      self.first_above_time = now + params.codel_interval
+      return packet, False
+    return packet, now >= self.first_above_time
+
+  def dequeue(self, now):
+    packet, ok_to_drop = self._pop(now)
+    if packet is None:
+      self.dropping = False
+      return None
+
+    if self.dropping:
+      if not ok_to_drop:
+        self.dropping = False
+      while self.dropping and now >= self.drop_next:
+        self.pipe.drop(packet, 'aqm')
+        self.count += 1
+        packet, ok_to_drop = self._pop(now)
+        if not ok_to_drop:
+          self.dropping = False
+        else:
+          self.drop_next = self._control_law(self.drop_next)
+    elif ok_to_drop:
+      self.pipe.drop(packet, 'aqm')
+      packet, _ = self._pop(now)
+      self.dropping = True
+      delta = self.count - self.last_count
+      interval = self.pipe.cached.codel_interval
+      if delta > 1 and now - self.drop_next < 16 * interval:
+        self.count = delta
+      else:
+        self.count = 1
+      self.drop_next = self._control_law(now)
+      self.last_count = self.count
+
+    return packet
+
+
+class FQCoDel(object):
+  """Flow queueing with CoDel on each queue, as described in RFC 8290.
+
+  Packets are hashed by their flow into fq_flows queues, which take turns
+  sending, fq_quantum bytes at a time, with new flows going first. When the
+  buffer is full, packets are dropped from the head of the queue that was
+  the longest when last looked at, rather than from the tail, so one heavy
+  flow can't lock the others out. Packets are dropped until the buffer is
+  back under its limit, looking for the longest queue again whenever that
+  one runs empty.
+  """
+
+  def __init__(self, pipe):
+    self.pipe = pipe
+    self.queues = {}  # CoDel instances, by hash bucket.
+    self.new_flows = collections.deque()
+    self.old_flows = collections.deque()
+    self.fattest = None
+    self.length = 0
+
+  def __len__(self):
+    return self.length
+
+  def _queue(self, flow):
+    index = hash(flow) % max(1, self.pipe.cached.fq_flows)
+    queue = self.queues.get(index)
+    if queue is None:
+      queue = self.queues[index] = CoDel(self.pipe)
+      queue.credits = 0
+      queue.active = False
+    return queue
+
+  def enqueue(self, packet, now):
+    self.push(packet)
+    while self.length and self.pipe.over_limit():
+      victim = self.fattest
+      if victim is None or not victim.queue:
+        victim = self.fattest = max(self.queues.itervalues(),
+                                    key=lambda queue: queue.bytes)
+      victim.bytes -= victim.queue[0].size
+      self.length -= 1
+      self.pipe.drop(victim.queue.popleft(), 'buffer')
+
+  def push(self, packet):
+    queue = self._queue(packet.flow)
+    queue.push(packet)
+    self.length += 1
+    if not queue.active:
+      queue.active = True
+      queue.credits = self.pipe.cached.fq_quantum
+      self.new_flows.append(queue)
+    if self.fattest is None or queue.bytes > self.fattest.bytes:
+      self.fattest = queue
+    return queue
+
+  def dequeue(self, now):
+    while True:
+      if self.new_flows:
+        flows = self.new_flows
+      elif self.old_flows:
+        flows = self.old_flows
+      else:
+        return None
+
+      queue = flows[0]
+      if queue.credits <= 0:
+        queue.credits += self.pipe.cached.fq_quantum
+        flows.popleft()
+        self.old_flows.append(queue)
+        continue
+
+      before = len(queue)
+      packet = queue.dequeue(now)
+      self.length -= before - len(queue)
+      if packet is None:
+        flows.popleft()
+        if flows is self.new_flows:
+          self.old_flows.append(queue)
+        else:
+          queue.active = False
+        continue
+
+      queue.credits -= packet.size
+      return packet
+
+  def drain(self):
+    packets = []
+    for flows in [self.new_flows, self.old_flows]:
+      for queue in flows:
+        packets.extend(queue.drain())
+        queue.active = False
+      flows.clear()
+    self.length = 0
+    self.fattest = None
+    return packets
+
+
+QDISCS = [TailDrop, RED, CoDel, FQCoDel]
+NAMES = ['taildrop', 'red', 'codel', 'fq_codel']
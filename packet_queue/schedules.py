@@ -0,0 +1,200 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Changes params over time, following a program run in the reactor.
+
+A program is a list of steps, each setting some params at a time in seconds
+from the start of the program. A step can instead be a ramp, which moves the
+params in a straight line from their values at the previous step's time (or
+the start, for the first step) to its own values at its time. For example,
+to bring the bandwidth down from 10 Mbit/s to 500 kbit/s over 30 seconds,
+then back up at once:
+
+  {"steps": [{"time": 0, "params": {"bandwidth": 1250000}},
+             {"time": 30, "params": {"bandwidth": 62500}, "ramp": true},
+             {"time": 40, "params": {"bandwidth": 1250000}}],
+   "loop": true}
+
+Times are counted from the start, not from the previous step, so timers
+firing late don't add up. With loop, the program starts over at the time of
+its last step. Ramps set the params every interval seconds from their start,
+which a program may change from RAMP_INTERVAL, down to MIN_INTERVAL. Params
+that pick from a list, like the qdisc, have no values in between: a ramp
+leaves them as they are until its time, then sets them.
+"""
+import math
+
+from twisted.internet import reactor
+
+from . import simulation
+
+
+RAMP_INTERVAL = 0.01
+MIN_INTERVAL = 0.001
+
+
+class Step(object):
+  """Params to set at a time, or to ramp to by then."""
+
+  def __init__(self, time, params, ramp=False):
+    self.time = time
+    self.params = params
+    self.ramp = ramp
+
+  def to_json(self):
+    return {'time': self.time, 'params': self.params, 'ramp': self.ramp}
+
+
+def parse_program(program, types):
+  """Checks a program, as decoded from JSON.
+
+  Args:
+    program: dictionary with a list of steps, and optionally loop and interval
+    types: {param: type} dictionary of the params that can be set
+
+  Returns:
+    A list of Steps, whether to loop, and the ramp interval
+
+  Raises:
+    ValueError if the program is malformed, or sets unknown params or values
+        out of range
+  """
+  if not isinstance(program, dict) or not program.get('steps'):
+    raise ValueError('Program must have a list of steps.')
+  steps = []
+  last_time = 0.0
+  for step in program['steps']:
+    try:
+      time = float(step['time'])
+      params = {k: types[k](v) for (k, v) in step['params'].items()}
+    except (KeyError, TypeError, AttributeError):
+      raise ValueError('Steps need a time and known params.', step)
+    simulation.check_params(params)
+    if time < last_time:
+      raise ValueError('Step times must not go back.', step)
+    last_time = time
+    steps.append(Step(time, params, bool(step.get('ramp', False))))
+
+  interval = float(program.get('interval', RAMP_INTERVAL))
+  if interval < MIN_INTERVAL:
+    raise ValueError('Ramp interval is too short.', interval)
+  return steps, bool(program.get('loop', False)), interval
+
+
+class Schedule(object):
+  """Runs a program of steps on a params dictionary.
+
+  Timers are set on the clock, the Twisted reactor by default.
+  """
+
+  def __init__(self, params, steps, loop=False, interval=RAMP_INTERVAL,
+               clock=None):
+    self.params = params
+    self.steps = steps
+    self.loop = loop
+    self.interval = interval
+    self.clock = reactor if clock is None else clock
+    self.types = {k: type(v) for (k, v) in params.items()}
+    self.period = steps[-1].time if steps else 0.0
+
+    self.index = 0
+    self.start_time = None
+    self.ramp_values = None  # Params at the start of the current ramp.
+    self.timer = None
+
+  @property
+  def running(self):
+    return self.timer is not None
+
+  def start(self):
+    """Starts the program, with its times counted from now."""
+    self.index = 0
+    self.start_time = self.clock.seconds()
+    self._schedule_next()
+
+  def stop(self):
+    """Stops the program, leaving the params as they are."""
+    if self.timer and self.timer.active():
+      self.timer.cancel()
+    self.timer = None
+
+  def to_json(self):
+    """Returns the program and its progress, for the API."""
+    elapsed = None
+    if self.running:
+      elapsed = self.clock.seconds() - self.start_time
+    return {
+        'steps': [step.to_json() for step in self.steps],
+        'loop': self.loop,
+        'interval': self.interval,
+        'running': self.running,
+        'elapsed': elapsed,
+    }
+
+  def _set(self, values):
+    params = {}
+    for key, value in values.items():
+      if self.types[key] is int:
+        value = round(value)
+      params[key] = self.types[key](value)
+    self.params.update(params)
+
+  def _begin_time(self, index):
+    """Returns when a step starts taking effect, from the program start."""
+    step = self.steps[index]
+    if not step.ramp:
+      return step.time
+    return self.steps[index - 1].time if index > 0 else 0.0
+
+  def _schedule_next(self):
+    if self.index == len(self.steps):
+      if not self.loop or self.period <= 0:
+        self.timer = None
+        return
+      self.index = 0
+      self.start_time += self.period
+
+    begin = self.start_time + self._begin_time(self.index)
+    delay = max(0, begin - self.clock.seconds())
+    self.timer = self.clock.callLater(delay, self._begin_step)
+
+  def _begin_step(self):
+    step = self.steps[self.index]
+    if step.ramp:
+      self.ramp_values = {k: float(self.params[k]) for k in step.params
+                          if k not in simulation.Pipe.CHOICES}
+    self._advance_step()
+
+  def _advance_step(self):
+    """Sets the params of the current step, or as far along its ramp as the
+    time allows.
+    """
+    step = self.steps[self.index]
+    now = self.clock.seconds()
+    end = self.start_time + step.time
+    if not step.ramp or now >= end:
+      self.params.update(step.params)
+      self.index += 1
+      self._schedule_next()
+      return
+
+    begin = self.start_time + self._begin_time(self.index)
+    fraction = (now - begin) / (end - begin)
+    self._set({k: start + (step.params[k] - start) * fraction
+               for (k, start) in self.ramp_values.items()})
+    # Ticks fall on whole intervals from the start of the ramp.
+    ticks = math.floor((now - begin) / self.interval) + 1
+    next_time = min(begin + ticks * self.interval, end)
+    self.timer = self.clock.callLater(max(0, next_time - now),
+                                      self._advance_step)
@@ -0,0 +1,310 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Simulation state shared between worker processes.
+
+A SharedBlock is a memory-mapped file of doubles, holding the pipe params in
+order of their names, then a version slot, then, for each worker and pipe
+direction, a buffer occupancy slot and a run of stats slots.
+
+The params are written like a seqlock: a writer takes an exclusive flock on
+the file, makes the version odd, writes the values and makes the version
+even again. Readers never wait on the lock. They copy the values and keep
+the copy if the version was even and unchanged around it, so they never see
+half an update. Each process keeps its copy in SharedParams.cached, for its
+pipes to read, and polls the version to notice updates from other
+processes. Any process can map the block, such as a controller changing the
+params from outside, with a workers count of zero.
+
+Every other slot has a single writer, so no locking is needed: each worker
+publishes how many bytes its own pipes hold, and reads the sum across all
+workers to enforce the buffer and bandwidth limits of the whole link.
+Workers also publish their counters and latency histograms from time to
+time, and the process serving the API reads their sums.
+"""
+
+import collections
+import ctypes
+import fcntl
+import mmap
+import os
+import tempfile
+import weakref
+
+from . import monitoring
+from . import simulation
+
+
+DOUBLE_SIZE = ctypes.sizeof(ctypes.c_double)
+DIRECTIONS = ['up', 'down']
+
+# Stats slots per worker and direction: the counters, then the latency
+# histogram's bucket counts and sum.
+STATS_SIZE = (len(simulation.Pipe.COUNTERS) +
+              len(monitoring.METRICS_LATENCY_BOUNDS) + 2)
+
+
+class SharedBlock(object):
+  """Memory-mapped params, occupancy and stats slots for some workers."""
+
+  def __init__(self, path, template, workers):
+    self.path = path
+    self.keys = sorted(template)
+    self.workers = workers
+
+    self.version_slot = len(self.keys)
+    self.occupancy_start = self.version_slot + 1
+    self.stats_start = self.occupancy_start + len(DIRECTIONS) * workers
+    count = self.stats_start + len(DIRECTIONS) * workers * STATS_SIZE
+
+    # Kept open to lock while writing params.
+    self.fd = os.open(path, os.O_RDWR)
+    if os.fstat(self.fd).st_size < count * DOUBLE_SIZE:
+      os.ftruncate(self.fd, count * DOUBLE_SIZE)
+    self.mmap = mmap.mmap(self.fd, count * DOUBLE_SIZE)
+
+    self.values = (ctypes.c_double * count).from_buffer(self.mmap)
+    self.params = SharedParams(self, template)
+
+  @classmethod
+  def create(cls, template, workers):
+    """Creates a new block file, initialized with the template params."""
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, path = tempfile.mkstemp(prefix='packet_queue-', dir=shm_dir)
+    os.close(fd)
+
+    block = cls(path, template, workers)
+    block.params.update(template)
+    return block
+
+  def slots(self, direction):
+    """Returns the index of the first occupancy slot for a direction."""
+    return (self.occupancy_start +
+            DIRECTIONS.index(direction) * self.workers)
+
+  def stats_slots(self, direction, worker):
+    """Returns the index of the first stats slot of a worker's pipe."""
+    index = DIRECTIONS.index(direction) * self.workers + worker
+    return self.stats_start + index * STATS_SIZE
+
+  def remove(self):
+    """Deletes the block file. Mappings that are already open stay valid."""
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+
+
+class SharedParams(collections.MutableMapping):
+  """Dictionary-like view of the params stored in a SharedBlock.
+
+  The set of keys is fixed, and values keep the types of the template. Like
+  simulation.Params, it has a version, a cached copy for pipes to read, and
+  watchers told of every update. Updates written by this process are seen at
+  once, and those written by others when poll is called.
+  """
+
+  def __init__(self, block, template):
+    self.fd = block.fd
+    self.values = block.values
+    self.version_slot = block.version_slot
+    self.index = {k: i for (i, k) in enumerate(block.keys)}
+    self.types = {k: type(v) for (k, v) in template.items()}
+    self.watchers = weakref.WeakSet()
+    self.cached_version = self.version
+    self.cached = simulation.CachedParams(self.snapshot())
+
+  @property
+  def version(self):
+    """Counts the updates written; odd while one is being written."""
+    return self.values[self.version_slot]
+
+  def __getitem__(self, key):
+    return self.types[key](self.values[self.index[key]])
+
+  def __setitem__(self, key, value):
+    self.update({key: value})
+
+  def update(self, *args, **kwargs):
+    """Writes several params at once, so readers see all or none of them."""
+    params = {k: self.types[k](v) for (k, v) in dict(*args, **kwargs).items()}
+    simulation.check_params(params)
+    values = {self.index[k]: float(v) for (k, v) in params.items()}
+    fcntl.flock(self.fd, fcntl.LOCK_EX)
+    try:
+      self.values[self.version_slot] += 1
+      for index, value in values.items():
+        self.values[index] = value
+      self.values[self.version_slot] += 1
+    finally:
+      fcntl.flock(self.fd, fcntl.LOCK_UN)
+    self._changed()
+
+  def poll(self):
+    """Takes up updates written by other processes, if there are any."""
+    if self.version != self.cached_version:
+      self._changed()
+
+  def watch(self, watcher):
+    """Calls watcher.params_changed() after every update, for as long as the
+    watcher is referenced elsewhere.
+    """
+    self.watchers.add(watcher)
+
+  def _changed(self):
+    # Read first, so an update racing with the snapshot is taken up again by
+    # the next poll.
+    self.cached_version = self.version
+    self.cached.update(self.snapshot())
+    for watcher in list(self.watchers):
+      watcher.params_changed()
+
+  def snapshot(self):
+    """Returns a consistent copy of the params, as a plain dictionary."""
+    values = self.values
+    slot = self.version_slot
+    while True:
+      version = values[slot]
+      copy = values[:slot]
+      if version % 2 == 0 and values[slot] == version:
+        break
+    return {k: self.types[k](copy[i]) for (k, i) in self.index.items()}
+
+  def __delitem__(self, key):
+    raise TypeError('Shared params can\'t be deleted')
+
+  def __iter__(self):
+    return iter(self.index)
+
+  def __len__(self):
+    return len(self.index)
+
+  def __repr__(self):
+    return repr(dict(self))
+
+
+class SharedPipe(simulation.Pipe):
+  """A Pipe that counts the bytes buffered by all workers toward its limits.
+
+  Its own occupancy is published to one slot of the block; the backlog is
+  the sum of the slots of every worker for the same direction. Each worker
+  gets a share of the bandwidth in proportion to the bytes it has buffered,
+  which changes with the other workers' buffers, so a waiting packet's release
+  time is rechecked every RATE_CHECK_INTERVAL seconds. Counters and latency
+  are only written to the block when publish is called.
+  """
+
+  RATE_CHECK_INTERVAL = 0.01
+
+  def __init__(self, name, params, event_log, block, worker, clock=None):
+    self.values = block.values
+    self.first_slot = block.slots(name)
+    self.last_slot = self.first_slot + block.workers
+    self.own_slot = self.first_slot + worker
+    self.stats_slot = block.stats_slots(name, worker)
+    simulation.Pipe.__init__(self, name, params, event_log, clock)
+
+  @property
+  def size(self):
+    return self._size
+
+  @size.setter
+  def size(self, value):
+    self._size = value
+    self.values[self.own_slot] = value
+
+  def backlog(self):
+    return int(sum(self.values[self.first_slot:self.last_slot]))
+
+  def rate(self):
+    """Shares the bandwidth between workers by how much each has buffered."""
+    bandwidth = self.cached.bandwidth
+    backlog = self.backlog()
+    if bandwidth <= 0 or not backlog:
+      return bandwidth
+    return float(bandwidth) * self._size / backlog
+
+  def publish(self):
+    """Writes the counters and latency histogram to the block."""
+    stats = [getattr(self, counter) for counter in self.COUNTERS]
+    stats.extend(self.latency.counts)
+    stats.append(self.latency.sum)
+    self.values[self.stats_slot:self.stats_slot + STATS_SIZE] = stats
+
+
+class SharedPipePair(simulation.PipePair):
+  """PipePair for one worker, using the params and slots of a SharedBlock."""
+
+  def __init__(self, block, event_log, worker, clock=None):
+    self.event_log = event_log
+    self.up = SharedPipe('up', block.params, event_log, block, worker, clock)
+    self.down = SharedPipe('down', block.params, event_log, block, worker,
+                           clock)
+
+  def publish(self):
+    self.up.publish()
+    self.down.publish()
+
+
+class AggregatePipe(object):
+  """Read-only view of one direction's pipes across all workers.
+
+  Has the attributes of a Pipe that the API server and shell look at: the
+  counters, buffer occupancy and latency histogram, as last published by the
+  workers. Resetting the meter only moves this view's baseline.
+  """
+
+  def __init__(self, name, block):
+    self.name = name
+    self.block = block
+    self.baseline = [0.0] * STATS_SIZE
+
+  def _stats(self):
+    values = self.block.values
+    totals = [0.0] * STATS_SIZE
+    for worker in range(self.block.workers):
+      start = self.block.stats_slots(self.name, worker)
+      for i, value in enumerate(values[start:start + STATS_SIZE]):
+        totals[i] += value
+    return totals
+
+  def reset_meter(self):
+    self.baseline = self._stats()
+
+  def meter(self):
+    stats = self._stats()
+    return {counter: int(stats[i] - self.baseline[i])
+            for (i, counter) in enumerate(simulation.Pipe.COUNTERS)}
+
+  @property
+  def size(self):
+    start = self.block.slots(self.name)
+    return int(sum(self.block.values[start:start + self.block.workers]))
+
+  @property
+  def latency(self):
+    stats = self._stats()
+    histogram = monitoring.Histogram(monitoring.METRICS_LATENCY_BOUNDS)
+    start = len(simulation.Pipe.COUNTERS)
+    for i in range(len(histogram.counts)):
+      histogram.counts[i] = int(stats[start + i] - self.baseline[start + i])
+    histogram.sum = stats[-1] - self.baseline[-1]
+    return histogram
+
+
+class AggregatePipePair(object):
+  """Stands in for a PipePair in the process that starts the workers."""
+
+  def __init__(self, block, event_log):
+    self.event_log = event_log
+    self.up = AggregatePipe('up', block)
+    self.down = AggregatePipe('down', block)
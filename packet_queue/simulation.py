@@ -12,17 +12,141 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import random
-import time
+import collections
+import weakref
+
 from twisted.internet import reactor
 
+from . import capture
+from . import impairments
+from . import monitoring
+from . import qdisc
+
+
+def check_params(params):
+  """Raises ValueError if any param that picks from a list is out of range.
+
+  Args:
+    params: {param: value} dictionary, of some or all of the params
+  """
+  for key, choices in Pipe.CHOICES.items():
+    if key in params and not 0 <= params[key] < len(choices):
+      raise ValueError('Unknown {}: {}'.format(key, params[key]))
+
+
+class CachedParams(object):
+  """Params copied into attributes, so reading them on every packet is cheap.
+  """
+
+  def __init__(self, values):
+    self.update(values)
+
+  def update(self, *args, **kwargs):
+    self.__dict__.update(*args, **kwargs)
+
+
+class Params(dict):
+  """Params dictionary that tells pipes when it changes.
+
+  The set of keys is fixed, and values keep the types of the template. Every
+  update is counted in the version, and copied to the cached attribute, a
+  CachedParams which pipes read on every packet. Then the watchers' method
+  params_changed is called. shared.SharedParams offers the same interface,
+  for params in shared memory.
+  """
+
+  def __init__(self, template, **values):
+    dict.__init__(self, template)
+    self.types = {k: type(v) for (k, v) in template.items()}
+    self.version = 0
+    self.cached = CachedParams(template)
+    self.watchers = weakref.WeakSet()
+    if values:
+      self.update(values)
+
+  def __setitem__(self, key, value):
+    self.update({key: value})
+
+  def __delitem__(self, key):
+    raise TypeError('Params can\'t be deleted')
+
+  def update(self, *args, **kwargs):
+    """Sets several params at once, counting as a single update."""
+    values = {k: self.types[k](v) for (k, v) in dict(*args, **kwargs).items()}
+    check_params(values)
+    dict.update(self, values)
+    self.version += 1
+    self.cached.update(values)
+    for watcher in list(self.watchers):
+      watcher.params_changed()
+
+  def snapshot(self):
+    """Returns a copy of the params, as a plain dictionary."""
+    return dict(self)
+
+  def watch(self, watcher):
+    """Calls watcher.params_changed() after every update, for as long as the
+    watcher is referenced elsewhere.
+    """
+    self.watchers.add(watcher)
+
 
 class PipePair(object):
   """Holds two Pipe instances sharing a parameter dictionary and event log."""
-  def __init__(self, params, event_log):
+  def __init__(self, params, event_log, clock=None):
     self.event_log = event_log
-    self.up = Pipe('up', params, event_log)
-    self.down = Pipe('down', params, event_log)
+    self.up = Pipe('up', params, event_log, clock)
+    self.down = Pipe('down', params, event_log, clock)
+
+
+class TokenBucket(object):
+  """Byte credit that accrues at a rate, up to a depth.
+
+  Credit goes negative while a packet is being paid for, and the packet may
+  go once it is back to zero. A rate of zero or less means unlimited, and
+  keeps the bucket full. Starts full.
+  """
+
+  def __init__(self):
+    self.credit = float('inf')
+    self.rate = -1
+    self.time = None
+
+  def advance(self, now, depth):
+    """Accrues credit at the current rate, up to the given time."""
+    if self.rate <= 0:
+      self.credit = depth
+    elif self.time is not None:
+      self.credit += (now - self.time) * self.rate
+    self.credit = min(self.credit, depth)
+    self.time = now
+
+  def charge(self, size):
+    self.credit -= size
+
+  def wait(self):
+    """Returns seconds until the credit is back to zero."""
+    if self.rate <= 0 or self.credit >= 0:
+      return 0
+    return -self.credit / float(self.rate)
+
+
+class Packet(object):
+  """A packet held by a Pipe, from when it's attempted until it's delivered."""
+
+  __slots__ = ['attempt_time', 'size', 'delay', 'deliver_callback',
+               'drop_callback', 'flow', 'reordered', 'payload']
+
+  def __init__(self, attempt_time, size, delay, deliver_callback,
+               drop_callback, flow, payload=None):
+    self.attempt_time = attempt_time
+    self.size = size
+    self.delay = delay
+    self.deliver_callback = deliver_callback
+    self.drop_callback = drop_callback
+    self.flow = flow
+    self.reordered = False
+    self.payload = payload
 
 
 class Pipe(object):
@@ -30,70 +154,335 @@ class Pipe(object):
   invokes the callback later.
 
   Limits bandwidth by holding packets in a "buffer", and rejects packets when
-  the buffer is full.
+  the buffer is full. Which packets the buffer holds, and the order they
+  leave in, is up to a queue discipline from the qdisc module: by default,
+  first in first out with tail drop.
+
+  Applies random packet loss prior to packets joining the buffer, and delay
+  after they are released, as well as the other impairments of the
+  impairments module: jitter, reordering and duplication.
+
+  Counts the packets and bytes attempted, delivered, and dropped because the
+  buffer was full, by active queue management, or to simulate loss, and
+  keeps a histogram of the latency of delivered packets, without going
+  through the event log.
+
+  Packets leave the buffer as a token bucket allows: credit accrues at the
+  bandwidth, and up to burst bytes can build up while the link is idle. With
+  a peak rate, a second bucket without a burst spaces packets out as if they
+  were serialized at that rate. A packet is taken from the queue discipline
+  and charged once the link is free, and a single timer is set for the time
+  its tokens allow. Its release time follows changes to the rates: it is
+  worked out again whenever the params change.
+
+  Alternatively, a shaper from the traces module can take the place of the
+  token buckets and the bandwidth param, releasing packets at the times a
+  recorded trace allows.
+
+  Released packets are kept in a FIFO queue of delivery deadlines, and a
+  single reactor timer is scheduled for whichever deadline comes first.
 
-  Applies constant random packet loss prior to packets joining the buffer, and
-  constant delay after they are released.
+  The params are a Params or shared.SharedParams, read on every packet
+  through the attributes of their cached copy. The pipe watches them to
+  switch queue disciplines, and recheck the head, when they change.
+
+  Time is read from, and timers set on, the clock: the Twisted reactor by
+  default, or anything with its seconds and callLater methods, such as an
+  offline.VirtualReactor.
   """
 
   PARAMS = {
       'bandwidth': -1,  # bytes per second, defaults to infinity
       'buffer': -1,  # max bytes allowed, defaults to infinity
+      'burst': 0,  # bytes sent at once after the link is idle
       'delay': 0.0,
       'loss': 0.0,
+      'jitter': 0.0,  # seconds, standard deviation of the delay
+      'jitter_distribution': 0,  # index into impairments.DISTRIBUTIONS
+      'gilbert_p': 0.0,  # chance of bursty loss starting, 0 for independent
+      'gilbert_r': 0.0,  # chance of bursty loss ending
+      'gilbert_loss_good': 0.0,  # loss outside of bursts
+      'gilbert_loss_bad': 1.0,  # loss during bursts
+      'reorder': 0.0,  # chance of a packet skipping the delay
+      'duplicate': 0.0,  # chance of a packet being delivered twice
+      'peak_rate': -1,  # bytes per second while bursting, defaults to infinity
+      'qdisc': 0,  # index into qdisc.NAMES, defaults to tail drop
+      'red_min': 15000,  # average bytes queued before RED starts dropping
+      'red_max': 45000,  # average bytes queued before RED drops everything
+      'red_probability': 0.1,  # RED's drop probability at red_max
+      'codel_target': 0.005,  # seconds of queueing delay CoDel aims for
+      'codel_interval': 0.1,  # seconds, about the longest round trip time
+      'fq_flows': 1024,  # number of FQ-CoDel queues
+      'fq_quantum': 1514,  # bytes each FQ-CoDel queue sends per turn
+  }
+
+  # Params holding an index into a list, with the list.
+  CHOICES = {
+      'jitter_distribution': impairments.DISTRIBUTIONS,
+      'qdisc': qdisc.NAMES,
   }
 
-  def __init__(self, name, params, event_log):
+  COUNTERS = [
+      'packets_attempted',
+      'bytes_attempted',
+      'packets_delivered',
+      'bytes_delivered',
+      'packets_dropped_buffer',
+      'bytes_dropped_buffer',
+      'packets_dropped_aqm',
+      'bytes_dropped_aqm',
+      'packets_dropped_loss',
+      'bytes_dropped_loss',
+  ]
+
+  # Seconds between rechecks of the head's release time, for subclasses whose
+  # rate changes without the params changing. None waits for params changes.
+  RATE_CHECK_INTERVAL = None
+
+  def __init__(self, name, params, event_log, clock=None):
     self.name = name
+    self.clock = reactor if clock is None else clock
     self.params = params
+    self.cached = params.cached
     self.events = event_log
     self.size = 0
+    self.impairments = impairments.Impairments(self.cached)
 
-  def attempt(self, deliver_callback, drop_callback, size):
+    self.qdisc_index = self.cached.qdisc
+    self.qdisc = qdisc.QDISCS[self.qdisc_index](self)
+
+    # The packet being sent, once it's been taken from the queue discipline.
+    self.head = None
+    self.release_time = None
+    self.tokens = TokenBucket()
+    self.peak_tokens = TokenBucket()
+    self.shaper = None
+
+    # Released packets, in order of delivery time.
+    self.deliveries = collections.deque()
+    self.delivery_times = collections.deque()
+
+    self.timer = None
+    self.timer_deadline = None
+
+    self.latency = monitoring.Histogram(monitoring.METRICS_LATENCY_BOUNDS)
+    self.reset_meter()
+    params.watch(self)
+
+  def reset_meter(self):
+    """Sets all counters, and the latency histogram, to zero."""
+    self.latency.reset()
+    for counter in self.COUNTERS:
+      setattr(self, counter, 0)
+
+  def meter(self):
+    """Returns a consistent snapshot of the counters, as a dictionary.
+
+    Must be called from the reactor thread.
+    """
+    return {counter: getattr(self, counter) for counter in self.COUNTERS}
+
+  def attempt(self, deliver_callback, drop_callback, size, flow=None,
+              payload=None):
     """Possibly invoke a callback representing a packet.
 
     The callback may be invoked later using the Twisted reactor, simulating
     network latency, or it may be ignored entirely, simulating packet loss.
-    """
-    attempt_time = time.time()
 
-    def deliver():
-      delivery_time = time.time()
-      latency = delivery_time - attempt_time
-      self.events.add(delivery_time, self.name, 'deliver', size)
-      self.events.add(delivery_time, self.name, 'latency', latency)
-      deliver_callback()
+    The flow is any hashable value identifying the connection the packet
+    belongs to, for queue disciplines that treat flows separately. The
+    payload is the packet itself, from its IP header, for the capture module.
+    """
+    attempt_time = self.clock.seconds()
+    self.packets_attempted += 1
+    self.bytes_attempted += size
 
-    if self.params['buffer'] > 0 and self.size + size > self.params['buffer']:
+    if self.impairments.lost():
+      self.packets_dropped_loss += 1
+      self.bytes_dropped_loss += size
       self.events.add(attempt_time, self.name, 'drop', size)
+      if capture.writer is not None:
+        capture.writer.add(attempt_time, self.name, 'loss', 0.0, size,
+                           payload)
       drop_callback()
       return
 
-    if random.random() < self.params['loss']:
-      self.events.add(attempt_time, self.name, 'drop', size)
-      drop_callback()
-      return
+    packet = Packet(attempt_time, size, self.impairments.delay(),
+                    deliver_callback, drop_callback, flow, payload)
+    packet.reordered = self.impairments.reordered()
 
+    # Counted first, so the queue discipline sees it in the backlog.
     self.size += size
+    self.qdisc.enqueue(packet, attempt_time)
     self.events.add(attempt_time, self.name, 'buffer', self.size)
 
-    def release_buffer():
-      release_time = time.time()
-      self.size -= size
-      self.events.add(release_time, self.name, 'buffer', self.size)
-
-    # Delay has two components: throttled (proportional to size) and constant.
-    #
-    # Throttle delay is calculated by estimating the time it will take all of
-    # the enqueued packets to be released, including the current one. Release
-    # the current packet (subtract its size) after this period of time.
-    #
-    # After the packet is released, there is an additional period of constant
-    # delay, so schedule a second event to finally call the packet's callback.
-    throttle_delay = 0
-    if self.params['bandwidth'] > 0:
-      throttle_delay = float(self.size) / self.params['bandwidth']
-    constant_delay = self.params['delay']
-
-    reactor.callLater(throttle_delay, release_buffer)
-    reactor.callLater(throttle_delay + constant_delay, deliver)
+    if self.head is None:
+      self._next_head(attempt_time)
+    self._schedule()
+
+  def drop(self, packet, reason):
+    """Invoked by the queue discipline to drop a packet from the buffer.
+
+    Args:
+      packet: a Packet that was counted in the buffer size
+      reason: 'buffer' or 'aqm'
+    """
+    self.size -= packet.size
+    if reason == 'buffer':
+      self.packets_dropped_buffer += 1
+      self.bytes_dropped_buffer += packet.size
+    else:
+      self.packets_dropped_aqm += 1
+      self.bytes_dropped_aqm += packet.size
+    now = self.clock.seconds()
+    self.events.add(now, self.name, 'drop', packet.size)
+    if capture.writer is not None:
+      capture.writer.add(now, self.name, reason, now - packet.attempt_time,
+                         packet.size, packet.payload)
+    packet.drop_callback()
+
+  def over_limit(self):
+    """Returns whether the buffer holds more than the buffer param allows."""
+    buffer = self.cached.buffer
+    return buffer > 0 and self.backlog() > buffer
+
+  def backlog(self):
+    """Returns the number of bytes in the buffer, including a new packet."""
+    return self.size
+
+  def rate(self):
+    """Returns the bandwidth available to this pipe, in bytes per second."""
+    return self.cached.bandwidth
+
+  def params_changed(self):
+    """Invoked by the params after every update."""
+    if self.cached.qdisc != self.qdisc_index:
+      self._change_qdisc()
+    now = self.clock.seconds()
+    if self.head is not None and self.release_time > now:
+      self._recheck_head(now)
+      self._schedule()
+
+  def _change_qdisc(self):
+    """Moves the queued packets to the queue discipline in the params.
+
+    An unknown queue discipline raises ValueError, leaving the packets where
+    they are.
+    """
+    index = self.cached.qdisc
+    check_params({'qdisc': index})
+    new_qdisc = qdisc.QDISCS[index](self)
+    packets = self.qdisc.drain()
+    self.qdisc_index = index
+    self.qdisc = new_qdisc
+    for packet in packets:
+      self.qdisc.push(packet)
+
+  def _refill(self, now):
+    """Brings the token buckets up to a time, and takes up the latest rates."""
+    self.tokens.advance(now, max(0, self.cached.burst))
+    self.peak_tokens.advance(now, 0)
+    self.tokens.rate = self.rate()
+    self.peak_tokens.rate = self.cached.peak_rate
+
+  def _next_head(self, now):
+    """Takes the next packet to send from the queue discipline, if any, and
+    charges it to the token buckets.
+    """
+    self.head = self.qdisc.dequeue(now)
+    if self.head is None:
+      return
+    if self.shaper is not None:
+      self.release_time = self.shaper.release_time(now, self.head.size)
+      return
+    self._refill(now)
+    self.tokens.charge(self.head.size)
+    self.peak_tokens.charge(self.head.size)
+    self.release_time = now + max(self.tokens.wait(), self.peak_tokens.wait())
+
+  def _recheck_head(self, now):
+    """Works out the head's release time again, in case the rates changed."""
+    if self.shaper is not None:
+      return
+    self._refill(now)
+    self.release_time = now + max(self.tokens.wait(), self.peak_tokens.wait())
+
+  def _schedule(self):
+    """Makes sure the timer fires no later than the earliest deadline."""
+    now = self.clock.seconds()
+    deadlines = []
+    if self.head is not None:
+      if self.shaper is None and self.RATE_CHECK_INTERVAL:
+        deadlines.append(
+            min(self.release_time, now + self.RATE_CHECK_INTERVAL))
+      else:
+        deadlines.append(self.release_time)
+    if self.deliveries:
+      deadlines.append(self.delivery_times[0])
+    if not deadlines:
+      return
+    deadline = min(deadlines)
+
+    if self.timer is not None:
+      if self.timer_deadline <= deadline:
+        return
+      self.timer.cancel()
+
+    self.timer_deadline = deadline
+    self.timer = self.clock.callLater(max(0, deadline - now), self._on_timer)
+
+  def _on_timer(self):
+    """Releases and delivers every packet whose deadline has passed.
+
+    Packets are released at the time the token buckets allowed, even if the
+    timer fires late, so a late timer doesn't lower the bandwidth.
+    """
+    self.timer = None
+    now = self.clock.seconds()
+
+    if self.head is not None and self.release_time > now:
+      self._recheck_head(now)
+    reordered = []
+    while self.head is not None and self.release_time <= now:
+      release_time = self.release_time
+      packet = self.head
+      self.size -= packet.size
+      self.events.add(now, self.name, 'buffer', self.size)
+
+      if packet.reordered:
+        reordered.append(packet)
+      else:
+        delivery_time = release_time + packet.delay
+        if self.deliveries:
+          delivery_time = max(delivery_time, self.delivery_times[-1])
+        self.deliveries.append(packet)
+        self.delivery_times.append(delivery_time)
+
+      self._next_head(release_time)
+
+    for packet in reordered:
+      self._deliver(packet, now)
+    deliveries = self.deliveries
+    delivery_times = self.delivery_times
+    while deliveries and delivery_times[0] <= now:
+      delivery_times.popleft()
+      self._deliver(deliveries.popleft(), now)
+
+    self._schedule()
+
+  def _deliver(self, packet, now):
+    """Counts a packet as delivered, and invokes its callback."""
+    latency = now - packet.attempt_time
+    self.packets_delivered += 1
+    self.bytes_delivered += packet.size
+    self.latency.add(latency)
+    self.events.add(now, self.name, 'deliver', packet.size)
+    self.events.add(now, self.name, 'latency', latency)
+    if capture.writer is not None:
+      delay = 0.0 if packet.reordered else packet.delay
+      capture.writer.add(now, self.name, 'delivered',
+                         max(0.0, latency - delay), packet.size,
+                         packet.payload)
+    packet.deliver_callback()
+    if self.impairments.duplicated():
+      packet.deliver_callback()
@@ -0,0 +1,296 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Network simulation adapter using a user-level TCP proxy.
+
+Each connection to the proxy port is relayed to the server over a connection
+of its own. The bytes going each way are cut into segments, which go through
+a pipe like packets do. Segments lost to the pipe are sent again after a
+retransmission timeout, and segments are written out in order, so a loss
+holds up the rest of the stream as it would with TCP.
+
+A connection only has a window of bytes in flight each way. When the window
+is full, or the other side's transport is buffering too much, the proxy stops
+reading from the sender, leaving the kernel's flow control to slow it down.
+"""
+import socket
+
+from twisted.internet import interfaces
+from twisted.internet import protocol
+from twisted.internet import reactor
+from zope.interface import implementer
+
+
+# Header bytes in each TCP segment. Used for bandwidth estimation.
+OVERHEAD = 40
+
+# Max payload bytes per segment: an Ethernet MTU's worth.
+SEGMENT_SIZE = 1460
+
+# Max bytes in flight each way per connection.
+WINDOW = 65536
+
+# Min seconds before a lost segment is sent again.
+MIN_RETRANSMIT_TIMEOUT = 0.2
+
+
+def configure(port, proxy_port, pipes, workers=1, block=None,
+              reuse_port=False):
+  """Starts a TCP proxy server on localhost.
+
+  Returns the proxy port number, which is the same as the proxy_port param
+  unless zero is passed in.
+
+  Workers work as they do for udp_proxy.configure.
+  """
+  if workers > 1:
+    if not proxy_port:
+      raise ValueError('Workers need a fixed proxy port.', proxy_port)
+    from packet_queue import workers as worker_processes
+    worker_processes.spawn('tcp', block, workers, {
+        'port': port,
+        'proxy_port': proxy_port,
+    })
+    return proxy_port
+
+  factory = ProxyServerFactory(port, pipes)
+  if reuse_port:
+    from packet_queue import udp_proxy
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, udp_proxy.SO_REUSEPORT, 1)
+    sock.setblocking(False)
+    sock.bind(('', proxy_port))
+    sock.listen(socket.SOMAXCONN)
+    listener = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()  # The reactor has its own copy of the descriptor.
+  else:
+    listener = reactor.listenTCP(proxy_port, factory)
+  return listener.getHost().port
+
+
+@implementer(interfaces.IPushProducer)
+class Stream(object):
+  """Relays the bytes going one way through a connection, via a pipe.
+
+  Reading from the source transport is paused while the window is full, and
+  while the sink transport asks its producer to pause. Once the source has
+  finished and every byte has been written, the sink's write side is closed
+  and done_callback is invoked.
+  """
+
+  def __init__(self, pipe, source, sink, done_callback, flow=None,
+               segment_size=SEGMENT_SIZE, window=WINDOW):
+    self.pipe = pipe
+    self.flow = flow
+    self.source = source
+    self.sink = sink
+    self.done_callback = done_callback
+    self.segment_size = segment_size
+    self.window = window
+
+    self.next_sent = 0  # Sequence number of the next segment.
+    self.next_written = 0  # Sequence number of the next segment to write.
+    self.arrived = {}  # Segments that made it through, waiting for a gap.
+    self.in_flight = 0
+
+    self.sink_paused = False
+    self.source_paused = False
+    self.finished = False
+    self.done = False
+    sink.registerProducer(self, True)
+
+  def write(self, data):
+    """Takes bytes read from the source."""
+    for offset in range(0, len(data), self.segment_size):
+      segment = data[offset:offset + self.segment_size]
+      self.in_flight += len(segment)
+      self._send(self.next_sent, segment)
+      self.next_sent += 1
+    self._update_source()
+
+  def finish(self):
+    """Marks the end of the source's bytes."""
+    self.finished = True
+    if not self.in_flight:
+      self._close()
+
+  def abort(self):
+    """Gives up on the bytes in flight, if the sink can't take them."""
+    self.arrived.clear()
+    self.in_flight = 0
+    self.finished = True
+    self._close(shut_down_sink=False)
+
+  def _close(self, shut_down_sink=True):
+    if self.done:
+      return
+    self.done = True
+    self.sink.unregisterProducer()
+    if shut_down_sink:
+      self.sink.loseWriteConnection()
+    self.done_callback()
+
+  def _send(self, sequence, segment):
+    def deliver():
+      self._arrive(sequence, segment)
+    def retransmit():
+      self._send(sequence, segment)
+    def drop():
+      reactor.callLater(self._retransmit_timeout(), retransmit)
+    if not self.done:
+      self.pipe.attempt(deliver, drop, len(segment) + OVERHEAD, self.flow)
+
+  def _retransmit_timeout(self):
+    # Roughly a round trip: the delay param applies to both directions.
+    return max(MIN_RETRANSMIT_TIMEOUT, 2 * self.pipe.cached.delay)
+
+  def _arrive(self, sequence, segment):
+    if self.done or sequence < self.next_written:
+      return  # Also ignores duplicates of segments already written.
+    self.arrived[sequence] = segment
+    while self.next_written in self.arrived:
+      segment = self.arrived.pop(self.next_written)
+      self.next_written += 1
+      self.in_flight -= len(segment)
+      self.sink.write(segment)
+
+    if self.finished and not self.in_flight:
+      self._close()
+    else:
+      self._update_source()
+
+  def _update_source(self):
+    paused = self.sink_paused or self.in_flight >= self.window
+    if paused and not self.source_paused:
+      self.source.pauseProducing()
+    elif self.source_paused and not paused:
+      self.source.resumeProducing()
+    self.source_paused = paused
+
+  def pauseProducing(self):
+    """Invoked by Twisted when the sink's write buffer is full."""
+    self.sink_paused = True
+    self._update_source()
+
+  def resumeProducing(self):
+    """Invoked by Twisted when the sink's write buffer has drained."""
+    self.sink_paused = False
+    self._update_source()
+
+  def stopProducing(self):
+    """Invoked by Twisted when the sink is closed."""
+
+
+@implementer(interfaces.IHalfCloseableProtocol)
+class ProxyServer(protocol.Protocol):
+  """Accepts a connection from a client, and relays it to the server.
+
+  Nothing is read from the client until the connection to the server is
+  made. Both connections are closed once both streams are done.
+  """
+
+  def __init__(self, port, pipes):
+    self.port = port
+    self.pipes = pipes
+    self.proxy_client = None
+    self.up = None
+    self.down = None
+    self.closed = False
+
+  def connectionMade(self):
+    """Invoked by Twisted."""
+    self.transport.pauseProducing()
+    factory = protocol.ClientFactory()
+    factory.protocol = lambda: ProxyClient(self)
+    factory.clientConnectionFailed = (
+        lambda connector, reason: self.transport.loseConnection())
+    reactor.connectTCP('127.0.0.1', self.port, factory)
+
+  def Connected(self, proxy_client):
+    """Invoked by ProxyClient when the connection to the server is made."""
+    if self.closed:
+      proxy_client.transport.loseConnection()
+      return
+    self.proxy_client = proxy_client
+    # Both streams belong to the flow of this connection.
+    self.up = Stream(self.pipes.up, self.transport, proxy_client.transport,
+                     self.StreamDone, flow=self)
+    self.down = Stream(self.pipes.down, proxy_client.transport,
+                       self.transport, self.StreamDone, flow=self)
+    self.transport.resumeProducing()
+
+  def StreamDone(self):
+    """Invoked by either Stream when it is done."""
+    if self.up.done and self.down.done:
+      self.transport.loseConnection()
+      self.proxy_client.transport.loseConnection()
+
+  def dataReceived(self, data):
+    """Invoked by Twisted."""
+    self.up.write(data)
+
+  def readConnectionLost(self):
+    """Invoked by Twisted when the client closes its write side."""
+    self.up.finish()
+
+  def writeConnectionLost(self):
+    """Invoked by Twisted."""
+
+  def connectionLost(self, reason):
+    """Invoked by Twisted."""
+    self.closed = True
+    if self.up:
+      self.up.finish()
+      self.down.abort()
+
+
+@implementer(interfaces.IHalfCloseableProtocol)
+class ProxyClient(protocol.Protocol):
+  """Connection from the proxy to the server, on behalf of a client."""
+
+  def __init__(self, proxy_server):
+    self.proxy_server = proxy_server
+
+  def connectionMade(self):
+    """Invoked by Twisted."""
+    self.proxy_server.Connected(self)
+
+  def dataReceived(self, data):
+    """Invoked by Twisted."""
+    self.proxy_server.down.write(data)
+
+  def readConnectionLost(self):
+    """Invoked by Twisted when the server closes its write side."""
+    self.proxy_server.down.finish()
+
+  def writeConnectionLost(self):
+    """Invoked by Twisted."""
+
+  def connectionLost(self, reason):
+    """Invoked by Twisted."""
+    if self.proxy_server.down:
+      self.proxy_server.down.finish()
+      self.proxy_server.up.abort()
+
+
+class ProxyServerFactory(protocol.ServerFactory):
+  """Makes a ProxyServer for each connection to the proxy port."""
+
+  def __init__(self, port, pipes):
+    self.port = port
+    self.pipes = pipes
+
+  def buildProtocol(self, address):
+    return ProxyServer(self.port, self.pipes)
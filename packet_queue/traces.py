@@ -0,0 +1,267 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replays recorded link conditions.
+
+Two kinds of traces are supported:
+
+  - Mahimahi packet delivery traces, which replace a pipe's bandwidth. Each
+    line is a time in milliseconds at which the link can send MTU bytes; a
+    time repeated on several lines gives several opportunities. The trace
+    repeats, with a period of its last time.
+  - CSV params traces, which change params over time. The header row names
+    "time" (seconds from the start) and then any params, and each row sets
+    those params at its time.
+
+Trace files are memory-mapped and read a line at a time as they're needed,
+so they can be larger than memory. Delivery traces cost the same to start
+whatever their length, and after an idle gap they find their place with a
+binary search of the file; params traces are checked row by row when they're
+loaded. Blank lines and lines starting with # are skipped.
+"""
+import mmap
+import os
+
+from twisted.internet import reactor
+
+from . import simulation
+
+
+MTU = 1500  # Bytes per delivery opportunity, as in Mahimahi.
+
+
+class TraceFile(object):
+  """Reads the lines of a memory-mapped file, from a cursor."""
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      if not size:
+        raise ValueError('Trace file is empty.', path)
+      self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self.path = path
+    self.cursor = 0
+
+  def next_line(self):
+    """Returns the next line worth reading, or None at the end of the file."""
+    while self.cursor < len(self.mmap):
+      end = self.mmap.find('\n', self.cursor)
+      if end < 0:
+        end = len(self.mmap)
+      line = self.mmap[self.cursor:end].strip()
+      self.cursor = end + 1
+      if line and not line.startswith('#'):
+        return line
+    return None
+
+  def seek(self, target, key, start=0):
+    """Moves the cursor to the first line from start whose key is at least
+    target, or to the end of the file, by binary search.
+
+    Args:
+      target: value to look for
+      key: function of a line, which mustn't decrease through the file
+      start: offset of the first line to consider
+    """
+    # Every line before low has a key below target, and so does none of the
+    # lines worth reading from high on.
+    low, high = start, len(self.mmap)
+    while low < high:
+      middle = (low + high) // 2
+      begin = self.mmap.rfind('\n', low, middle) + 1 or low
+      self.cursor = begin
+      line = self.next_line()
+      if line is None or key(line) >= target:
+        high = begin
+      else:
+        low = self.cursor
+    self.cursor = low
+
+  def last_line(self):
+    """Returns the last line worth reading, without moving the cursor."""
+    end = len(self.mmap)
+    while end > 0:
+      start = self.mmap.rfind('\n', 0, end - 1) + 1
+      line = self.mmap[start:end].strip()
+      if line and not line.startswith('#'):
+        return line
+      end = start
+    return None
+
+
+class DeliveryTrace(object):
+  """A Mahimahi packet delivery trace, repeated forever."""
+
+  def __init__(self, path):
+    self.file = TraceFile(path)
+    last = self.file.last_line()
+    if last is None:
+      raise ValueError('Trace has no delivery opportunities.', path)
+    self.period = max(1, int(last))  # Milliseconds.
+    self.base = 0  # Milliseconds added to the times read in this period.
+
+  def next(self):
+    """Returns the time of the next opportunity, in milliseconds."""
+    line = self.file.next_line()
+    if line is None:
+      self.file.cursor = 0
+      self.base += self.period
+      line = self.file.next_line()
+    return self.base + int(line)
+
+  def skip(self, milliseconds):
+    """Moves ahead so that next returns the first opportunity at or after a
+    time, which mustn't be earlier than the last one returned.
+    """
+    self.base = int(milliseconds // self.period) * self.period
+    self.file.seek(milliseconds - self.base, int)
+
+
+class DeliveryShaper(object):
+  """Decides when a pipe releases packets, following a DeliveryTrace.
+
+  A packet leaves at the opportunity that brings the bytes sent for it up to
+  its size. Bytes left over at an opportunity can go to the next packet, if
+  that's released at the same time; otherwise they're wasted, as are the
+  opportunities that pass while the pipe is empty.
+  """
+
+  def __init__(self, trace, start_time):
+    self.trace = trace
+    self.start_time = start_time
+    self.opportunity = start_time  # Time of the current opportunity.
+    self.remaining = 0  # Bytes left to send at the current opportunity.
+
+  def _advance(self):
+    self.opportunity = self.start_time + self.trace.next() / 1000.0
+    self.remaining = MTU
+
+  def release_time(self, now, size):
+    """Returns the time a packet that reached the head of the buffer at now
+    will be released.
+    """
+    if self.opportunity < now:
+      self.remaining = 0
+      self.trace.skip((now - self.start_time) * 1000)
+      while self.opportunity < now:
+        self._advance()
+
+    while size > self.remaining:
+      size -= self.remaining
+      self._advance()
+    self.remaining -= size
+    return self.opportunity
+
+
+class ParamsTrace(object):
+  """Sets params at the times given by a CSV trace.
+
+  With loop, the trace starts over at the time of its last row. Timers are
+  set on the clock, the Twisted reactor by default.
+  """
+
+  def __init__(self, path, params, loop=False, clock=None):
+    self.file = TraceFile(path)
+    self.params = params
+    self.loop = loop
+    self.clock = reactor if clock is None else clock
+
+    header = self.file.next_line()
+    columns = [column.strip() for column in (header or '').split(',')]
+    if columns[0] != 'time':
+      raise ValueError('Params trace must start with a time column.', path)
+    for key in columns[1:]:
+      if key not in params:
+        raise ValueError('Unknown param in trace.', key)
+    self.keys = columns[1:]
+    self.data_start = self.file.cursor
+    self._check_rows()
+
+    last = self.file.last_line()
+    self.period = float(last.split(',')[0]) if last != header else 0.0
+    self.start_time = None
+    self.timer = None
+
+  def start(self):
+    """Starts setting params, with the first row's time counted from now."""
+    self.start_time = self.clock.seconds()
+    self._schedule_next()
+
+  def stop(self):
+    if self.timer and self.timer.active():
+      self.timer.cancel()
+    self.timer = None
+
+  def _parse(self, line):
+    fields = [field.strip() for field in line.split(',')]
+    values = {}
+    for key, field in zip(self.keys, fields[1:]):
+      if field:
+        values[key] = type(self.params[key])(float(field))
+    return float(fields[0]), values
+
+  def _check_rows(self):
+    """Raises ValueError, giving the line number, for the first row that
+    can't be parsed or that sets a param out of range.
+    """
+    mmap = self.file.mmap
+    number = mmap[:self.data_start].count('\n')
+    mmap.seek(min(self.data_start, len(mmap)))
+    for line in iter(mmap.readline, ''):
+      number += 1
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      try:
+        simulation.check_params(self._parse(line)[1])
+      except ValueError as e:
+        raise ValueError('Bad row in params trace, line {}: {}'.format(
+            number, e), self.file.path)
+
+  def _schedule_next(self):
+    line = self.file.next_line()
+    if line is None:
+      if not self.loop or self.period <= 0:
+        self.timer = None
+        return
+      self.file.cursor = self.data_start
+      self.start_time += self.period
+      line = self.file.next_line()
+
+    offset, values = self._parse(line)
+    def apply_row():
+      self.params.update(values)
+      self._schedule_next()
+    delay = max(0, self.start_time + offset - self.clock.seconds())
+    self.timer = self.clock.callLater(delay, apply_row)
+
+
+def configure(pipes, params, uplink=None, downlink=None, params_trace=None,
+              loop=False, clock=None):
+  """Starts replaying traces, given their paths.
+
+  Returns the ParamsTrace, if there is one.
+  """
+  if clock is None:
+    clock = reactor
+  now = clock.seconds()
+  if uplink:
+    pipes.up.shaper = DeliveryShaper(DeliveryTrace(uplink), now)
+  if downlink:
+    pipes.down.shaper = DeliveryShaper(DeliveryTrace(downlink), now)
+  if params_trace:
+    player = ParamsTrace(params_trace, params, loop, clock)
+    player.start()
+    return player
+  return None
@@ -13,9 +13,16 @@
 # limitations under the License.
 
 """Network simulation adapter using a user-level UDP proxy."""
+import collections
+import socket
+
+from twisted.internet import abstract
 from twisted.internet import protocol
 from twisted.internet import reactor
 
+from packet_queue import capture
+from packet_queue import mmsg
+
 
 # Header bytes in each UDP packet. Used for bandwidth estimation.
 OVERHEAD = 28
@@ -25,15 +32,58 @@ OVERHEAD = 28
 DROP = lambda: None
 
 
-def configure(port, proxy_port, pipes):
+# Max number of batches of datagrams read from a socket per read event.
+MAX_BATCHES_PER_READ = 8
+
+# Defaults for the table of client addresses the proxy relays for.
+MAX_FLOWS = 1000
+FLOW_TIMEOUT = 120.0  # Seconds without packets in either direction.
+
+# Not defined by the socket module before Python 3.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def configure(port, proxy_port, pipes, batch_io=False, max_flows=MAX_FLOWS,
+              flow_timeout=FLOW_TIMEOUT, workers=1, block=None,
+              reuse_port=False):
   """Starts a UDP proxy server on localhost.
 
   Returns the proxy port number, which is the same as the proxy_port param
   unless zero is passed in.
+
+  With batch_io, each socket reads and writes many datagrams per system call.
+
+  With more than one worker, the proxy runs in worker processes that all
+  bind proxy_port with SO_REUSEPORT, so the kernel spreads client addresses
+  across them. As with nfqueue workers, pipes are ignored: each worker builds
+  its own from the shared.SharedBlock passed as block.
   """
-  server = ProxyServer(port, pipes)
-  port = reactor.listenUDP(proxy_port, server.udp)
-  return port.getHost().port
+  if workers > 1:
+    if not proxy_port:
+      raise ValueError('Workers need a fixed proxy port.', proxy_port)
+    from packet_queue import workers as worker_processes
+    worker_processes.spawn('udp', block, workers, {
+        'port': port,
+        'proxy_port': proxy_port,
+        'batch_io': batch_io,
+        'max_flows': max_flows,
+        'flow_timeout': flow_timeout,
+    })
+    return proxy_port
+
+  server = ProxyServer(port, pipes, BatchedUDP if batch_io else UDP,
+                       max_flows=max_flows, flow_timeout=flow_timeout)
+  return server.udp.listen(proxy_port, reuse_port)
+
+
+def bind(port, reuse_port=False):
+  """Returns a non-blocking UDP socket bound to a port on all interfaces."""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  if reuse_port:
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+  sock.setblocking(False)
+  sock.bind(('', port))
+  return sock
 
 
 class UDP(protocol.DatagramProtocol):
@@ -44,15 +94,100 @@ class UDP(protocol.DatagramProtocol):
   """
   def __init__(self, receiver):
     self.receiver = receiver
+    self.port = None
+
+  def listen(self, port, reuse_port=False):
+    """Starts listening, and returns the port number listened on.
+
+    With reuse_port, other sockets can bind the same port at the same time.
+    """
+    if reuse_port:
+      sock = bind(port, reuse_port)
+      self.port = reactor.adoptDatagramPort(sock.fileno(), socket.AF_INET,
+                                            self)
+      sock.close()  # The reactor has its own copy of the descriptor.
+    else:
+      self.port = reactor.listenUDP(port, self)
+    return self.port.getHost().port
+
+  def close(self):
+    """Stops listening. Later calls to Send are ignored."""
+    self.port.stopListening()
+    self.port = None
 
   def Send(self, data, address):
-    self.transport.write(data, address)
+    if self.port:
+      self.transport.write(data, address)
 
   def datagramReceived(self, *args):
     """Invoked by Twisted."""
     self.receiver(*args)
 
 
+class BatchedUDP(object):
+  """Drop-in replacement for UDP that batches system calls.
+
+  Each read event drains the socket, up to MAX_BATCHES_PER_READ batches of
+  datagrams, using recvmmsg where available. Datagrams sent during one
+  reactor tick are written together at the start of the next, using
+  sendmmsg where available.
+  """
+
+  receive_buffers = None  # mmsg.Receiver shared by all instances.
+
+  def __init__(self, receiver):
+    self.receiver = receiver
+    self.socket = None
+    self.outgoing = []
+    self.dropped = 0  # Datagrams the socket didn't take.
+
+  def listen(self, port, reuse_port=False):
+    """Starts listening, and returns the port number listened on.
+
+    With reuse_port, other sockets can bind the same port at the same time.
+    """
+    if BatchedUDP.receive_buffers is None:
+      BatchedUDP.receive_buffers = mmsg.Receiver()
+
+    self.socket = bind(port, reuse_port)
+
+    self.reader = abstract.FileDescriptor()
+    self.reader.doRead = self.doRead
+    self.reader.fileno = self.socket.fileno
+    reactor.addReader(self.reader)
+    return self.socket.getsockname()[1]
+
+  def close(self):
+    """Stops listening. Later calls to Send are ignored."""
+    reactor.removeReader(self.reader)
+    self.socket.close()
+    self.socket = None
+    self.outgoing = []
+
+  def doRead(self):
+    """Invoked by Twisted when the socket is readable."""
+    buffers = BatchedUDP.receive_buffers
+    for _ in range(MAX_BATCHES_PER_READ):
+      datagrams = buffers.receive(self.socket)
+      for data, address in datagrams:
+        self.receiver(data, address)
+      if len(datagrams) < buffers.size:
+        break
+
+  def Send(self, data, address):
+    if not self.socket:
+      return
+    if not self.outgoing:
+      reactor.callLater(0, self.flush)
+    self.outgoing.append((data, address))
+
+  def flush(self):
+    outgoing = self.outgoing
+    self.outgoing = []
+    if self.socket:
+      self.dropped += len(outgoing) - mmsg.send(self.socket, outgoing)
+
+
 class ProxyServer(object):
   """Proxies a UDP server. Incoming packets are from clients.
 
@@ -60,12 +195,21 @@ class ProxyServer(object):
   as a proxy client for the server. This is so that the port for an incoming
   packet from the server can be used to determine which client it should be
   relayed to.
+
+  Proxy clients are kept in least recently used order. A client is closed
+  when no packets have gone either way for flow_timeout seconds, or when a
+  new client would exceed max_flows; None means no limit.
   """
-  def __init__(self, port, pipes):
-    self.udp = UDP(self.Receive)
+  def __init__(self, port, pipes, udp_class=UDP, max_flows=None,
+               flow_timeout=None):
+    self.udp_class = udp_class
+    self.udp = udp_class(self.Receive)
     self.server_address = ('127.0.0.1', port)
-    self.proxy_clients = {}
+    self.proxy_clients = collections.OrderedDict()
     self.pipes = pipes
+    self.max_flows = max_flows
+    self.flow_timeout = flow_timeout
+    self.expiry_scheduled = False
 
   def Receive(self, data, address):
     """Invoked by Twisted when a packet arrives at the client-facing port.
@@ -75,36 +219,82 @@ class ProxyServer(object):
     proxy_client = self._GetProxyClient(address)
     def callback():
       proxy_client.udp.Send(data, self.server_address)
-    self.pipes.up.attempt(callback, DROP, len(data) + OVERHEAD)
+    payload = None
+    if capture.writer is not None:
+      payload = capture.udp_packet(address, self.server_address, data)
+    self.pipes.up.attempt(callback, DROP, len(data) + OVERHEAD, address,
+                          payload)
 
   def _GetProxyClient(self, address):
     """Gets a proxy client for a given client address.
 
     Returns the new proxy client, or an existing one if the address has been
-    used before.
+    used recently.
     """
-    if address in self.proxy_clients:
-      proxy_client = self.proxy_clients[address]
-    else:
-      proxy_client = ProxyClient(self, address)
-      self.proxy_clients[address] = proxy_client
-      reactor.listenUDP(0, proxy_client.udp)
+    proxy_client = self.proxy_clients.get(address)
+    if proxy_client:
+      self.Touch(proxy_client)
+      return proxy_client
+
+    if self.max_flows and len(self.proxy_clients) >= self.max_flows:
+      _, oldest = self.proxy_clients.popitem(last=False)
+      oldest.udp.close()
+
+    proxy_client = ProxyClient(self, address)
+    proxy_client.last_active = reactor.seconds()
+    self.proxy_clients[address] = proxy_client
+    proxy_client.udp.listen(0)
+
+    if self.flow_timeout and not self.expiry_scheduled:
+      self.expiry_scheduled = True
+      reactor.callLater(self.flow_timeout, self._ExpireIdle)
 
     return proxy_client
 
+  def Touch(self, proxy_client):
+    """Marks a proxy client as the most recently used."""
+    proxy_client.last_active = reactor.seconds()
+    del self.proxy_clients[proxy_client.relay_address]
+    self.proxy_clients[proxy_client.relay_address] = proxy_client
+
+  def _ExpireIdle(self):
+    """Closes idle proxy clients, oldest first, and checks again later."""
+    self.expiry_scheduled = False
+    deadline = reactor.seconds() - self.flow_timeout
+    while self.proxy_clients:
+      address, proxy_client = next(self.proxy_clients.iteritems())
+      if proxy_client.last_active > deadline:
+        break
+      del self.proxy_clients[address]
+      proxy_client.udp.close()
+
+    if self.proxy_clients:
+      self.expiry_scheduled = True
+      oldest = next(self.proxy_clients.itervalues())
+      delay = oldest.last_active + self.flow_timeout - reactor.seconds()
+      reactor.callLater(max(0, delay), self._ExpireIdle)
+
 
 class ProxyClient(object):
   """Proxies a UDP client. Incoming packets are from the server."""
   def __init__(self, proxy_server, relay_address):
-    self.udp = UDP(self.Receive)
+    self.udp = proxy_server.udp_class(self.Receive)
     self.proxy_server = proxy_server
     self.relay_address = relay_address
+    self.last_active = None
 
   def Receive(self, data, ignore_address):
     """Invoked by Twisted when a packet arrives from the server.
 
     Relays the packet to the actual client, via ProxyServer.
     """
+    if self.proxy_server.proxy_clients.get(self.relay_address) is self:
+      self.proxy_server.Touch(self)
     def callback():
       self.proxy_server.udp.Send(data, self.relay_address)
-    self.proxy_server.pipes.down.attempt(callback, DROP, len(data) + OVERHEAD)
+    payload = None
+    if capture.writer is not None:
+      payload = capture.udp_packet(self.proxy_server.server_address,
+                                   self.relay_address, data)
+    self.proxy_server.pipes.down.attempt(callback, DROP, len(data) + OVERHEAD,
+                                         self.relay_address, payload)
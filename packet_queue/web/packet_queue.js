@@ -57,6 +57,10 @@ var byteCount = {
   }
 };
 
+// Id of the next event to request when polling. Keeping our own cursor lets
+// several pages watch the same server without taking each other's events.
+var eventsCursor = 0;
+
 var toMillis = function(seconds) {
   return Math.floor(seconds * 1000);
 };
@@ -64,15 +68,25 @@ var toMillis = function(seconds) {
 var requestNewEvents = function() {
   var xhr = new XMLHttpRequest();
   xhr.responseType = 'json';
-  xhr.open('GET', '/events');
-  xhr.onload = onNewEvents;
+  xhr.open('GET', '/events?cursor=' + eventsCursor);
+  xhr.onload = function() {
+    onNewEvents(this.response);
+  };
   xhr.send();
 };
 
-var onNewEvents = function() {
-  var events = this.response.events;
-  var serverTime = toMillis(this.response.now);
+var streamEvents = function() {
+  var source = new EventSource('/events/stream');
+  source.onmessage = function(message) {
+    onNewEvents(JSON.parse(message.data));
+  };
+};
+
+var onNewEvents = function(response) {
+  var events = response.events;
+  var serverTime = toMillis(response.now);
   var timeDiff = Date.now() - serverTime;
+  eventsCursor = response.cursor;
 
   for (var i = 0; i < events.length; i++) {
     var e = events[i];
@@ -112,7 +126,11 @@ var initGraphs = function() {
     }
   }
 
-  setInterval(requestNewEvents, 1000);
+  if (window.EventSource) {
+    streamEvents();
+  } else {
+    setInterval(requestNewEvents, 1000);
+  }
 };
 
 var onParamsSubmit = function(event) {
@@ -122,8 +140,15 @@ var onParamsSubmit = function(event) {
   var params = {
     bandwidth: parseInt(this.elements.bandwidth.value),
     buffer: parseInt(this.elements.buffer.value),
+    burst: parseInt(this.elements.burst.value),
     delay: parseFloat(this.elements.delay.value),
-    loss: parseFloat(this.elements.loss.value)
+    loss: parseFloat(this.elements.loss.value),
+    jitter: parseFloat(this.elements.jitter.value),
+    jitter_distribution: parseInt(this.elements.jitter_distribution.value),
+    reorder: parseFloat(this.elements.reorder.value),
+    duplicate: parseFloat(this.elements.duplicate.value),
+    peak_rate: parseInt(this.elements.peak_rate.value),
+    qdisc: parseInt(this.elements.qdisc.value)
   };
 
   var xhr = new XMLHttpRequest();
@@ -142,6 +167,9 @@ var onParamsResponse = function() {
       var value = response[key];
       var inputElement = document.getElementById('param-' + key);
       var valueElement = document.getElementById('param-value-' + key);
+      if (!inputElement) {
+        continue;  // A param without a row in the form.
+      }
       inputElement.value = value;
       valueElement.textContent = value;
     }
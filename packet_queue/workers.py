@@ -0,0 +1,180 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Worker processes that share the work of simulating one link.
+
+Workers are started as fresh interpreters rather than forked, since a forked
+child would share the parent's reactor. They find the shared params and
+occupancy slots through the path of a shared.SharedBlock, and publish their
+counters there for the parent's API server.
+"""
+
+import argparse
+import json
+import os
+import select
+import subprocess
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet import task
+
+from . import impairments
+from . import monitoring
+from . import shared
+from . import simulation
+
+
+KINDS = ['nfqueue', 'tcp', 'udp']
+
+# Seconds between writes of each worker's counters to the shared block.
+PUBLISH_INTERVAL = 0.1
+
+# Seconds between checks for params updated by the process serving the API.
+PARAMS_POLL_INTERVAL = 0.005
+
+# Seconds spawn waits for every worker to report that it's ready.
+READY_TIMEOUT = 10.0
+
+
+def spawn(kind, block, workers, options, timeout=READY_TIMEOUT):
+  """Starts worker processes, and stops them when the reactor shuts down.
+
+  Returns once every worker has bound its queues or sockets, so callers can
+  go on to send packets their way.
+
+  Args:
+    kind: adapter run by each worker, one of KINDS
+    block: shared.SharedBlock holding the params, occupancy and stats slots
+    workers: number of worker processes
+    options: JSON-serializable keyword arguments for the adapter
+    timeout: seconds to wait for the workers to be ready
+
+  Raises:
+    RuntimeError if a worker exits or isn't ready in time
+  """
+  # Each worker writes a byte to this pipe once it's ready. The write end is
+  # inherited, since Popen leaves file descriptors open by default.
+  ready, ready_write = os.pipe()
+  processes = []
+  for worker in range(workers):
+    command = [
+        sys.executable, '-m', 'packet_queue.workers', kind,
+        '--block', block.path,
+        '--workers', str(workers),
+        '--worker', str(worker),
+        '--options', json.dumps(options),
+        '--ready_fd', str(ready_write),
+    ]
+    if impairments.SEED is not None:
+      # Each worker gets a seed of its own, so they don't all draw the same
+      # random numbers.
+      command += ['--seed', str(impairments.SEED + worker)]
+    processes.append(subprocess.Popen(command))
+  os.close(ready_write)
+
+  def stop():
+    for process in processes:
+      if process.poll() is None:
+        process.terminate()
+    for process in processes:
+      process.wait()
+    block.remove()
+
+  try:
+    started = wait_ready(ready, processes, timeout)
+  finally:
+    os.close(ready)
+  if not started:
+    stop()
+    raise RuntimeError('Worker processes failed to start.')
+  reactor.addSystemEventTrigger('before', 'shutdown', stop)
+  return processes
+
+
+def wait_ready(ready, processes, timeout):
+  """Returns whether every process wrote its byte to the ready pipe before
+  timeout seconds passed, and before any of them exited.
+  """
+  deadline = time.time() + timeout
+  count = 0
+  while count < len(processes):
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      return False
+    readable, _, _ = select.select([ready], [], [], min(remaining, 0.1))
+    if readable:
+      data = os.read(ready, len(processes) - count)
+      if not data:  # Every write end is closed.
+        return False
+      count += len(data)
+    elif any(process.poll() is not None for process in processes):
+      return False
+  return True
+
+
+def watch_parent(parent_pid):
+  """Stops the reactor if the process that started this one goes away."""
+  def check():
+    if os.getppid() != parent_pid:
+      reactor.stop()
+  loop = task.LoopingCall(check)
+  loop.start(1.0, now=False)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('kind', choices=KINDS)
+  parser.add_argument('--block', required=True)
+  parser.add_argument('--workers', type=int, required=True)
+  parser.add_argument('--worker', type=int, required=True)
+  parser.add_argument('--options', default='{}')
+  parser.add_argument('--seed', type=int)
+  parser.add_argument('--ready_fd', type=int)
+  args = parser.parse_args()
+
+  if args.seed is not None:
+    impairments.seed(args.seed)
+
+  block = shared.SharedBlock(args.block, simulation.Pipe.PARAMS, args.workers)
+  pipes = shared.SharedPipePair(block, monitoring.EventLog(), args.worker)
+  options = {str(k): v for (k, v) in json.loads(args.options).items()}
+
+  if args.kind == 'nfqueue':
+    from . import nfqueue # Makes imports that only work on Linux.
+    nfqueue.listen(pipes,
+                   nfqueue.UP_QUEUE_BALANCE + args.worker,
+                   nfqueue.DOWN_QUEUE_BALANCE + args.worker,
+                   **options)
+  elif args.kind == 'tcp':
+    from . import tcp_proxy
+    tcp_proxy.configure(pipes=pipes, reuse_port=True, **options)
+  elif args.kind == 'udp':
+    from . import udp_proxy
+    udp_proxy.configure(pipes=pipes, reuse_port=True, **options)
+
+  poller = task.LoopingCall(block.params.poll)
+  poller.start(PARAMS_POLL_INTERVAL)
+  publisher = task.LoopingCall(pipes.publish)
+  publisher.start(PUBLISH_INTERVAL)
+  watch_parent(os.getppid())
+  if args.ready_fd is not None:
+    os.write(args.ready_fd, '.')
+    os.close(args.ready_fd)
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main()
@@ -24,7 +24,7 @@ setup(
     zip_safe=False,  # python-iptables doesn't work well with eggs
 
     description='Packet-based impaired network library',
-    packages=find_packages(exclude=['contrib', 'docs', 'tests']),
+    packages=find_packages(exclude=['benchmarks', 'contrib', 'docs', 'tests']),
     package_data={'packet_queue': ['web/*']},
     include_package_data=True,
 
@@ -35,5 +35,6 @@ setup(
         'scripts/impaired_network_server',
         'scripts/impaired_network_shell',
         'scripts/impaired_network_clear_iptables',
+        'scripts/impaired_network_simulate',
     ]
 )
@@ -18,15 +18,20 @@ import StringIO
 from twisted.trial import unittest
 from twisted.web import http_headers
 
+from twisted.internet import task
 from twisted.internet.defer import succeed
 from twisted.web.test import test_web
 
 from packet_queue import api_server
+from packet_queue import monitoring
 from packet_queue import simulation
 
+from test_simulation import FakeReactor
 
-def construct_dummy_request(method="GET", data=""):
+
+def construct_dummy_request(method="GET", data="", args=None):
   request = test_web.DummyRequest([""])
+  request.args = args or {}
 
   request.content = StringIO.StringIO(data)
   request.method = method  # checked by Twisted's resource.Resource.render
@@ -62,6 +67,14 @@ class PipeParamsTest(unittest.TestCase):
     self.assertRaises(TypeError, api_server.parse_pipe_params, {"bandwidth": ()})
     self.assertRaises(TypeError, api_server.parse_pipe_params, {"bandwidth": None})
 
+  def test_out_of_range(self):
+    self.assertRaises(ValueError, api_server.parse_pipe_params, {"qdisc": 9})
+    self.assertRaises(ValueError, api_server.parse_pipe_params, {"qdisc": -1})
+    self.assertRaises(ValueError, api_server.parse_pipe_params,
+                      {"jitter": 0.1, "jitter_distribution": 5})
+    self.assertRaises(ValueError, api_server.parse_pipe_params,
+                      {"jitter_distribution": -1})
+
   def test_normal_case(self):
     expected = {"bandwidth": -1}
     actual = api_server.parse_pipe_params({"bandwidth": "-1"})
@@ -135,6 +148,16 @@ class PipeResourceTest(unittest.TestCase):
     # correctly set params
     self.assertEqual(self.params, expected)
 
+  def test_put_out_of_range(self):
+    params = dict(simulation.Pipe.PARAMS)
+    resource = api_server.PipeResource(params=params)
+    request = construct_dummy_request(method="PUT",
+                                      data=json.dumps({"qdisc": 9}))
+    resource.render(request)
+
+    self.assertEqual(request.responseCode, 400)
+    self.assertEqual(params["qdisc"], 0)
+
   def test_delete_request(self):
     new = {"foo": 128}
 
@@ -145,3 +168,198 @@ class PipeResourceTest(unittest.TestCase):
     content = self.resource.render(request)
 
     self.assertEqual(json.loads(content), self.BASE_PARAMS)
+
+
+class EventsResourceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.event_log = monitoring.EventLog()
+    self.resource = api_server.EventsResource(self.event_log)
+    self.event_log.add(1.0, "up", "deliver", 1024)
+    self.event_log.add(1.0, "up", "latency", 0.25)
+
+  def test_raw_events(self):
+    content = self.resource.render(construct_dummy_request())
+    events = json.loads(content)["events"]
+    self.assertEqual([e["type"] for e in events], ["deliver", "latency"])
+
+  def test_aggregated(self):
+    request = construct_dummy_request(args={"resolution": ["100ms"]})
+    data = json.loads(self.resource.render(request))
+
+    self.assertEqual(data["resolution"], 0.1)
+    self.assertEqual(len(data["buckets"]), 1)
+    self.assertEqual(data["buckets"][0]["delivered"], 1024)
+
+  def test_invalid_resolution(self):
+    request = construct_dummy_request(args={"resolution": ["soon"]})
+    self.resource.render(request)
+    self.assertEqual(request.responseCode, 400)
+
+  def test_cursor(self):
+    request = construct_dummy_request(args={"cursor": ["2"]})
+    data = json.loads(self.resource.render(request))
+    self.assertEqual([e["type"] for e in data["events"]], ["latency"])
+    self.assertEqual(data["cursor"], 3)
+
+    # Reading with a cursor leaves pending events for other clients.
+    data = json.loads(self.resource.render(construct_dummy_request()))
+    self.assertEqual(len(data["events"]), 2)
+
+
+class EventStreamResourceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.event_log = monitoring.EventLog()
+    self.resource = api_server.EventStreamResource(self.event_log)
+    self.clock = task.Clock()
+    self.resource.clock = self.clock
+
+  def subscribe(self, **args):
+    request = construct_dummy_request(args=args)
+    request.registerProducer = lambda producer, streaming: None
+    self.resource.render(request)
+    return request
+
+  def messages(self, request):
+    return [json.loads(line[len("data: "):])
+            for line in "".join(request.written).splitlines()
+            if line.startswith("data: ")]
+
+  def test_each_client_gets_all_events(self):
+    first = self.subscribe()
+    second = self.subscribe()
+
+    self.event_log.add(1.0, "up", "deliver", 1024)
+    self.clock.advance(self.resource.interval)
+
+    for request in first, second:
+      events = self.messages(request)[0]["events"]
+      self.assertEqual([e["value"] for e in events], [1024])
+
+  def test_paused_client_catches_up(self):
+    request = self.subscribe()
+    stream, = self.resource.streams
+
+    stream.pauseProducing()
+    self.event_log.add(1.0, "up", "deliver", 1024)
+    self.clock.advance(self.resource.interval)
+    self.assertEqual(self.messages(request), [])
+
+    stream.resumeProducing()
+    self.clock.advance(self.resource.interval)
+    self.assertEqual(len(self.messages(request)[0]["events"]), 1)
+
+  def test_aggregated(self):
+    request = self.subscribe(resolution=["1s"])
+    self.event_log.add(1.0, "up", "deliver", 1024)
+    self.clock.advance(self.resource.interval)
+
+    buckets = self.messages(request)[0]["buckets"]
+    self.assertEqual(buckets[0]["delivered"], 1024)
+
+  def test_finished_client_removed(self):
+    request = self.subscribe()
+    request.finish()
+    self.assertEqual(self.resource.streams, set())
+    self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class ScheduleResourceTest(unittest.TestCase):
+
+  PROGRAM = {"steps": [{"time": 0, "params": {"bandwidth": 1000}},
+                       {"time": 1, "params": {"bandwidth": 2000}}]}
+
+  def setUp(self):
+    self.reactor = FakeReactor()
+    self.params = dict(simulation.Pipe.PARAMS)
+    self.resource = api_server.ScheduleResource(self.params)
+    self.resource.clock = self.reactor
+
+  def put(self, program):
+    request = construct_dummy_request(method="PUT", data=json.dumps(program))
+    return request, json.loads(self.resource.render(request))
+
+  def test_get_without_program(self):
+    content = self.resource.render(construct_dummy_request())
+    self.assertEqual(json.loads(content), None)
+
+  def test_put_valid_request(self):
+    _, data = self.put(self.PROGRAM)
+    self.assertTrue(data["running"])
+    self.assertEqual(len(data["steps"]), 2)
+
+    self.reactor.advance_time(0)
+    self.assertEqual(self.params["bandwidth"], 1000)
+    self.reactor.advance_time(1.0)
+    self.assertEqual(self.params["bandwidth"], 2000)
+
+    data = json.loads(self.resource.render(construct_dummy_request()))
+    self.assertFalse(data["running"])
+
+  def test_put_invalid_request(self):
+    request, data = self.put({"steps": [{"time": 0, "params": {"foo": 1}}]})
+    self.assertEqual(request.responseCode, 400)
+    self.assertTrue("error" in data, data)
+
+  def test_put_replaces_program(self):
+    self.put(self.PROGRAM)
+    self.put({"steps": [{"time": 0.5, "params": {"loss": 0.5}}]})
+    self.reactor.advance_time(1.0)
+    self.assertEqual(self.params["bandwidth"], -1)
+    self.assertEqual(self.params["loss"], 0.5)
+
+  def test_delete_request(self):
+    self.put(self.PROGRAM)
+    self.reactor.advance_time(0)
+    request = construct_dummy_request(method="DELETE")
+    data = json.loads(self.resource.render(request))
+    self.assertFalse(data["running"])
+
+    self.reactor.advance_time(1.0)
+    self.assertEqual(self.params["bandwidth"], 1000)
+
+
+class MeterResourceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.pipes = simulation.PipePair(simulation.Params(simulation.Pipe.PARAMS),
+                                     monitoring.EventLog())
+    self.resource = api_server.MeterResource(self.pipes)
+    self.pipes.up.bytes_attempted = 100
+
+  def test_get(self):
+    data = json.loads(self.resource.render(construct_dummy_request()))
+    self.assertEqual(data["up"]["bytes_attempted"], 100)
+    self.assertEqual(data["down"]["bytes_attempted"], 0)
+
+  def test_delete(self):
+    request = construct_dummy_request(method="DELETE")
+    data = json.loads(self.resource.render(request))
+    self.assertEqual(data["up"]["bytes_attempted"], 0)
+
+
+class MetricsResourceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.pipes = simulation.PipePair(simulation.Params(simulation.Pipe.PARAMS),
+                                     monitoring.EventLog())
+    self.resource = api_server.MetricsResource(self.pipes)
+
+  def test_metrics(self):
+    self.pipes.up.packets_delivered = 2
+    self.pipes.up.size = 512
+    self.pipes.up.latency.add(0.003)
+    self.pipes.up.latency.add(0.2)
+
+    content = self.resource.render(construct_dummy_request())
+    lines = content.splitlines()
+
+    self.assertIn('packet_queue_packets_total{pipe="up",outcome="delivered"} 2',
+                  lines)
+    self.assertIn('packet_queue_buffer_bytes{pipe="up"} 512', lines)
+    self.assertIn('packet_queue_latency_seconds_bucket{pipe="up",le="0.005"} 1',
+                  lines)
+    self.assertIn('packet_queue_latency_seconds_bucket{pipe="up",le="+Inf"} 2',
+                  lines)
+    self.assertIn('packet_queue_latency_seconds_count{pipe="down"} 0', lines)
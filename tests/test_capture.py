@@ -0,0 +1,145 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+from packet_queue import capture
+from packet_queue import monitoring
+from packet_queue import simulation
+
+from test_simulation import FakeReactor
+
+
+def read_blocks(path):
+  """Returns (block type, body) pairs from a pcapng file."""
+  with open(path, 'rb') as f:
+    data = f.read()
+  blocks = []
+  offset = 0
+  while offset < len(data):
+    block_type, length = struct.unpack_from('=II', data, offset)
+    blocks.append((block_type, data[offset + 8:offset + length - 4]))
+    offset += length
+  return blocks
+
+
+def read_packets(path):
+  """Returns (interface, captured bytes, size, comment) for each packet."""
+  packets = []
+  for block_type, body in read_blocks(path):
+    if block_type != capture.ENHANCED_PACKET:
+      continue
+    interface, _, _, captured, size = struct.unpack_from('=IIIII', body)
+    data = body[20:20 + captured]
+    options = body[20 + captured + (-captured % 4):]
+    code, length = struct.unpack_from('=HH', options)
+    assert code == capture.OPTION_COMMENT
+    packets.append((interface, data, size, options[4:4 + length]))
+  return packets
+
+
+class CaptureTestCase(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'capture.pcapng')
+
+  def tearDown(self):
+    capture.stop()
+    shutil.rmtree(self.directory)
+
+
+class WriterTest(CaptureTestCase):
+  def test_blocks(self):
+    writer = capture.Writer(self.path, snaplen=4)
+    writer.add(1.5, 'down', 'delivered', 0.25, 100, 'abcdefgh')
+    writer.add(2.0, 'up', 'loss', 0.0, 100, None)
+    writer.stop()
+
+    blocks = read_blocks(self.path)
+    self.assertEqual([block_type for (block_type, _) in blocks],
+                     [capture.SECTION_HEADER,
+                      capture.INTERFACE_DESCRIPTION,
+                      capture.INTERFACE_DESCRIPTION,
+                      capture.ENHANCED_PACKET])
+    self.assertEqual(read_packets(self.path), [
+        (1, 'abcd', 100, 'verdict=delivered queueing_delay=0.250000')])
+
+  def test_rotation(self):
+    writer = capture.Writer(self.path, file_size=200, files=2)
+    for i in range(5):
+      writer.add(i, 'up', 'delivered', 0.0, 100, chr(i) * 100)
+    writer.stop()
+
+    self.assertEqual(sorted(os.listdir(self.directory)),
+                     ['capture.pcapng.0', 'capture.pcapng.1'])
+    first = read_packets(self.path + '.0')
+    second = read_packets(self.path + '.1')
+    self.assertEqual([data[0] for (_, data, _, _) in first], ['\x04'])
+    self.assertEqual([data[0] for (_, data, _, _) in second],
+                     ['\x02', '\x03'])
+
+  def test_write_error(self):
+    os.mkdir(self.path)  # Opening a directory for writing fails.
+    writer = capture.Writer(self.path, queue_size=2)
+    for i in range(10):
+      writer.add(i, 'up', 'delivered', 0.0, 100, 'abcd')
+    writer.stop()
+    self.assertFalse(writer.thread.is_alive())
+    self.assertIsInstance(writer.error, IOError)
+
+    dropped = writer.dropped
+    writer.add(10, 'up', 'delivered', 0.0, 100, 'abcd')
+    self.assertEqual(writer.dropped, dropped + 1)
+
+  def test_udp_packet(self):
+    packet = capture.udp_packet(('10.0.0.1', 5000), ('10.0.0.2', 3000), 'hi')
+    self.assertEqual(len(packet), 30)
+    self.assertEqual(packet[12:16], socket.inet_aton('10.0.0.1'))
+    self.assertEqual(struct.unpack_from('!HHH', packet, 20), (5000, 3000, 10))
+
+
+class PipeCaptureTest(CaptureTestCase):
+  def test_verdicts(self):
+    reactor = FakeReactor()
+    params = simulation.Params(simulation.Pipe.PARAMS, bandwidth=1000,
+                               buffer=1000)
+    pipe = simulation.Pipe('up', params, monitoring.EventLog(), reactor)
+    capture.start(self.path)
+
+    noop = lambda: None
+    pipe.attempt(noop, noop, 500, payload='first')
+    pipe.attempt(noop, noop, 500, payload='second')
+    pipe.attempt(noop, noop, 500, payload='third')
+    params['loss'] = 1.0
+    pipe.attempt(noop, noop, 500, payload='fourth')
+    for _ in range(100):
+      reactor.advance_time(0.01)
+    capture.stop()
+
+    comments = [(data, comment) for (_, data, _, comment)
+                in read_packets(self.path)]
+    self.assertEqual(comments, [
+        ('third', 'verdict=buffer queueing_delay=0.000000'),
+        ('fourth', 'verdict=loss queueing_delay=0.000000'),
+        ('first', 'verdict=delivered queueing_delay=0.500000'),
+        ('second', 'verdict=delivered queueing_delay=1.000000'),
+    ])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -81,7 +81,7 @@ class EndToEndTest(unittest.TestCase):
   def setUp(self):
     self.app = FakeApp()
     self.port = self.app.start_server()
-    self.params = dict(simulation.Pipe.PARAMS)
+    self.params = simulation.Params(simulation.Pipe.PARAMS)
     self.child = None  # multiprocessing.Process
     self.ready = multiprocessing.Event()
     self.shared = multiprocessing.Manager().Namespace()
@@ -104,9 +104,9 @@ class EndToEndTest(unittest.TestCase):
     reactor.callLater(0, self.set_ready)
     reactor.run()
 
-  def run_proxy(self):
+  def run_proxy(self, batch_io=False):
     pipes = simulation.PipePair(self.params, monitoring.EventLog())
-    proxy_port = udp_proxy.configure(self.port, 0, pipes)
+    proxy_port = udp_proxy.configure(self.port, 0, pipes, batch_io=batch_io)
     self.shared.proxy_port = proxy_port
     reactor.callLater(0, self.set_ready)
     reactor.run()
@@ -138,6 +138,15 @@ class EndToEndTest(unittest.TestCase):
     self.app.send_response()
     self.assertEqual(self.app.get_readable(), (False, True))
 
+  def test_proxy_batched_deliver_all(self):
+    self.start_child(lambda: self.run_proxy(batch_io=True))
+
+    self.app.send_packet(self.shared.proxy_port)
+    self.assertEqual(self.app.get_readable(), (True, False))
+
+    self.app.send_response()
+    self.assertEqual(self.app.get_readable(), (False, True))
+
   def test_proxy_drop_all(self):
     self.params['loss'] = 1.0
     self.start_child(self.run_proxy)
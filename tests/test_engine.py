@@ -0,0 +1,34 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from packet_queue import engine
+
+
+class EngineTest(unittest.TestCase):
+  def test_default(self):
+    engine.install('twisted')
+    self.assertEqual(engine.installed(), 'twisted')
+
+  def test_unsupported(self):
+    try:
+      import asyncio
+    except ImportError:
+      self.assertRaises(RuntimeError, engine.install, 'asyncio')
+    else:
+      self.skipTest('asyncio is available')
+
+
+if __name__ == '__main__':
+  unittest.main()
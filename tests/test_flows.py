@@ -0,0 +1,134 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import struct
+import unittest
+from packet_queue import flows
+from packet_queue import monitoring
+from packet_queue import simulation
+
+from test_simulation import FakeReactor
+
+
+def ipv4_packet(protocol, source, destination):
+  """Returns the headers of an IPv4 packet, with a UDP or TCP port pair."""
+  header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28, 0, 0, 64, protocol, 0,
+                       socket.inet_aton(source[0]),
+                       socket.inet_aton(destination[0]))
+  return header + struct.pack('!HH', source[1], destination[1])
+
+
+class ClassifyTest(unittest.TestCase):
+  def test_ipv4(self):
+    payload = ipv4_packet(17, ('10.0.0.1', 5000), ('10.0.0.2', 3000))
+    self.assertEqual(
+        flows.classify(payload),
+        (17, socket.inet_aton('10.0.0.1'), 5000,
+         socket.inet_aton('10.0.0.2'), 3000))
+
+  def test_reverse_matches(self):
+    up = ipv4_packet(6, ('10.0.0.1', 5000), ('10.0.0.2', 3000))
+    down = ipv4_packet(6, ('10.0.0.2', 3000), ('10.0.0.1', 5000))
+    self.assertEqual(flows.classify(up), flows.classify(down, reverse=True))
+
+  def test_ipv6(self):
+    source = socket.inet_pton(socket.AF_INET6, '::1')
+    destination = socket.inet_pton(socket.AF_INET6, '::2')
+    payload = (struct.pack('!IHBB', 6 << 28, 8, 17, 64) + source +
+               destination + struct.pack('!HH', 5000, 3000))
+    self.assertEqual(flows.classify(payload),
+                     (17, source, 5000, destination, 3000))
+
+  def test_not_ip(self):
+    self.assertIsNone(flows.classify('\0' * 40))
+
+
+class FlowTableTest(unittest.TestCase):
+  def setUp(self):
+    self.reactor = FakeReactor()
+    self.params = simulation.Params(simulation.Pipe.PARAMS)
+    self.event_log = monitoring.EventLog()
+    self.table = flows.FlowTable(self.params, self.event_log, max_flows=2,
+                                 flow_timeout=10.0, clock=self.reactor)
+    self.received = []
+
+  def wait(self, seconds):
+    for _ in range(int(round(seconds / 0.01))):
+      self.reactor.advance_time(0.01)
+
+  def send(self, obj, size, flow):
+    def callback():
+      self.received.append(obj)
+    self.table.up.attempt(callback, lambda: None, size, flow)
+
+  def test_flows_queue_separately(self):
+    self.params.update(bandwidth=1000, buffer=1000)
+
+    self.send(1, 1000, 'a')
+    self.send(2, 1000, 'a')
+    self.send(3, 1000, 'b')
+    self.assertEqual(self.table.up.size, 2000)
+
+    self.reactor.advance_time(1.0)
+    self.assertItemsEqual(self.received, [1, 3])
+
+    meter = self.table.up.meter()
+    self.assertEqual(meter['packets_delivered'], 2)
+    self.assertEqual(meter['packets_dropped_buffer'], 1)
+
+  def test_aggregate_bandwidth(self):
+    self.table.aggregate_bandwidth = 1000
+
+    self.send(1, 500, 'a')
+    self.send(2, 500, 'b')
+    self.wait(0.5)
+    self.assertItemsEqual(self.received, [])
+
+    self.wait(0.5)
+    self.assertItemsEqual(self.received, [1, 2])
+
+  def test_evict_least_recently_used(self):
+    self.send(1, 100, 'a')
+    self.send(2, 100, 'b')
+    self.send(3, 100, 'a')
+    self.send(4, 100, 'c')
+    self.assertEqual(list(self.table.flows), ['a', 'c'])
+
+    # Counters of removed flows still count.
+    self.reactor.advance_time(0)
+    self.assertEqual(self.table.up.meter()['packets_delivered'], 4)
+    self.assertEqual(sum(self.table.up.latency.counts), 4)
+
+  def test_expire_idle(self):
+    self.send(1, 100, 'a')
+    self.reactor.advance_time(6.0)
+    self.send(2, 100, 'b')
+
+    self.reactor.advance_time(5.0)
+    self.assertEqual(list(self.table.flows), ['b'])
+    self.reactor.advance_time(5.0)
+    self.assertEqual(list(self.table.flows), [])
+
+  def test_reset_meter(self):
+    self.send(1, 100, 'a')
+    self.send(2, 100, 'b')
+    self.send(3, 100, 'c')
+    self.reactor.advance_time(0)
+    self.table.up.reset_meter()
+    self.assertEqual(set(self.table.up.meter().values()), {0})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,134 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+from packet_queue import impairments
+from packet_queue import monitoring
+from packet_queue import simulation
+
+from test_simulation import FakeReactor
+
+
+def mean_and_deviation(values):
+  mean = sum(values) / len(values)
+  deviation = (sum((x - mean) ** 2 for x in values) / len(values)) ** 0.5
+  return mean, deviation
+
+
+class RandomPoolTest(unittest.TestCase):
+  def test_seed_repeats(self):
+    first = impairments.RandomPool(seed=7)
+    second = impairments.RandomPool(seed=7)
+    self.assertEqual([first.uniform() for _ in range(5000)],
+                     [second.uniform() for _ in range(5000)])
+
+  def test_distributions_standardized(self):
+    pool = impairments.RandomPool(seed=1, table=[-1.0, 1.0])
+    for distribution in range(len(impairments.DISTRIBUTIONS)):
+      mean, deviation = mean_and_deviation(
+          [pool.variate(distribution) for _ in range(20000)])
+      self.assertAlmostEqual(mean, 0.0, delta=0.05)
+      self.assertAlmostEqual(deviation, 1.0, delta=0.15)
+
+  def test_unknown_distribution(self):
+    pool = impairments.RandomPool(seed=1)
+    self.assertRaises(ValueError, pool.variate, -1)
+    self.assertRaises(ValueError, pool.variate,
+                      len(impairments.DISTRIBUTIONS))
+
+  def test_load_table(self):
+    handle, path = tempfile.mkstemp()
+    os.write(handle, '1\n2\n\n3\n')
+    os.close(handle)
+    try:
+      table = impairments.load_table(path)
+    finally:
+      os.remove(path)
+    self.assertEqual(len(table), 3)
+    self.assertAlmostEqual(table[0], -table[2])
+    self.assertAlmostEqual(table[1], 0.0)
+
+
+class ImpairmentsTest(unittest.TestCase):
+  def setUp(self):
+    self.params = simulation.CachedParams(simulation.Pipe.PARAMS)
+    self.impairments = impairments.Impairments(
+        self.params, impairments.RandomPool(seed=3))
+
+  def test_gilbert_elliott_bursts(self):
+    self.params.update(gilbert_p=0.01, gilbert_r=0.25)
+    losses = [self.impairments.lost() for _ in range(100000)]
+
+    # The bad state lasts four packets on average, and is entered once
+    # every hundred packets in the good state.
+    self.assertAlmostEqual(sum(losses) / float(len(losses)), 0.038,
+                           delta=0.008)
+    bursts = sum(1 for (a, b) in zip(losses, losses[1:]) if b and not a)
+    self.assertAlmostEqual(sum(losses) / float(bursts), 4.0, delta=0.5)
+
+  def test_off_draws_nothing(self):
+    pool = self.impairments.pool
+    self.impairments.lost()
+    self.impairments.delay()
+    self.impairments.reordered()
+    self.impairments.duplicated()
+    self.assertEqual(pool.uniforms, [])
+
+  def test_jitter_never_negative(self):
+    self.params.update(delay=0.01, jitter=0.1)
+    delays = [self.impairments.delay() for _ in range(1000)]
+    self.assertEqual(min(delays), 0.0)
+    self.assertGreater(max(delays), 0.1)
+
+
+class ImpairedPipeTest(unittest.TestCase):
+  def setUp(self):
+    self.reactor = FakeReactor()
+    self.params = simulation.Params(simulation.Pipe.PARAMS, delay=0.5)
+    self.pipe = simulation.Pipe('test', self.params, monitoring.EventLog(),
+                                self.reactor)
+    self.pipe.impairments.pool = impairments.RandomPool(seed=5)
+    self.received = []
+
+  def send(self, obj):
+    self.pipe.attempt(lambda: self.received.append(obj), lambda: None, 100)
+
+  def test_reorder_skips_delay(self):
+    self.send(1)
+    self.params['reorder'] = 1.0
+    self.send(2)
+    self.reactor.advance_time(0)
+    self.assertEqual(self.received, [2])
+    self.reactor.advance_time(0.5)
+    self.assertEqual(self.received, [2, 1])
+
+  def test_jitter_keeps_order(self):
+    self.params['jitter'] = 0.2
+    for i in range(100):
+      self.send(i)
+    self.reactor.advance_time(5.0)
+    self.assertEqual(self.received, range(100))
+
+  def test_duplicate(self):
+    self.params['duplicate'] = 1.0
+    self.send(1)
+    self.reactor.advance_time(0.5)
+    self.assertEqual(self.received, [1, 1])
+    self.assertEqual(self.pipe.packets_delivered, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,248 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import socket
+import struct
+import unittest
+
+try:
+  from packet_queue import libnetfilter_queue
+except OSError:  # The shared library isn't installed.
+  libnetfilter_queue = None
+
+requires_library = unittest.skipIf(libnetfilter_queue is None,
+                                   'libnetfilter_queue not installed')
+
+ACCEPT = 1
+DROP = 0
+
+
+@requires_library
+class PacketLengthTest(unittest.TestCase):
+  def test_ipv4(self):
+    header = struct.pack('!BBH', 0x45, 0, 1500).ljust(20, '\0')
+    self.assertEqual(libnetfilter_queue.packet_length(header, 128), 1500)
+
+  def test_ipv6(self):
+    # The payload length leaves out the 40 byte fixed header.
+    header = struct.pack('!IH', 0x60000000, 1460).ljust(40, '\0')
+    self.assertEqual(libnetfilter_queue.packet_length(header, 128), 1500)
+
+  def test_truncated(self):
+    ipv4 = struct.pack('!BBH', 0x45, 0, 1500).ljust(19, '\0')
+    ipv6 = struct.pack('!IH', 0x60000000, 1460).ljust(39, '\0')
+    for payload in ['', ipv4, ipv6]:
+      self.assertEqual(libnetfilter_queue.packet_length(payload, 128), 128)
+
+  def test_unknown_version(self):
+    payload = struct.pack('!BBH', 0x55, 0, 1500).ljust(40, '\0')
+    self.assertEqual(libnetfilter_queue.packet_length(payload, 128), 128)
+
+
+class FakeNfq(object):
+  """Stands in for the library, recording the verdicts sent to the kernel."""
+
+  QUEUE_HANDLE = 7
+
+  def __init__(self):
+    self.sockets = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.verdicts = []
+    self.handled = []  # Sizes of the messages handed to the library.
+
+  def close(self):
+    for sock in self.sockets:
+      sock.close()
+
+  def nfq_open(self):
+    return 1
+
+  def nfq_fd(self, handle):
+    return self.sockets[0].fileno()
+
+  def nfq_unbind_pf(self, handle, family):
+    return 0
+
+  def nfq_bind_pf(self, handle, family):
+    return 0
+
+  def nfq_create_queue(self, handle, queue_num, callback, data):
+    return self.QUEUE_HANDLE
+
+  def nfq_set_mode(self, qh, mode, copy_range):
+    return 0
+
+  def nfq_set_verdict(self, qh, packet_id, verdict, length, buf):
+    self.verdicts.append(('one', packet_id, verdict))
+
+  def nfq_set_verdict_batch(self, qh, packet_id, verdict):
+    self.verdicts.append(('batch', packet_id, verdict))
+
+  def nfq_handle_packet(self, handle, buffer, size):
+    self.handled.append(size)
+
+
+class FakeSocket(object):
+  """Returns message sizes from recv_into, or raises socket errors."""
+
+  def __init__(self, results):
+    self.results = list(results)
+    self.reads = 0
+
+  def recv_into(self, buffer, size, flags):
+    self.reads += 1
+    if not self.results:
+      raise socket.error(errno.EAGAIN, 'Resource temporarily unavailable')
+    result = self.results.pop(0)
+    if isinstance(result, socket.error):
+      raise result
+    return result
+
+  def close(self):
+    pass
+
+
+class ManagerTestCase(unittest.TestCase):
+  """Runs a Manager with batched verdicts on a FakeNfq."""
+
+  def setUp(self):
+    self.nfq = FakeNfq()
+    self.original_nfq = libnetfilter_queue.nfq
+    libnetfilter_queue.nfq = self.nfq
+    self.manager = libnetfilter_queue.Manager(batch_verdicts=True)
+    self.manager.bind(0, lambda packet: None)
+    self.callback = libnetfilter_queue.py_callbacks[FakeNfq.QUEUE_HANDLE]
+
+  def tearDown(self):
+    libnetfilter_queue.nfq = self.original_nfq
+    libnetfilter_queue.py_callbacks.pop(FakeNfq.QUEUE_HANDLE, None)
+    libnetfilter_queue.copy_ranges.pop(FakeNfq.QUEUE_HANDLE, None)
+    self.manager.socket.close()
+    self.nfq.close()
+
+
+@requires_library
+class ProcessTest(ManagerTestCase):
+  def drain(self, results, drain_limit):
+    self.manager.socket.close()
+    self.manager.socket = FakeSocket(results)
+    self.manager.drain_limit = drain_limit
+    self.manager.process()
+    return self.manager.socket
+
+  def test_stops_when_empty(self):
+    sock = self.drain([100, 200], 8)
+    self.assertEqual(self.nfq.handled, [100, 200])
+    self.assertEqual(sock.reads, 3)
+
+  def test_drain_limit(self):
+    sock = self.drain([100, 200, 300], 2)
+    self.assertEqual(self.nfq.handled, [100, 200])
+    self.assertEqual(sock.results, [300])
+
+  def test_overrun(self):
+    overrun = socket.error(errno.ENOBUFS, 'No buffer space available')
+    self.drain([100, overrun, 200], 8)
+    self.assertEqual(self.nfq.handled, [100, 200])
+    self.assertEqual(self.manager.overruns, 1)
+
+  def test_other_errors_raised(self):
+    error = socket.error(errno.EBADF, 'Bad file descriptor')
+    self.assertRaises(socket.error, self.drain, [error], 8)
+
+
+@requires_library
+class FlushVerdictsTest(ManagerTestCase):
+
+  def arrive(self, *ids):
+    packets = []
+    for packet_id in ids:
+      packet = libnetfilter_queue.Packet(packet_id, 100, '',
+                                         FakeNfq.QUEUE_HANDLE)
+      self.callback(packet)
+      packets.append(packet)
+    return packets
+
+  def verdicts(self, *verdicts):
+    for packet, verdict in verdicts:
+      self.manager.set_verdict(packet, verdict)
+    self.manager.flush_verdicts()
+    sent = self.nfq.verdicts
+    self.nfq.verdicts = []
+    return sent
+
+  def test_in_order_batch(self):
+    packets = self.arrive(1, 2, 3)
+    self.assertEqual(self.verdicts(*[(p, ACCEPT) for p in packets]),
+                     [('batch', 3, ACCEPT)])
+    self.assertFalse(self.manager.unverdicted[FakeNfq.QUEUE_HANDLE])
+
+  def test_batches_split_by_verdict(self):
+    one, two, three = self.arrive(1, 2, 3)
+    self.assertEqual(
+        self.verdicts((one, ACCEPT), (two, DROP), (three, ACCEPT)),
+        [('batch', 1, ACCEPT), ('batch', 2, DROP), ('batch', 3, ACCEPT)])
+
+  def test_out_of_order(self):
+    one, two, three = self.arrive(1, 2, 3)
+    self.assertEqual(
+        sorted(self.verdicts((three, ACCEPT), (two, ACCEPT))),
+        [('one', 2, ACCEPT), ('one', 3, ACCEPT)])
+
+    # Packets already verdicted one by one aren't covered by a batch again.
+    self.assertEqual(self.verdicts((one, DROP)), [('batch', 1, DROP)])
+    self.assertFalse(self.manager.unverdicted[FakeNfq.QUEUE_HANDLE])
+    self.assertFalse(self.manager.verdicted[FakeNfq.QUEUE_HANDLE])
+
+  def test_gap(self):
+    one, two, three, four = self.arrive(1, 2, 3, 4)
+    self.assertEqual(
+        self.verdicts((one, ACCEPT), (two, ACCEPT), (four, ACCEPT)),
+        [('batch', 2, ACCEPT), ('one', 4, ACCEPT)])
+    self.assertEqual(self.verdicts((three, ACCEPT)), [('batch', 3, ACCEPT)])
+
+    five, six = self.arrive(5, 6)
+    self.assertEqual(self.verdicts((five, ACCEPT), (six, ACCEPT)),
+                     [('batch', 6, ACCEPT)])
+
+  def test_wraparound(self):
+    packets = self.arrive(2 ** 32 - 2, 2 ** 32 - 1, 0, 1)
+    # Ids after the wraparound compare lower, so they start a new batch.
+    self.assertEqual(self.verdicts(*[(p, ACCEPT) for p in packets]),
+                     [('batch', 2 ** 32 - 1, ACCEPT), ('batch', 1, ACCEPT)])
+
+  def test_late_verdicts_ignored(self):
+    one, two, three = self.arrive(1, 2, 3)
+    self.assertEqual(self.verdicts((three, ACCEPT)), [('one', 3, ACCEPT)])
+    self.assertEqual(self.verdicts((three, DROP)), [])
+    self.assertEqual(self.verdicts((one, ACCEPT), (two, ACCEPT)),
+                     [('batch', 2, ACCEPT)])
+    self.assertEqual(self.verdicts((one, DROP), (three, DROP)), [])
+    self.assertFalse(self.manager.unverdicted[FakeNfq.QUEUE_HANDLE])
+    self.assertFalse(self.manager.verdicted[FakeNfq.QUEUE_HANDLE])
+    self.assertFalse(self.manager.pending_verdicts[FakeNfq.QUEUE_HANDLE])
+
+    four, = self.arrive(2 ** 32 - 1)
+    five, = self.arrive(0)
+    self.assertEqual(self.verdicts((five, ACCEPT)), [('one', 0, ACCEPT)])
+    self.assertEqual(self.verdicts((two, ACCEPT), (four, ACCEPT)),
+                     [('batch', 2 ** 32 - 1, ACCEPT)])
+
+  def test_nothing_pending(self):
+    self.arrive(1)
+    self.assertEqual(self.verdicts(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,97 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import select
+import socket
+import unittest
+from packet_queue import mmsg
+
+
+class BatchedIOTest(unittest.TestCase):
+  """Sends datagrams between two sockets on localhost."""
+
+  def setUp(self):
+    self.available = mmsg.available
+    self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sender.bind(('127.0.0.1', 0))
+    self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.receiver.bind(('127.0.0.1', 0))
+    self.buffers = mmsg.Receiver(size=4)
+
+  def tearDown(self):
+    mmsg.available = self.available
+    self.sender.close()
+    self.receiver.close()
+
+  def exchange(self, count):
+    address = self.receiver.getsockname()
+    datagrams = [('packet %d' % i, address) for i in range(count)]
+    self.assertEqual(mmsg.send(self.sender, datagrams), count)
+    select.select([self.receiver], [], [], 1.0)
+
+    received = []
+    while True:
+      batch = self.buffers.receive(self.receiver)
+      if not batch:
+        return received
+      self.assertTrue(len(batch) <= self.buffers.size)
+      received.extend(batch)
+
+  def check(self):
+    received = self.exchange(10)
+    self.assertEqual([data for (data, _) in received],
+                     ['packet %d' % i for i in range(10)])
+    for _, address in received:
+      self.assertEqual(address, self.sender.getsockname())
+
+  def test_batched(self):
+    if not mmsg.available:
+      self.skipTest('recvmmsg and sendmmsg not available')
+    self.check()
+
+  def test_fallback(self):
+    mmsg.available = False
+    self.check()
+
+  def check_refused(self):
+    # Too large for IPv4, so the kernel refuses the middle datagram alone.
+    address = self.receiver.getsockname()
+    datagrams = [('first', address), ('x' * 70000, address),
+                 ('last', address)]
+    self.assertEqual(mmsg.send(self.sender, datagrams), 2)
+    select.select([self.receiver], [], [], 1.0)
+    received = self.buffers.receive(self.receiver)
+    self.assertEqual([data for (data, _) in received], ['first', 'last'])
+
+  def test_batched_refused(self):
+    if not mmsg.available:
+      self.skipTest('recvmmsg and sendmmsg not available')
+    self.check_refused()
+
+  def test_fallback_refused(self):
+    mmsg.available = False
+    self.check_refused()
+
+  def test_nothing_to_receive(self):
+    self.assertEqual(self.buffers.receive(self.receiver), [])
+
+  def test_pack_address(self):
+    address = ('10.1.2.3', 4567)
+    packed = mmsg.pack_address(address)
+    self.assertEqual(len(packed), mmsg.SOCKADDR_IN_SIZE)
+    self.assertEqual(mmsg.unpack_address(packed), address)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,158 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from packet_queue import monitoring
+
+
+class EventLogTest(unittest.TestCase):
+  def setUp(self):
+    self.log = monitoring.EventLog()
+
+  def test_get_pending(self):
+    self.log.add(1.0, 'up', 'deliver', 1024)
+    self.log.add(1.5, 'down', 'latency', 0.25)
+
+    self.assertEqual(self.log.get_pending(), [
+      {'id': 1, 'time': 1.0, 'pipe': 'up', 'type': 'deliver', 'value': 1024},
+      {'id': 2, 'time': 1.5, 'pipe': 'down', 'type': 'latency', 'value': 0.25},
+    ])
+    self.assertEqual(self.log.get_pending(), [])
+
+    self.log.add(2.0, 'up', 'drop', 512)
+    self.assertEqual([e['id'] for e in self.log.get_pending()], [3])
+
+  def test_get_since(self):
+    self.log.add(1.0, 'up', 'deliver', 1024)
+    events, cursor = self.log.get_since(1)
+    self.assertEqual([e['id'] for e in events], [1])
+
+    self.log.add(2.0, 'up', 'drop', 512)
+    events, cursor = self.log.get_since(cursor)
+    self.assertEqual([e['id'] for e in events], [2])
+
+    # Other readers, including get_pending, are unaffected.
+    self.assertEqual(len(self.log.get_since(0)[0]), 2)
+    self.assertEqual(len(self.log.get_pending()), 2)
+
+  def test_overwrite_oldest(self):
+    total = self.log.max_size + 10
+    for i in range(total):
+      self.log.add(float(i), 'up', 'buffer', i)
+
+    events = self.log.get_pending()
+    self.assertEqual(len(events), self.log.max_size)
+    self.assertEqual(events[0]['id'], 11)
+    self.assertEqual(events[0]['value'], 10)
+    self.assertEqual(events[-1]['id'], total)
+
+
+  def test_value_types(self):
+    self.log.add(1.0, 'up', 'latency', 1.0)
+    self.log.add(1.0, 'up', 'deliver', 1024)
+    latency, deliver = self.log.get_pending()
+    self.assertIsInstance(latency['value'], float)
+    self.assertIsInstance(deliver['value'], int)
+
+
+class BucketsTest(unittest.TestCase):
+  def setUp(self):
+    self.log = monitoring.EventLog()
+
+  def test_summary(self):
+    self.log.add(10.0, 'up', 'buffer', 2048)
+    self.log.add(10.01, 'up', 'buffer', 1024)
+    self.log.add(10.02, 'up', 'drop', 512)
+    self.log.add(10.05, 'up', 'deliver', 1024)
+    self.log.add(10.05, 'up', 'latency', 0.05)
+    self.log.add(10.15, 'up', 'deliver', 1024)
+    self.log.add(10.15, 'up', 'latency', 0.15)
+
+    buckets = self.log.get_buckets(0.1)
+    self.assertEqual([b['start'] for b in buckets], [10.0, 10.1])
+    self.assertEqual(buckets[0]['delivered'], 1024)
+    self.assertEqual(buckets[0]['dropped'], 512)
+    self.assertEqual(buckets[0]['buffer_max'], 2048)
+    self.assertEqual(buckets[0]['latency']['count'], 1)
+    self.assertAlmostEqual(buckets[0]['latency']['p50'], 0.05)
+    self.assertEqual(buckets[1]['buffer_max'], 0)
+
+  def test_coarser_resolution(self):
+    for i in range(10):
+      self.log.add(i * 0.1, 'up', 'deliver', 100)
+      self.log.add(i * 0.1, 'up', 'latency', 0.001 * (i + 1))
+    self.log.add(0.0, 'down', 'drop', 100)
+
+    buckets = self.log.get_buckets(0.5)
+    self.assertEqual([(b['pipe'], b['start']) for b in buckets],
+                     [('down', 0.0), ('up', 0.0), ('up', 0.5)])
+    up = buckets[1]
+    self.assertEqual(up['delivered'], 500)
+    self.assertEqual(up['latency']['count'], 5)
+    self.assertAlmostEqual(up['latency']['min'], 0.001)
+    self.assertAlmostEqual(up['latency']['mean'], 0.003)
+    self.assertTrue(0.003 <= up['latency']['p50'] < 0.004)
+    self.assertAlmostEqual(up['latency']['p99'], 0.005)
+
+  def test_since(self):
+    self.log.add(1.0, 'up', 'deliver', 100)
+    self.log.add(2.0, 'up', 'deliver', 100)
+    self.assertEqual([b['start'] for b in self.log.get_buckets(1.0, 1.5)],
+                     [2.0])
+
+
+  def test_summarized_lazily(self):
+    self.log.add(1.0, 'up', 'deliver', 100)
+    self.assertEqual(self.log.buckets, {})
+    self.assertEqual(self.log.get_buckets(0.1)[0]['delivered'], 100)
+
+  def test_summarized_before_overwrite(self):
+    total = self.log.max_size * 2 + 10
+    for i in range(total):
+      self.log.add(i * 0.001, 'up', 'deliver', 100)
+      if i == 0:
+        self.log.get_buckets(0.1)
+    events = self.log.get_pending()
+    self.assertEqual(events[0]['id'], total - self.log.max_size + 1)
+
+    buckets = self.log.get_buckets(1000.0)
+    self.assertEqual(buckets[0]['delivered'], total * 100)
+    self.assertIsInstance(buckets[0]['delivered'], int)
+    self.assertEqual(self.log.get_buckets(1000.0), buckets)
+
+
+  def test_unread_events_skipped(self):
+    total = self.log.max_size * 2 + 10
+    for i in range(total):
+      self.log.add(i * 0.001, 'up', 'deliver', 100)
+    self.assertEqual(self.log.buckets, {})
+
+    buckets = self.log.get_buckets(1000.0)
+    self.assertGreaterEqual(buckets[0]['delivered'], self.log.max_size * 50)
+    self.assertLessEqual(buckets[0]['delivered'], self.log.max_size * 100)
+
+
+class ParseDurationTest(unittest.TestCase):
+  def test_units(self):
+    self.assertEqual(monitoring.parse_duration('100ms'), 0.1)
+    self.assertEqual(monitoring.parse_duration('2s'), 2.0)
+    self.assertEqual(monitoring.parse_duration('0.5'), 0.5)
+
+  def test_invalid(self):
+    self.assertRaises(ValueError, monitoring.parse_duration, 'fast')
+    self.assertRaises(ValueError, monitoring.parse_duration, '0ms')
+
+
+if __name__ == '__main__':
+  unittest.main()
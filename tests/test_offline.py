@@ -0,0 +1,153 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import random
+import struct
+import tempfile
+import unittest
+from packet_queue import monitoring
+from packet_queue import offline
+from packet_queue import simulation
+
+
+class VirtualReactorTest(unittest.TestCase):
+  def setUp(self):
+    self.reactor = offline.VirtualReactor()
+    self.called = []
+
+  def test_order(self):
+    self.reactor.callLater(2.0, self.called.append, 3)
+    self.reactor.callLater(1.0, self.called.append, 1)
+    self.reactor.callLater(1.0, self.called.append, 2)
+    self.reactor.run()
+    self.assertEqual(self.called, [1, 2, 3])
+    self.assertEqual(self.reactor.seconds(), 2.0)
+
+  def test_cancel(self):
+    call = self.reactor.callLater(1.0, self.called.append, 1)
+    self.assertTrue(call.active())
+    call.cancel()
+    self.assertFalse(call.active())
+    self.reactor.run()
+    self.assertEqual(self.called, [])
+
+  def test_advance(self):
+    self.reactor.callLater(1.0, self.called.append, 1)
+    self.reactor.callLater(3.0, self.called.append, 2)
+    self.reactor.advance(2.0)
+    self.assertEqual(self.called, [1])
+    self.assertEqual(self.reactor.seconds(), 2.0)
+
+  def test_pipe_clock(self):
+    pipe = simulation.Pipe(
+        'up', simulation.Params(simulation.Pipe.PARAMS, delay=1.0),
+        monitoring.EventLog(), self.reactor)
+    pipe.attempt(lambda: self.called.append(1), lambda: None, 100)
+    self.reactor.advance(0.5)
+    self.assertEqual(self.called, [])
+    self.reactor.advance(0.5)
+    self.assertEqual(self.called, [1])
+
+
+class TrafficTest(unittest.TestCase):
+  def test_constant_bit_rate(self):
+    packets = list(offline.constant_bit_rate(4, 100, 1.0))
+    self.assertEqual(packets, [(0.0, 100), (0.25, 100), (0.5, 100),
+                               (0.75, 100)])
+
+  def test_poisson(self):
+    packets = list(offline.poisson(1000, 100, 10.0, random.Random(1)))
+    self.assertAlmostEqual(len(packets), 10000, delta=300)
+    times = [t for (t, _) in packets]
+    self.assertEqual(times, sorted(times))
+
+  def test_pcap_sizes(self):
+    handle, path = tempfile.mkstemp()
+    header = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+    records = [struct.pack('<IIII', 10, 500000, 4, 1500) + 'abcd',
+               struct.pack('<IIII', 11, 0, 2, 60) + 'ab']
+    os.write(handle, header + ''.join(records))
+    os.close(handle)
+    try:
+      self.assertEqual(list(offline.pcap_sizes(path)),
+                       [(0.0, 1500), (0.5, 60)])
+    finally:
+      os.remove(path)
+
+  def write_pcapng(self, order, blocks):
+    handle, path = tempfile.mkstemp()
+    data = ''
+    for block_type, body in blocks:
+      length = len(body) + 12
+      data += struct.pack(order + 'II', block_type, length) + body
+      data += struct.pack(order + 'I', length)
+    os.write(handle, data)
+    os.close(handle)
+    self.addCleanup(os.remove, path)
+    return path
+
+  def section(self, order):
+    return (0x0a0d0d0a,
+            struct.pack(order + 'IHHq', 0x1a2b3c4d, 1, 0, -1))
+
+  def packet(self, order, interface, timestamp, size, data):
+    body = struct.pack(order + 'IIIII', interface, timestamp >> 32,
+                       timestamp & 0xffffffff, len(data), size)
+    return 6, body + data.ljust((len(data) + 3) & ~3, '\0')
+
+  def test_pcapng_sizes(self):
+    for order in '<>':
+      path = self.write_pcapng(order, [
+          self.section(order),
+          (1, struct.pack(order + 'HHI', 1, 0, 65535)),
+          # Nanosecond timestamps, set by the if_tsresol option.
+          (1, struct.pack(order + 'HHIHHB3xHH', 1, 0, 65535, 9, 1, 9, 0, 0)),
+          self.packet(order, 0, 10500000, 1500, 'abcd'),
+          (3, struct.pack(order + 'I', 60) + 'ab\0\0'),
+          self.packet(order, 1, 11000000000, 60, 'ab')])
+      self.assertEqual(list(offline.pcap_sizes(path)),
+                       [(0.0, 1500), (0.5, 60)])
+
+  def test_pcapng_undescribed_interface(self):
+    path = self.write_pcapng('<', [self.section('<'),
+                                   self.packet('<', 0, 0, 60, 'ab')])
+    self.assertRaises(ValueError, list, offline.pcap_sizes(path))
+
+  def test_not_pcap(self):
+    handle, path = tempfile.mkstemp()
+    os.write(handle, 'not a capture')
+    os.close(handle)
+    self.addCleanup(os.remove, path)
+    self.assertRaises(ValueError, list, offline.pcap_sizes(path))
+
+
+class SimulateTest(unittest.TestCase):
+  def test_bandwidth_limits_throughput(self):
+    params = dict(simulation.Pipe.PARAMS, bandwidth=100000, buffer=10000,
+                  delay=0.1)
+    traffic = offline.constant_bit_rate(200, 1000, 10.0)
+    results = offline.simulate(params, up=traffic)
+
+    up = results['up']
+    self.assertEqual(up['packets_attempted'], 2000)
+    self.assertAlmostEqual(up['packets_delivered'], 1000, delta=20)
+    self.assertAlmostEqual(up['drop_rate_buffer'], 0.5, delta=0.01)
+    self.assertGreaterEqual(up['latency_p50'], 0.1)
+    self.assertEqual(results['down']['packets_attempted'], 0)
+    self.assertAlmostEqual(results['virtual_seconds'], 10.1, delta=0.2)
+
+
+if __name__ == '__main__':
+  unittest.main()
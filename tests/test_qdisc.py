@@ -0,0 +1,163 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from packet_queue import monitoring
+from packet_queue import qdisc
+from packet_queue import simulation
+
+from test_simulation import FakeReactor
+
+
+class QdiscTest(unittest.TestCase):
+  def setUp(self):
+    self.reactor = FakeReactor()
+    params = simulation.Params(simulation.Pipe.PARAMS)
+    self.pipe = simulation.Pipe('test', params, monitoring.EventLog(),
+                                self.reactor)
+    self.received = []
+    self.dropped = []
+
+  def configure(self, **kwargs):
+    self.pipe.params.update(kwargs)
+
+  def use(self, name, **kwargs):
+    """Starts over with a new pipe using a queue discipline."""
+    params = simulation.Params(simulation.Pipe.PARAMS,
+                               qdisc=qdisc.NAMES.index(name), **kwargs)
+    self.pipe = simulation.Pipe('test', params, monitoring.EventLog(),
+                                self.reactor)
+
+  def send(self, obj, size, flow=None):
+    def deliver():
+      self.received.append(obj)
+    def drop():
+      self.dropped.append(obj)
+    self.pipe.attempt(deliver, drop, size, flow)
+
+  def wait(self, seconds, step=0.01):
+    for _ in range(int(round(seconds / step))):
+      self.reactor.advance_time(step)
+
+  def test_red_drops_early(self):
+    self.use('red', bandwidth=1000, red_min=1000, red_max=2000)
+    self.pipe.qdisc.average = 3000.0
+
+    self.send(1, 100)
+    self.assertEqual(self.dropped, [1])
+    self.assertEqual(self.pipe.packets_dropped_aqm, 1)
+    self.assertEqual(self.pipe.size, 0)
+
+  def test_red_average_decays_while_idle(self):
+    self.use('red', bandwidth=151400, red_min=1000, red_max=2000)
+    self.pipe.qdisc.average = 2000.0
+    self.pipe.qdisc.idle_since = 0.0
+
+    # Long enough to send a thousand packets, bringing the average well
+    # below red_min.
+    self.wait(10.0, step=10.0)
+    self.send(1, 100)
+    self.assertEqual(self.dropped, [])
+    self.assertLess(self.pipe.qdisc.average, 1000.0)
+
+  def test_codel_keeps_delay_down(self):
+    self.use('codel', bandwidth=100000)
+
+    # Offer 1.2 times the bandwidth for five seconds.
+    for i in range(500):
+      self.send(i, 1200)
+      self.wait(0.01)
+    self.assertGreater(self.pipe.packets_dropped_aqm, 0)
+
+    # Tail drop would have queued a second of packets by now.
+    self.assertLess(self.pipe.size, 20000)
+    self.assertLess(self.pipe.latency.quantile(0.99), 0.5)
+
+  def test_fq_codel_round_robin(self):
+    self.use('fq_codel', bandwidth=1000, fq_quantum=100)
+
+    for i in range(5):
+      self.send(('heavy', i), 100, flow='heavy')
+    self.send(('light', 0), 100, flow='light')
+
+    self.wait(0.3)
+    self.assertEqual(self.received,
+                     [('heavy', 0), ('light', 0), ('heavy', 1)])
+
+  def test_fq_codel_drops_from_fattest_flow(self):
+    self.use('fq_codel', bandwidth=1000, buffer=500)
+
+    for i in range(5):
+      self.send(('heavy', i), 100, flow='heavy')
+    self.send(('light', 0), 100, flow='light')
+
+    self.assertEqual(self.dropped, [('heavy', 1)])
+    self.assertEqual(self.pipe.size, 500)
+
+  def test_fq_codel_drops_until_under_limit(self):
+    self.use('fq_codel', bandwidth=1000, buffer=500)
+
+    for i in range(5):
+      self.send(('heavy', i), 100, flow='heavy')
+    self.send(('light', 0), 400, flow='light')
+
+    self.assertEqual(self.dropped, [('heavy', i) for i in range(1, 5)])
+    self.assertEqual(self.pipe.size, 500)
+
+  def test_fq_codel_finds_next_fattest_flow(self):
+    self.use('fq_codel', bandwidth=1000)
+
+    self.send(('heavy', 0), 100, flow='heavy')
+    self.send(('light', 0), 150, flow='light')
+    self.send(('heavy', 1), 100, flow='heavy')
+    self.send(('heavy', 2), 100, flow='heavy')
+
+    # Once the heavy flow runs empty, the light one is the longest.
+    self.configure(buffer=200)
+    self.send(('light', 1), 10, flow='light')
+    self.assertEqual(self.dropped, [('heavy', 1), ('heavy', 2), ('light', 0)])
+    self.assertEqual(self.pipe.size, 110)
+
+  def test_change_keeps_queued_packets(self):
+    self.configure(bandwidth=1000)
+    for i in range(3):
+      self.send(i, 100)
+
+    self.configure(qdisc=qdisc.NAMES.index('fq_codel'))
+    self.send(3, 100)
+    self.assertIsInstance(self.pipe.qdisc, qdisc.FQCoDel)
+
+    self.wait(0.4)
+    self.assertEqual(self.received, [0, 1, 2, 3])
+
+  def test_unknown_keeps_queued_packets(self):
+    self.configure(bandwidth=1000)
+    for i in range(3):
+      self.send(i, 100)
+
+    # As an unchecked write to shared params could leave it.
+    self.pipe.cached.qdisc = len(qdisc.NAMES)
+    self.assertRaises(ValueError, self.pipe.params_changed)
+    self.assertIsInstance(self.pipe.qdisc, qdisc.TailDrop)
+    self.assertEqual(len(self.pipe.qdisc), 2)
+    self.assertEqual(self.pipe.size, 300)
+
+    self.configure(qdisc=0)
+    self.send(3, 100)
+    self.wait(0.4)
+    self.assertEqual(self.received, [0, 1, 2, 3])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,131 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from packet_queue import schedules
+from packet_queue import simulation
+
+from test_simulation import FakeReactor
+
+
+TYPES = {k: type(v) for (k, v) in simulation.Pipe.PARAMS.items()}
+
+
+class ParseProgramTest(unittest.TestCase):
+  def test_defaults(self):
+    steps, loop, interval = schedules.parse_program(
+        {'steps': [{'time': '1', 'params': {'bandwidth': '1000'}}]}, TYPES)
+    self.assertEqual(len(steps), 1)
+    self.assertEqual(steps[0].time, 1.0)
+    self.assertEqual(steps[0].params, {'bandwidth': 1000})
+    self.assertFalse(steps[0].ramp)
+    self.assertFalse(loop)
+    self.assertEqual(interval, schedules.RAMP_INTERVAL)
+
+  def test_invalid(self):
+    for program in [None, {}, {'steps': []}, {'steps': [1]},
+                    {'steps': [{'time': 0}]},
+                    {'steps': [{'time': 0, 'params': {'colour': 1}}]},
+                    {'steps': [{'time': 0, 'params': {'loss': 'x'}}]},
+                    {'steps': [{'time': 0, 'params': {'qdisc': 9}}]},
+                    {'steps': [{'time': 2, 'params': {}},
+                               {'time': 1, 'params': {}}]},
+                    {'steps': [{'time': 0, 'params': {}}], 'interval': 0}]:
+      self.assertRaises(ValueError, schedules.parse_program, program, TYPES)
+
+
+class ScheduleTest(unittest.TestCase):
+  def setUp(self):
+    self.reactor = FakeReactor()
+    self.params = dict(simulation.Pipe.PARAMS)
+
+  def run_program(self, program):
+    steps, loop, interval = schedules.parse_program(program, TYPES)
+    schedule = schedules.Schedule(self.params, steps, loop, interval,
+                                  self.reactor)
+    schedule.start()
+    return schedule
+
+  def wait(self, seconds):
+    for _ in range(int(round(seconds / 0.001))):
+      self.reactor.advance_time(0.001)
+
+  def test_steps(self):
+    schedule = self.run_program({'steps': [
+        {'time': 0, 'params': {'bandwidth': 1000, 'delay': 0.1}},
+        {'time': 0.5, 'params': {'bandwidth': 2000}}]})
+    self.reactor.advance_time(0)
+    self.assertEqual(self.params['bandwidth'], 1000)
+    self.assertEqual(self.params['delay'], 0.1)
+
+    self.wait(0.499)
+    self.assertEqual(self.params['bandwidth'], 1000)
+    self.wait(0.001)
+    self.assertEqual(self.params['bandwidth'], 2000)
+    self.assertFalse(schedule.running)
+
+  def test_ramp(self):
+    self.run_program({'steps': [
+        {'time': 0, 'params': {'bandwidth': 1250000}},
+        {'time': 1, 'params': {'bandwidth': 62500}, 'ramp': True}]})
+    # Ticks fall every 10 ms from the start, so the value set at 0.5 holds.
+    self.wait(0.505)
+    self.assertAlmostEqual(self.params['bandwidth'], 656250, delta=1200)
+    self.assertIsInstance(self.params['bandwidth'], int)
+    self.wait(0.25)
+    self.assertAlmostEqual(self.params['bandwidth'], 359375, delta=1200)
+    self.wait(0.245)
+    self.assertEqual(self.params['bandwidth'], 62500)
+
+  def test_ramp_steps_choices(self):
+    self.run_program({'steps': [
+        {'time': 0, 'params': {'qdisc': 0, 'loss': 0.0}},
+        {'time': 1, 'params': {'qdisc': 3, 'loss': 0.5}, 'ramp': True}]})
+    self.wait(0.5)
+    self.assertEqual(self.params['qdisc'], 0)
+    self.assertAlmostEqual(self.params['loss'], 0.25, delta=0.01)
+    self.wait(0.5)
+    self.assertEqual(self.params['qdisc'], 3)
+    self.assertEqual(self.params['loss'], 0.5)
+
+  def test_first_step_ramp(self):
+    self.run_program({'steps': [
+        {'time': 1, 'params': {'loss': 0.5}, 'ramp': True}],
+                      'interval': 0.1})
+    self.wait(0.25)
+    self.assertAlmostEqual(self.params['loss'], 0.1, delta=0.001)
+
+  def test_loop(self):
+    self.run_program({'steps': [
+        {'time': 0, 'params': {'loss': 0.1}},
+        {'time': 1, 'params': {'loss': 0.2}},
+        {'time': 2, 'params': {'loss': 0.3}}], 'loop': True})
+    self.wait(4.5)
+    self.assertEqual(self.params['loss'], 0.1)
+    self.wait(1.0)
+    self.assertEqual(self.params['loss'], 0.2)
+
+  def test_stop(self):
+    schedule = self.run_program({'steps': [
+        {'time': 0, 'params': {'loss': 0.1}},
+        {'time': 1, 'params': {'loss': 0.2}}]})
+    self.wait(0.5)
+    schedule.stop()
+    self.wait(1.0)
+    self.assertEqual(self.params['loss'], 0.1)
+    self.assertFalse(schedule.to_json()['running'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,184 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from packet_queue import monitoring
+from packet_queue import shared
+from packet_queue import simulation
+
+from test_simulation import FakeReactor
+
+
+class SharedParamsTest(unittest.TestCase):
+  def setUp(self):
+    self.block = shared.SharedBlock.create(simulation.Pipe.PARAMS, 2)
+
+  def tearDown(self):
+    self.block.remove()
+
+  def test_defaults(self):
+    self.assertEqual(dict(self.block.params), simulation.Pipe.PARAMS)
+
+  def test_types(self):
+    self.block.params['bandwidth'] = 1024
+    self.block.params['delay'] = 0.5
+    self.assertIsInstance(self.block.params['bandwidth'], int)
+    self.assertIsInstance(self.block.params['delay'], float)
+
+  def test_visible_to_other_mappings(self):
+    other = shared.SharedBlock(self.block.path, simulation.Pipe.PARAMS, 2)
+    self.block.params.update(bandwidth=1024, loss=0.25)
+    self.assertEqual(other.params['bandwidth'], 1024)
+    self.assertEqual(other.params['loss'], 0.25)
+
+  def test_version(self):
+    other = shared.SharedBlock(self.block.path, simulation.Pipe.PARAMS, 0)
+    version = other.params.version
+    self.block.params.update(bandwidth=1024, loss=0.25)
+    self.assertEqual(other.params.version, version + 2)
+    snapshot = other.params.snapshot()
+    self.assertEqual(snapshot, dict(self.block.params))
+    self.assertIsInstance(snapshot['bandwidth'], int)
+
+  def test_poll(self):
+    other = shared.SharedBlock(self.block.path, simulation.Pipe.PARAMS, 0)
+    changes = []
+
+    class Watcher(object):
+      def params_changed(self):
+        changes.append(other.params.cached.loss)
+
+    watcher = Watcher()
+    other.params.watch(watcher)
+    self.block.params.update(loss=0.25)
+    self.assertEqual(other.params.cached.loss, 0.0)
+
+    other.params.poll()
+    other.params.poll()
+    self.assertEqual(other.params.cached.loss, 0.25)
+    self.assertEqual(changes, [0.25])
+
+  def test_unknown_key(self):
+    self.assertRaises(KeyError, self.block.params.__setitem__, 'foo', 1)
+    self.assertRaises(TypeError, self.block.params.__delitem__, 'loss')
+
+
+class SharedPipeTest(unittest.TestCase):
+  def setUp(self):
+    self.block = shared.SharedBlock.create(simulation.Pipe.PARAMS, 2)
+    self.reactor = FakeReactor()
+    self.workers = [
+        shared.SharedPipePair(self.block, monitoring.EventLog(), worker,
+                              self.reactor)
+        for worker in range(2)]
+    self.received = []
+
+  def tearDown(self):
+    self.block.remove()
+
+  def send(self, worker, obj, size):
+    def callback():
+      self.received.append(obj)
+    self.workers[worker].up.attempt(callback, lambda: None, size)
+
+  def test_buffer_shared(self):
+    self.block.params.update(bandwidth=1024, buffer=2048)
+
+    self.send(0, 1, 1024)
+    self.send(1, 2, 1024)
+    self.send(0, 3, 1024)
+    self.assertEqual(self.workers[0].up.backlog(), 2048)
+    self.assertEqual(self.workers[0].down.backlog(), 0)
+
+    self.reactor.advance_time(2.0)
+    self.assertItemsEqual(self.received, [1, 2])
+    self.assertEqual(self.workers[1].up.backlog(), 0)
+
+  def test_bandwidth_shared(self):
+    self.block.params['bandwidth'] = 1024
+
+    self.send(0, 1, 1024)
+    self.send(1, 2, 1024)
+
+    self.reactor.advance_time(1.0)
+    self.assertItemsEqual(self.received, [1])
+
+    self.reactor.advance_time(1.0)
+    self.assertItemsEqual(self.received, [1, 2])
+
+
+class AggregatePipeTest(unittest.TestCase):
+  def setUp(self):
+    self.block = shared.SharedBlock.create(simulation.Pipe.PARAMS, 2)
+    self.reactor = FakeReactor()
+    self.workers = [
+        shared.SharedPipePair(self.block, monitoring.EventLog(), worker,
+                              self.reactor)
+        for worker in range(2)]
+    self.pipes = shared.AggregatePipePair(self.block, monitoring.EventLog())
+
+  def tearDown(self):
+    self.block.remove()
+
+  def send(self, worker, size):
+    self.workers[worker].up.attempt(lambda: None, lambda: None, size)
+
+  def publish(self):
+    for worker in self.workers:
+      worker.publish()
+
+  def test_meter_summed(self):
+    self.block.params['buffer'] = 1500
+    self.send(0, 1000)
+    self.send(1, 1000)
+    self.reactor.advance_time(1.0)
+    self.assertEqual(self.pipes.up.meter()['packets_attempted'], 0)
+
+    self.publish()
+    meter = self.pipes.up.meter()
+    self.assertEqual(meter['packets_attempted'], 2)
+    self.assertEqual(meter['bytes_delivered'], 1000)
+    self.assertEqual(meter['packets_dropped_buffer'], 1)
+    self.assertEqual(self.pipes.down.meter()['packets_attempted'], 0)
+
+  def test_reset_meter(self):
+    self.send(0, 1000)
+    self.publish()
+    self.pipes.up.reset_meter()
+    self.send(1, 500)
+    self.reactor.advance_time(1.0)
+    self.publish()
+
+    meter = self.pipes.up.meter()
+    self.assertEqual(meter['packets_attempted'], 1)
+    self.assertEqual(meter['bytes_attempted'], 500)
+    self.assertEqual(sum(self.pipes.up.latency.counts), 2)
+
+  def test_size_and_latency(self):
+    self.block.params.update(bandwidth=1000, delay=0.5)
+    self.send(0, 1000)
+    self.send(1, 1000)
+    self.assertEqual(self.pipes.up.size, 2000)
+
+    self.reactor.advance_time(1.5)
+    self.reactor.advance_time(1.0)
+    self.publish()
+    self.assertEqual(self.pipes.up.size, 0)
+    latency = self.pipes.up.latency
+    self.assertEqual(sum(latency.counts), 2)
+    self.assertAlmostEqual(latency.sum, 4.0)
+
+
+if __name__ == '__main__':
+  unittest.main()
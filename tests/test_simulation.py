@@ -18,6 +18,22 @@ from packet_queue import monitoring
 from packet_queue import simulation
 
 
+class FakeDelayedCall(object):
+  """Handle returned by FakeReactor.callLater, like Twisted's DelayedCall."""
+  def __init__(self, reactor, time, callback):
+    self.reactor = reactor
+    self.time = time
+    self.callback = callback
+    self.cancelled = False
+    self.called = False
+
+  def active(self):
+    return not (self.cancelled or self.called)
+
+  def cancel(self):
+    self.cancelled = True
+
+
 class FakeReactor(object):
   """Substitute for the Twisted reactor module.
 
@@ -26,19 +42,28 @@ class FakeReactor(object):
   def __init__(self):
     self.queue = []
     self.time = 0.0
+    self.count = 0  # Keeps callbacks with equal times in scheduling order.
 
   def advance_time(self, seconds):
     self.time += seconds
     while self.queue:
-      time, callback = self.queue[0]
+      time, _, call = self.queue[0]
       if time <= self.time:
         self.queue.pop(0)
-        callback()
+        if not call.cancelled:
+          call.called = True
+          call.callback()
       else:
         break
 
   def callLater(self, delay, callback):
-    bisect.insort(self.queue, (self.time + delay, callback))
+    call = FakeDelayedCall(self, self.time + delay, callback)
+    self.count += 1
+    bisect.insort(self.queue, (call.time, self.count, call))
+    return call
+
+  def seconds(self):
+    return self.time
 
 
 class FakeReactorTest(unittest.TestCase):
@@ -67,14 +92,22 @@ class FakeReactorTest(unittest.TestCase):
     self.reactor.advance_time(0.5)
     self.assertItemsEqual(self.called, [1, 2, 3, 4])
 
+  def test_cancel(self):
+    call = self.reactor.callLater(0.5, self.Add(1))
+    self.reactor.callLater(0.5, self.Add(2))
+    call.cancel()
+
+    self.reactor.advance_time(0.5)
+    self.assertItemsEqual(self.called, [2])
+
 
 class PipeTest(unittest.TestCase):
   def setUp(self):
-    params = dict(simulation.Pipe.PARAMS)
-    self.pipe = simulation.Pipe('test', params, monitoring.EventLog())
-    self.received = []
     self.reactor = FakeReactor()
-    simulation.reactor = self.reactor
+    params = simulation.Params(simulation.Pipe.PARAMS)
+    self.pipe = simulation.Pipe('test', params, monitoring.EventLog(),
+                                self.reactor)
+    self.received = []
 
   def configure(self, **kwargs):
     self.pipe.params.update(kwargs)
@@ -118,6 +151,16 @@ class PipeTest(unittest.TestCase):
     self.wait(0.5)
     self.expect([1, 2, 3])
 
+  def test_throttle_first_packet(self):
+    self.configure(bandwidth=1000)
+
+    self.send(1, 500)
+    self.wait(0.25)
+    self.expect([])
+
+    self.wait(0.25)
+    self.expect([1])
+
   def test_throttle_plus_constant_delay(self):
     self.configure(bandwidth=4096, delay=2.0)
 
@@ -132,6 +175,58 @@ class PipeTest(unittest.TestCase):
     self.wait(2.0)
     self.expect([1, 2])
 
+  def test_burst(self):
+    self.configure(bandwidth=1024, burst=2048)
+
+    self.send(1, 1024)
+    self.send(2, 1024)
+    self.send(3, 1024)
+    self.wait(0.0)
+    self.expect([1, 2])
+
+    self.wait(1.0)
+    self.expect([1, 2, 3])
+
+  def test_peak_rate(self):
+    self.configure(bandwidth=1024, burst=2048, peak_rate=4096)
+
+    self.send(1, 1024)
+    self.send(2, 1024)
+    self.wait(0.25)
+    self.expect([1])
+
+    self.wait(0.25)
+    self.expect([1, 2])
+
+  def test_bandwidth_change_applies_to_queued_packets(self):
+    self.configure(bandwidth=1024)
+
+    self.send(1, 2048)
+    self.wait(0.5)
+    self.configure(bandwidth=4096)
+
+    # About 512 bytes went at the old rate, and the other 1536 go at the new
+    # one, from the moment the params changed.
+    self.wait(0.37)
+    self.expect([])
+    self.wait(0.01)
+    self.expect([1])
+
+  def test_single_timer_while_waiting(self):
+    self.configure(bandwidth=1024)
+
+    self.send(1, 1024)
+    self.send(2, 1024)
+    self.reactor.advance_time(0.5)
+    self.assertEqual(len(self.reactor.queue), 1)
+    self.assertEqual(self.reactor.queue[0][0], 1.0)
+
+    self.configure(bandwidth=512)
+    self.reactor.advance_time(0.5)
+    self.expect([])
+    self.reactor.advance_time(0.5)
+    self.expect([1])
+
   def test_buffer_full(self):
     self.configure(bandwidth=1024, buffer=2048)
 
@@ -157,3 +252,118 @@ class PipeTest(unittest.TestCase):
     self.send(1, 1024)
     self.wait(1.0)
     self.expect([])
+
+  def test_single_timer(self):
+    self.configure(bandwidth=1024, delay=1.0)
+
+    for i in range(10):
+      self.send(i, 1024)
+    self.assertEqual(len(self.reactor.queue), 1)
+
+    self.wait(20.0)
+    self.expect(range(10))
+    self.assertEqual(self.reactor.queue, [])
+
+  def test_delivery_due_before_next_release(self):
+    self.configure(bandwidth=1024, delay=0.5)
+
+    self.send(1, 1024)
+    self.wait(1.0)
+    self.send(2, 2048)  # Released at 3.0, after 1 is delivered at 1.5.
+
+    self.wait(0.5)
+    self.expect([1])
+
+    self.wait(2.0)
+    self.expect([1, 2])
+
+  def test_order_preserved_when_delay_decreases(self):
+    self.configure(delay=1.0)
+    self.send(1)
+    self.configure(delay=0.0)
+    self.send(2)
+
+    self.wait(0.0)
+    self.expect([])
+
+    self.wait(1.0)
+    self.assertEqual(self.received, [1, 2])
+
+  def test_meter(self):
+    self.configure(bandwidth=1024, buffer=2048)
+
+    self.send(1, 1024)
+    self.send(2, 2048)
+    self.configure(loss=1.0)
+    self.send(3, 512)
+    self.wait(1.0)
+
+    meter = self.pipe.meter()
+    self.assertEqual(meter['packets_attempted'], 3)
+    self.assertEqual(meter['bytes_attempted'], 3584)
+    self.assertEqual(meter['packets_delivered'], 1)
+    self.assertEqual(meter['bytes_delivered'], 1024)
+    self.assertEqual(meter['bytes_dropped_buffer'], 2048)
+    self.assertEqual(meter['bytes_dropped_loss'], 512)
+
+    self.pipe.reset_meter()
+    self.assertEqual(set(self.pipe.meter().values()), {0})
+
+
+class ParamsTest(unittest.TestCase):
+  def setUp(self):
+    self.params = simulation.Params(simulation.Pipe.PARAMS)
+
+  def test_initial_values(self):
+    params = simulation.Params(simulation.Pipe.PARAMS, bandwidth=1000.0)
+    self.assertEqual(params['bandwidth'], 1000)
+    self.assertIsInstance(params.cached.bandwidth, int)
+    self.assertEqual(params.cached.delay, 0.0)
+
+  def test_types(self):
+    self.params['bandwidth'] = 1024.0
+    self.params['delay'] = 1
+    self.assertIsInstance(self.params['bandwidth'], int)
+    self.assertIsInstance(self.params['delay'], float)
+
+  def test_version(self):
+    self.assertEqual(self.params.version, 0)
+    self.params['loss'] = 0.5
+    self.assertEqual(self.params.version, 1)
+    self.params.update(loss=0.25, delay=0.5)
+    self.assertEqual(self.params.version, 2)
+
+  def test_unknown_key(self):
+    self.assertRaises(KeyError, self.params.__setitem__, 'foo', 1)
+    self.assertRaises(KeyError, self.params.update, loss=0.5, foo=1)
+    self.assertEqual(self.params['loss'], 0.0)
+    self.assertEqual(self.params.version, 0)
+    self.assertRaises(TypeError, self.params.__delitem__, 'loss')
+
+  def test_cached(self):
+    cached = self.params.cached
+    self.params.update(loss=0.25, delay=0.5)
+    self.assertIs(self.params.cached, cached)
+    self.assertEqual(cached.loss, 0.25)
+    self.assertEqual(cached.delay, 0.5)
+
+  def test_watchers(self):
+    class Watcher(object):
+      changes = 0
+      def params_changed(self):
+        self.changes += 1
+
+    watcher = Watcher()
+    self.params.watch(watcher)
+    self.params['loss'] = 0.5
+    self.params.update(loss=0.25, delay=0.5)
+    self.assertEqual(watcher.changes, 2)
+
+    del watcher
+    self.assertEqual(len(self.params.watchers), 0)
+
+  def test_out_of_range(self):
+    self.assertRaises(ValueError, self.params.__setitem__, 'qdisc', 9)
+    self.assertRaises(ValueError, self.params.update, loss=0.5, qdisc=-1)
+    self.assertEqual(self.params['qdisc'], 0)
+    self.assertEqual(self.params['loss'], 0.0)
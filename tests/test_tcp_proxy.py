@@ -0,0 +1,122 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from packet_queue import monitoring
+from packet_queue import simulation
+from packet_queue import tcp_proxy
+
+from test_simulation import FakeReactor
+
+
+class FakeTransport(object):
+  """Substitute for a Twisted TCP transport that records what happens."""
+  def __init__(self):
+    self.written = []
+    self.paused = False
+    self.producer = None
+    self.write_closed = False
+
+  def write(self, data):
+    self.written.append(data)
+
+  def pauseProducing(self):
+    self.paused = True
+
+  def resumeProducing(self):
+    self.paused = False
+
+  def registerProducer(self, producer, streaming):
+    self.producer = producer
+
+  def unregisterProducer(self):
+    self.producer = None
+
+  def loseWriteConnection(self):
+    self.write_closed = True
+
+
+class StreamTest(unittest.TestCase):
+  def setUp(self):
+    self.reactor = FakeReactor()
+    simulation.reactor = self.reactor
+    tcp_proxy.reactor = self.reactor
+
+    self.params = simulation.Params(simulation.Pipe.PARAMS)
+    self.pipe = simulation.Pipe('up', self.params, monitoring.EventLog())
+    self.source = FakeTransport()
+    self.sink = FakeTransport()
+    self.done = []
+    self.stream = tcp_proxy.Stream(
+        self.pipe, self.source, self.sink, lambda: self.done.append(True),
+        segment_size=4, window=8)
+
+  def test_segments(self):
+    self.params['delay'] = 0.5
+    self.stream.write('abcdefghij')
+    self.assertEqual(self.pipe.packets_attempted, 3)
+
+    self.reactor.advance_time(0.5)
+    self.assertEqual(self.sink.written, ['abcd', 'efgh', 'ij'])
+
+  def test_retransmit_in_order(self):
+    self.params['loss'] = 1.0
+    self.stream.write('abcd')
+    self.params['loss'] = 0.0
+    self.stream.write('efgh')
+    self.reactor.advance_time(0)
+    self.assertEqual(self.sink.written, [])
+
+    self.reactor.advance_time(tcp_proxy.MIN_RETRANSMIT_TIMEOUT)
+    self.assertEqual(self.sink.written, ['abcd', 'efgh'])
+
+  def test_window(self):
+    self.params['delay'] = 0.5
+    self.stream.write('abcd')
+    self.assertFalse(self.source.paused)
+    self.stream.write('efgh')
+    self.assertTrue(self.source.paused)
+
+    self.reactor.advance_time(0.5)
+    self.assertFalse(self.source.paused)
+
+  def test_sink_paused(self):
+    self.assertIs(self.sink.producer, self.stream)
+    self.stream.pauseProducing()
+    self.assertTrue(self.source.paused)
+    self.stream.resumeProducing()
+    self.assertFalse(self.source.paused)
+
+  def test_finish_after_delivery(self):
+    self.params['delay'] = 0.5
+    self.stream.write('abcd')
+    self.stream.finish()
+    self.assertFalse(self.sink.write_closed)
+
+    self.reactor.advance_time(0.5)
+    self.assertTrue(self.sink.write_closed)
+    self.assertEqual(self.done, [True])
+
+  def test_abort(self):
+    self.params['delay'] = 0.5
+    self.stream.write('abcd')
+    self.stream.abort()
+    self.reactor.advance_time(0.5)
+    self.assertEqual(self.sink.written, [])
+    self.assertFalse(self.sink.write_closed)
+    self.assertEqual(self.done, [True])
+
+
+if __name__ == '__main__':
+  unittest.main()
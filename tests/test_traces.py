@@ -0,0 +1,145 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from packet_queue import monitoring
+from packet_queue import simulation
+from packet_queue import traces
+
+from test_simulation import FakeReactor
+
+
+class TraceTestCase(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.reactor = FakeReactor()
+    simulation.reactor = self.reactor
+    traces.reactor = self.reactor
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write(self, contents):
+    path = os.path.join(self.directory, 'trace')
+    with open(path, 'w') as f:
+      f.write(contents)
+    return path
+
+
+class DeliveryTraceTest(TraceTestCase):
+  def test_repeats(self):
+    trace = traces.DeliveryTrace(self.write('# comment\n2\n2\n\n5\n'))
+    self.assertEqual([trace.next() for _ in range(6)], [2, 2, 5, 7, 7, 10])
+
+  def test_skip(self):
+    trace = traces.DeliveryTrace(self.write('2\n5'))
+    trace.skip(23)
+    self.assertEqual([trace.next() for _ in range(3)], [25, 27, 30])
+    trace.skip(32)
+    self.assertEqual(trace.next(), 32)
+
+  def test_skip_within_period(self):
+    lines = ['# opportunities'] + [str(t) for t in range(0, 10000, 2)]
+    trace = traces.DeliveryTrace(self.write('\n'.join(lines) + '\n\n'))
+    for target in [0, 1, 4321, 9997, 10001]:
+      trace.skip(target)
+      expected = target + target % 2
+      self.assertEqual(trace.next(), expected)
+
+  def test_empty(self):
+    self.assertRaises(ValueError, traces.DeliveryTrace, self.write('\n# x\n'))
+
+
+class DeliveryShaperTest(TraceTestCase):
+  def setUp(self):
+    TraceTestCase.setUp(self)
+    trace = traces.DeliveryTrace(self.write('10\n20\n30\n40\n'))
+    self.shaper = traces.DeliveryShaper(trace, 100.0)
+
+  def test_shares_opportunity(self):
+    self.assertAlmostEqual(self.shaper.release_time(100.0, 1000), 100.01)
+    self.assertAlmostEqual(self.shaper.release_time(100.01, 500), 100.01)
+    self.assertAlmostEqual(self.shaper.release_time(100.01, 1), 100.02)
+
+  def test_large_packet_spans_opportunities(self):
+    self.assertAlmostEqual(self.shaper.release_time(100.0, 3001), 100.03)
+
+  def test_idle_opportunities_wasted(self):
+    self.assertAlmostEqual(self.shaper.release_time(100.0, 100), 100.01)
+    self.assertAlmostEqual(self.shaper.release_time(100.025, 100), 100.03)
+    self.assertAlmostEqual(self.shaper.release_time(110.005, 100), 110.01)
+
+
+class ShapedPipeTest(TraceTestCase):
+  def test_pipe_follows_trace(self):
+    params = simulation.Params(simulation.Pipe.PARAMS, bandwidth=1, delay=0.5)
+    pipe = simulation.Pipe('test', params, monitoring.EventLog())
+    pipe.shaper = traces.DeliveryShaper(
+        traces.DeliveryTrace(self.write('100\n200\n')), 0.0)
+
+    received = []
+    for i in range(3):
+      pipe.attempt(lambda i=i: received.append(i), lambda: None, 1500)
+
+    self.reactor.advance_time(0.65)
+    self.assertEqual(received, [0])
+    self.reactor.advance_time(0.1)
+    self.assertEqual(received, [0, 1])
+    self.reactor.advance_time(0.1)
+    self.assertEqual(received, [0, 1, 2])
+
+
+class ParamsTraceTest(TraceTestCase):
+  def setUp(self):
+    TraceTestCase.setUp(self)
+    self.params = dict(simulation.Pipe.PARAMS)
+
+  def test_sets_params(self):
+    path = self.write('time,bandwidth,delay\n0,1000,0.1\n1.5,2000,\n')
+    traces.ParamsTrace(path, self.params).start()
+    self.reactor.advance_time(0)
+    self.assertEqual(self.params['bandwidth'], 1000)
+    self.assertIsInstance(self.params['bandwidth'], int)
+    self.assertEqual(self.params['delay'], 0.1)
+
+    self.reactor.advance_time(1.0)
+    self.assertEqual(self.params['bandwidth'], 1000)
+    self.reactor.advance_time(0.5)
+    self.assertEqual(self.params['bandwidth'], 2000)
+    self.assertEqual(self.params['delay'], 0.1)
+
+  def test_loop(self):
+    path = self.write('time,loss\n0,0.1\n1,0.2\n2,0.3\n')
+    traces.ParamsTrace(path, self.params, loop=True).start()
+    for _ in range(5):
+      self.reactor.advance_time(1.0)
+    self.assertEqual(self.params['loss'], 0.2)
+
+  def test_unknown_param(self):
+    path = self.write('time,colour\n0,1\n')
+    self.assertRaises(ValueError, traces.ParamsTrace, path, self.params)
+
+  def test_bad_rows(self):
+    for rows, number in [('0,0\n1,7\n', 4), ('0,0\n\n# x\n1,\nfoo,0\n', 7)]:
+      path = self.write('# comment\ntime,qdisc\n' + rows)
+      with self.assertRaises(ValueError) as context:
+        traces.ParamsTrace(path, self.params)
+      self.assertIn('line {}:'.format(number), context.exception.args[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
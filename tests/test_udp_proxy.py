@@ -0,0 +1,101 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from packet_queue import monitoring
+from packet_queue import simulation
+from packet_queue import udp_proxy
+
+from test_simulation import FakeReactor
+
+
+class FakeUDP(object):
+  """Substitute for udp_proxy.UDP that records what is sent."""
+  def __init__(self, receiver):
+    self.receiver = receiver
+    self.sent = []
+    self.listening = False
+
+  def listen(self, port):
+    self.listening = True
+    return port
+
+  def close(self):
+    self.listening = False
+
+  def Send(self, data, address):
+    if self.listening:
+      self.sent.append((data, address))
+
+
+class ProxyServerTest(unittest.TestCase):
+  def setUp(self):
+    self.reactor = FakeReactor()
+    simulation.reactor = self.reactor
+    udp_proxy.reactor = self.reactor
+
+    pipes = simulation.PipePair(simulation.Params(simulation.Pipe.PARAMS),
+                                monitoring.EventLog())
+    self.server = udp_proxy.ProxyServer(
+        3000, pipes, FakeUDP, max_flows=2, flow_timeout=10.0)
+    self.server.udp.listen(3001)
+
+  def client_send(self, port):
+    self.server.Receive('data', ('127.0.0.1', port))
+    self.reactor.advance_time(0)
+    return self.server.proxy_clients[('127.0.0.1', port)]
+
+  def test_relay(self):
+    proxy_client = self.client_send(5000)
+    self.assertEqual(proxy_client.udp.sent, [('data', ('127.0.0.1', 3000))])
+
+    proxy_client.Receive('reply', ('127.0.0.1', 3000))
+    self.reactor.advance_time(0)
+    self.assertEqual(self.server.udp.sent, [('reply', ('127.0.0.1', 5000))])
+
+  def test_evict_least_recently_used(self):
+    first = self.client_send(5000)
+    second = self.client_send(5001)
+    first.Receive('reply', ('127.0.0.1', 3000))  # Now second is the oldest.
+
+    self.client_send(5002)
+    self.assertEqual(list(self.server.proxy_clients),
+                     [('127.0.0.1', 5000), ('127.0.0.1', 5002)])
+    self.assertTrue(first.udp.listening)
+    self.assertFalse(second.udp.listening)
+
+  def test_expire_idle(self):
+    first = self.client_send(5000)
+    self.reactor.advance_time(6.0)
+    second = self.client_send(5001)
+
+    self.reactor.advance_time(5.0)
+    self.assertFalse(first.udp.listening)
+    self.assertEqual(list(self.server.proxy_clients), [('127.0.0.1', 5001)])
+
+    self.reactor.advance_time(5.0)
+    self.assertFalse(second.udp.listening)
+    self.assertEqual(len(self.server.proxy_clients), 0)
+    self.assertEqual(self.reactor.queue, [])
+
+  def test_activity_postpones_expiry(self):
+    proxy_client = self.client_send(5000)
+    for _ in range(3):
+      self.reactor.advance_time(6.0)
+      self.client_send(5000)
+    self.assertTrue(proxy_client.udp.listening)
+
+
+if __name__ == '__main__':
+  unittest.main()
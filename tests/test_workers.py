@@ -0,0 +1,59 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import unittest
+from packet_queue import workers
+
+
+class FakeProcess(object):
+  def __init__(self, returncode=None):
+    self.returncode = returncode
+
+  def poll(self):
+    return self.returncode
+
+
+class WaitReadyTest(unittest.TestCase):
+  def setUp(self):
+    self.ready, self.ready_write = os.pipe()
+
+  def tearDown(self):
+    os.close(self.ready)
+    if self.ready_write is not None:
+      os.close(self.ready_write)
+
+  def test_ready(self):
+    os.write(self.ready_write, '..')
+    processes = [FakeProcess(), FakeProcess()]
+    self.assertTrue(workers.wait_ready(self.ready, processes, 1.0))
+
+  def test_timeout(self):
+    os.write(self.ready_write, '.')
+    processes = [FakeProcess(), FakeProcess()]
+    self.assertFalse(workers.wait_ready(self.ready, processes, 0.05))
+
+  def test_worker_exited(self):
+    processes = [FakeProcess(), FakeProcess(returncode=1)]
+    self.assertFalse(workers.wait_ready(self.ready, processes, 10.0))
+
+  def test_pipe_closed(self):
+    os.close(self.ready_write)
+    self.ready_write = None
+    self.assertFalse(workers.wait_ready(self.ready, [FakeProcess()], 10.0))
+
+
+if __name__ == '__main__':
+  unittest.main()